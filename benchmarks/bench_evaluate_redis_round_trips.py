@@ -0,0 +1,143 @@
+"""
+Benchmark of the Redis traffic of /evaluate for a patient whose data has changed.
+
+Compares the previous sequence of awaited commands (get, delete + publish, get, set, set pointer,
+delete + publish of the old fingerprint, set) with the current one (one pipelined read before the
+database work and one MULTI/EXEC transaction for all the writes after it). Every round trip to the
+in-process Redis stand-in is counted and delayed by --rtt-ms to simulate the network.
+Finally, the round trips of the real /evaluate endpoint are counted end to end, for a changed patient and for an
+unchanged patient whose fingerprint entry is missing (expired or evicted), which also reads the patient's cache entry.
+
+    python benchmarks/bench_evaluate_redis_round_trips.py --requests 500 --rtt-ms 0.5
+"""
+from contextlib import contextmanager
+from unittest.mock import patch
+import argparse
+import asyncio
+import json
+import time
+
+from harness import bench_app, login
+import fakeredis
+import redis.asyncio.connection
+import main
+
+
+class RoundTrips:
+    # Counts the packets sent to Redis (one per command, one per pipeline) and adds a fixed network latency to each
+    def __init__(self, rtt_seconds):
+        self.rtt_seconds = rtt_seconds
+        self.count = 0
+
+    @contextmanager
+    def measure(self):
+        send_packed_command = redis.asyncio.connection.Connection.send_packed_command
+        round_trips = self
+
+        async def send(connection, *args, **kwargs):
+            round_trips.count += 1
+            if round_trips.rtt_seconds:
+                await asyncio.sleep(round_trips.rtt_seconds)
+            return await send_packed_command(connection, *args, **kwargs)
+
+        with patch.object(redis.asyncio.connection.Connection, "send_packed_command", send):
+            yield self
+
+
+async def sequential_commands(patient_data, patient_id, recommendations_json):
+    # Redis traffic of a changed patient before the change, each command awaited on its own
+    redis_client = main.redis_client
+    fingerprint = main.get_patient_fingerprint(patient_data)
+    fingerprint_key = main.get_recommendations_cache_key_by_fingerprint(fingerprint)
+    cache_key = main.get_recommendations_cache_key(patient_id, patient_data.first_name, patient_data.last_name)
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(fingerprint_key)
+        pipe.pttl(fingerprint_key)
+        await pipe.execute()
+    await redis_client.delete(cache_key)
+    await redis_client.publish(main.CACHE_INVALIDATION_CHANNEL, json.dumps([cache_key]))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(cache_key)
+        pipe.pttl(cache_key)
+        await pipe.execute()
+    await redis_client.set(cache_key, recommendations_json, ex=86400)
+    pointer_key = main.get_patient_fingerprint_key(patient_data.first_name, patient_data.last_name)
+    previous_fingerprint = await redis_client.set(pointer_key, fingerprint, ex=86400, get=True)
+    if previous_fingerprint and previous_fingerprint != fingerprint:
+        previous_key = main.get_recommendations_cache_key_by_fingerprint(previous_fingerprint)
+        await redis_client.delete(previous_key)
+        await redis_client.publish(main.CACHE_INVALIDATION_CHANNEL, json.dumps([previous_key]))
+    await redis_client.set(fingerprint_key, recommendations_json, ex=86400)
+
+
+async def batched_commands(patient_data, patient_id, recommendations_json):
+    # Current Redis traffic of a changed patient, through the cache helpers used by /evaluate
+    fingerprint = main.get_patient_fingerprint(patient_data)
+    pointer_key = main.get_patient_fingerprint_key(patient_data.first_name, patient_data.last_name)
+    _, (previous_fingerprint,) = await main.cache_read(main.get_recommendations_cache_key_by_fingerprint(fingerprint), "fingerprint", [pointer_key])
+    cache_key = main.get_recommendations_cache_key(patient_id, patient_data.first_name, patient_data.last_name)
+    batch = main.cache_batch()
+    batch.set(cache_key, recommendations_json, ex=86400, invalidate=True)
+    await main.cache_fingerprint(batch, patient_data, fingerprint, previous_fingerprint, recommendations_json)
+
+
+async def run(commands, requests, round_trips):
+    with patch("main.redis_client", fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)):
+        main.local_cache.clear()
+        latencies = []
+        with round_trips.measure():
+            round_trips.count = 0
+            for i in range(requests):
+                # Every request changes the BMI of the same patient, so the previous fingerprint is always replaced
+                patient_data = main.PatientData(first_name="Bench", last_name="Mark", age=70, bmi=20 + i % 2, chronic_pain=True, recent_surgery=False)
+                start = time.perf_counter()
+                await commands(patient_data, 1, json.dumps(main.generate_recommendation(patient_data)))
+                latencies.append(time.perf_counter() - start)
+        return round_trips.count / requests, sum(latencies) / requests * 1000
+
+
+async def endpoint_round_trips(requests, round_trips, changed=True):
+    async with bench_app() as client:
+        headers = await login(client)
+        patient = {"first_name": "Bench", "last_name": "Mark", "age": 70, "bmi": 20.0, "chronic_pain": True, "recent_surgery": False}
+        await client.post("/evaluate", json=patient, headers=headers)
+        fingerprint_key = main.get_recommendations_cache_key_by_fingerprint(main.get_patient_fingerprint(main.PatientData(**patient)))
+        count = 0
+        for i in range(requests):
+            if not changed:
+                # The fingerprint entry is gone, the patient's cache entry still holds its recommendations
+                await main.redis_client.delete(fingerprint_key)
+                main.local_cache.clear()
+            with round_trips.measure():
+                round_trips.count = 0
+                body = {**patient, "bmi": 21.0 + i % 2} if changed else patient
+                response = await client.post("/evaluate", json=body, headers=headers)
+                response.raise_for_status()
+                count += round_trips.count
+        return count / requests
+
+
+async def bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="simulated network round trip to Redis")
+    args = parser.parse_args()
+    round_trips = RoundTrips(args.rtt_ms / 1000)
+
+    print(f"{args.requests} evaluations of a changed patient, {args.rtt_ms} ms per Redis round trip")
+    print(f"{'redis traffic':<24}{'round trips/request':>20}{'ms/request':>12}")
+    for name, commands in (("sequential commands", sequential_commands), ("pipeline + transaction", batched_commands)):
+        count, latency = await run(commands, args.requests, round_trips)
+        print(f"{name:<24}{count:>20.1f}{latency:>12.3f}")
+
+    main.local_cache.clear()
+    count = await endpoint_round_trips(args.requests, round_trips)
+    print(f"POST /evaluate (changed patient, end to end): {count:.1f} Redis round trips per request")
+    main.local_cache.clear()
+    count = await endpoint_round_trips(args.requests, round_trips, changed=False)
+    print(f"POST /evaluate (unchanged patient, fingerprint missing, end to end): {count:.1f} Redis round trips per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,180 @@
+"""
+Load test of the API with a configurable mix of requests at a fixed concurrency.
+
+Runs the app in process (see harness.py). The operations are drawn with a fixed seed, so a run is reproducible:
+- token: POST /token (bcrypt check of the admin password);
+- evaluate_new: POST /evaluate for a patient never seen before;
+- evaluate_changed: POST /evaluate for a known patient whose BMI changed;
+- evaluate_unchanged: POST /evaluate for a known patient with the same data (cache);
+- recommendation: GET /recommendation/{id} of an existing recommendation.
+Throughput and p50/p95/p99 latency are reported for the whole run and per operation.
+With --baseline the results are compared with a JSON baseline (and the process exits with status 1 on a regression),
+--save-baseline writes the results as the new baseline.
+
+    python benchmarks/bench_load.py --requests 2000 --concurrency 16
+    python benchmarks/bench_load.py --baseline benchmarks/baselines/load.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+from harness import bench_app, compare_to_baseline, latency_summary, login, save_baseline, ADMIN_PASSWORD
+import main
+
+DEFAULT_MIX = "token=1,evaluate_new=10,evaluate_changed=10,evaluate_unchanged=40,recommendation=39"
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight)
+    return weights
+
+
+class LoadState:
+    # Known patients (their current data) and recommendation ids the operations pick from
+    def __init__(self, rng):
+        self.rng = rng
+        self.patients = []
+        self.recommendation_ids = []
+        self.new_patients = 0
+
+    def new_patient(self):
+        self.new_patients += 1
+        return {
+            "first_name": "Load", "last_name": f"New{self.new_patients}", "age": self.rng.randint(18, 95),
+            "bmi": round(self.rng.uniform(16, 45), 1), "chronic_pain": self.rng.random() < 0.3, "recent_surgery": self.rng.random() < 0.1
+        }
+
+
+async def token(client, headers, state):
+    return await client.post("/token", data={"username": main.fake_users_db["username"], "password": ADMIN_PASSWORD})
+
+
+async def evaluate_new(client, headers, state):
+    return await client.post("/evaluate", json=state.new_patient(), headers=headers)
+
+
+async def evaluate_changed(client, headers, state):
+    patient = state.rng.choice(state.patients)
+    patient["bmi"] = round(patient["bmi"] + 0.1, 1)
+    return await client.post("/evaluate", json=dict(patient), headers=headers)
+
+
+async def evaluate_unchanged(client, headers, state):
+    return await client.post("/evaluate", json=dict(state.rng.choice(state.patients)), headers=headers)
+
+
+async def recommendation(client, headers, state):
+    return await client.get(f"/recommendation/{state.rng.choice(state.recommendation_ids)}", headers=headers)
+
+
+OPERATIONS = {
+    "token": token,
+    "evaluate_new": evaluate_new,
+    "evaluate_changed": evaluate_changed,
+    "evaluate_unchanged": evaluate_unchanged,
+    "recommendation": recommendation,
+}
+
+
+async def seed(client, headers, state, patients):
+    # Known patients and their recommendations, evaluated once before the measurements
+    for i in range(patients):
+        patient = state.new_patient()
+        patient["last_name"] = f"Known{i}"
+        response = await client.post("/evaluate", json=patient, headers=headers)
+        response.raise_for_status()
+        state.patients.append(patient)
+    async with client.session_factory() as db:
+        state.recommendation_ids = (await db.execute(text("SELECT id FROM recommendations"))).scalars().all()
+
+
+async def run_load(client, headers, state, operations, concurrency):
+    latencies = {name: [] for name in dict.fromkeys(operations)}
+    errors = 0
+    queue = iter(operations)
+
+    async def client_loop():
+        nonlocal errors
+        for name in queue:
+            start = time.perf_counter()
+            response = await OPERATIONS[name](client, headers, state)
+            latencies[name].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    every = [latency for values in latencies.values() for latency in values]
+    return {
+        "config": {"requests": len(operations), "concurrency": concurrency},
+        "throughput_rps": len(every) / elapsed,
+        "errors": errors,
+        "overall": latency_summary(every),
+        "operations": {name: latency_summary(values) for name, values in latencies.items()},
+    }
+
+
+def baseline_metrics(results):
+    # Throughput must not drop, the p95 latencies must not grow
+    metrics = {"throughput_rps": (results["throughput_rps"], True), "overall.p95_ms": (results["overall"]["p95_ms"], False)}
+    for name, summary in results["operations"].items():
+        metrics[f"operations.{name}.p95_ms"] = (summary["p95_ms"], False)
+    return metrics
+
+
+async def bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--patients", type=int, default=200, help="known patients evaluated before the run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON baseline to compare with")
+    parser.add_argument("--save-baseline", help="write the results to this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline (fraction)")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    operations = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    state = LoadState(rng)
+
+    # A database file, so that the concurrent requests each get their own connection
+    with tempfile.TemporaryDirectory() as directory:
+        async with bench_app(os.path.join(directory, "bench.db")) as client:
+            headers = await login(client)
+            await seed(client, headers, state, args.patients)
+            main.local_cache.clear()
+            results = await run_load(client, headers, state, operations, args.concurrency)
+    results["config"].update(mix=args.mix, seed=args.seed, patients=args.patients)
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent clients, mix {args.mix}")
+    print(f"{'operation':<22}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, summary in (*results["operations"].items(), ("overall", results["overall"])):
+        print(f"{name:<22}{summary['requests']:>10}{summary['p50_ms']:>10.2f}{summary['p95_ms']:>10.2f}{summary['p99_ms']:>10.2f}")
+    print(f"throughput: {results['throughput_rps']:.0f} requests/s, {results['errors']} errors")
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+    if args.baseline:
+        regressions = compare_to_baseline(args.baseline, baseline_metrics(results), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
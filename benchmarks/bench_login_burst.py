@@ -0,0 +1,79 @@
+"""
+Latency of /evaluate while a burst of logins is hashing passwords.
+
+Runs the app in process (see harness.py) and measures /evaluate latency with no logins, during a burst of
+/token requests with bcrypt running in the bounded thread pool, and during the same burst with bcrypt running
+inline on the event loop (the previous behaviour).
+
+    python benchmarks/bench_login_burst.py --logins 20 --concurrency 8
+"""
+import argparse
+import asyncio
+import time
+from unittest.mock import patch
+
+from harness import bench_app, latency_summary, login, ADMIN_PASSWORD
+
+
+async def run_inline(func, *args):
+    # bcrypt on the event loop, as before
+    return func(*args)
+
+
+async def evaluate_load(client, headers, concurrency, stop=None, requests=None):
+    latencies = []
+    patient = {"first_name": "Burst", "last_name": "Patient", "age": 40, "bmi": 24.0, "chronic_pain": False, "recent_surgery": False}
+
+    async def loop():
+        while (stop is not None and not stop.is_set()) or (requests is not None and len(latencies) < requests):
+            start = time.perf_counter()
+            response = await client.post("/evaluate", json=patient, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return latencies
+
+
+async def login_burst(client, logins, stop):
+    async def one_login():
+        response = await client.post("/token", data={"username": "admin", "password": ADMIN_PASSWORD})
+        response.raise_for_status()
+
+    await asyncio.gather(*(one_login() for _ in range(logins)))
+    stop.set()
+
+
+async def measure_burst(client, headers, logins, concurrency):
+    stop = asyncio.Event()
+    latencies, _ = await asyncio.gather(
+        evaluate_load(client, headers, concurrency, stop=stop),
+        login_burst(client, logins, stop)
+    )
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400)
+    args = parser.parse_args()
+
+    async with bench_app() as client:
+        headers = await login(client)
+        await evaluate_load(client, headers, 1, requests=10)
+
+        results = {"no logins": latency_summary(await evaluate_load(client, headers, args.concurrency, requests=args.requests))}
+        results["login burst, thread pool"] = latency_summary(await measure_burst(client, headers, args.logins, args.concurrency))
+        with patch("main.run_password_hashing", run_inline):
+            results["login burst, inline bcrypt"] = latency_summary(await measure_burst(client, headers, args.logins, args.concurrency))
+
+    print(f"/evaluate latency with {args.concurrency} concurrent clients, bursts of {args.logins} logins")
+    print(f"{'scenario':<30}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, summary in results.items():
+        print(f"{name:<30}{summary['requests']:>10}{summary['p50_ms']:>10.2f}{summary['p95_ms']:>10.2f}{summary['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
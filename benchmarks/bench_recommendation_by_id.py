@@ -0,0 +1,106 @@
+"""
+Benchmark of GET /recommendation/{id}.
+
+Compares the previous handler (cache entry parsed with json.loads on a hit, ORM object returned on a miss,
+both validated against RecommendationResponse and encoded again by FastAPI) with the current one
+(the cache holds the response body, encoded once with orjson and sent as it is).
+Redis hits clear the local cache before each request, misses clear both cache tiers.
+
+    python benchmarks/bench_recommendation_by_id.py --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi import Depends, HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from harness import bench_app, latency_summary, login
+from models import Recommendation
+import main
+
+
+async def previous_get_recommendation_by_id(
+    id: str,
+    db: AsyncSession = Depends(main.get_db),
+    current_user: main.TokenData = Depends(main.get_current_user)
+):
+    # Handler before the change
+    cache_key = main.get_recommendations_cache_key_by_id(id)
+    cached_recommendation_by_id = await main.redis_client.get(cache_key)
+    if cached_recommendation_by_id:
+        return json.loads(cached_recommendation_by_id)
+
+    recommendation_result = await db.execute(select(Recommendation).filter_by(id=id))
+    recommendation_result = recommendation_result.scalars().first()
+    if not recommendation_result:
+        raise HTTPException(status_code=404, detail="Recommendation not found")
+    recommendation_data = {
+        "id": recommendation_result.id,
+        "patient_id": recommendation_result.patient_id,
+        "recommendation": recommendation_result.recommendation,
+        "timestamp": recommendation_result.timestamp.isoformat()
+    }
+    await main.redis_client.set(cache_key, json.dumps(recommendation_data), ex=86400)
+    return recommendation_result
+
+
+main.app.get("/previous/recommendation/{id}", response_model=main.RecommendationResponse)(previous_get_recommendation_by_id)
+
+
+async def run(client, headers, path, requests, cache):
+    latencies = []
+    for _ in range(requests):
+        if cache != "local":
+            main.local_cache.clear()
+        if cache == "miss":
+            await main.redis_client.delete(main.get_recommendations_cache_key_by_id("1"))
+        start = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies
+
+
+async def bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    async with bench_app() as client:
+        headers = await login(client)
+        async with client.session_factory() as db:
+            await db.execute(text(
+                "INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) "
+                "VALUES (1, 'Bench', 'Mark', 70, 35.0, 1, 0)"
+            ))
+            await db.execute(text(
+                "INSERT INTO recommendations (id, patient_id, recommendation, timestamp) "
+                "VALUES ('1', 1, 'Physical Therapy', '2025-03-16T19:56:28.855702')"
+            ))
+            await db.commit()
+
+        print(f"{args.requests} requests per row")
+        print(f"{'handler':<12}{'cache':<8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+        rows = (
+            ("previous", "/previous/recommendation/1", "redis"),
+            ("previous", "/previous/recommendation/1", "miss"),
+            ("current", "/recommendation/1", "local"),
+            ("current", "/recommendation/1", "redis"),
+            ("current", "/recommendation/1", "miss"),
+        )
+        for name, path, cache in rows:
+            # Warm up (which also fills the cache of the hits), then measure
+            await run(client, headers, path, 20, cache)
+            latencies = await run(client, headers, path, args.requests, cache)
+            summary = latency_summary(latencies)
+            print(
+                f"{name:<12}{cache:<8}{summary['p50_ms']:>10.3f}{summary['p95_ms']:>10.3f}"
+                f"{summary['p99_ms']:>10.3f}{len(latencies) / sum(latencies):>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
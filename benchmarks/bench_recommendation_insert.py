@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the recommendation write path of /evaluate.
+
+Compares the previous approach (one db.flush() per recommendation to read back the id and timestamp
+generated by the database) with the current one (ids and timestamps generated up front, one bulk insert).
+It counts the statements sent to the database per request and the time per request on a SQLite file database.
+
+    python benchmarks/bench_recommendation_insert.py --requests 500 --recommendations 3
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, Patient, Recommendation, OutboxEvent
+from main import build_recommendation_rows, insert_recommendations, get_recommendation_stream
+
+
+RECOMMENDATIONS = ["Post-Op Rehabilitation Plan", "Physical Therapy", "Weight Management Program", "General Health Checkup"]
+
+
+async def flush_per_recommendation(db, patient_id, recommendations_text):
+    # Write path before the change
+    for rec in recommendations_text:
+        recommendation = Recommendation(patient_id=patient_id, recommendation=rec)
+        db.add(recommendation)
+        await db.flush()
+        data = {
+            "patient_id": patient_id,
+            "recommendation_id": recommendation.id,
+            "recommendation": rec,
+            "timestamp": recommendation.timestamp.isoformat()
+        }
+        db.add(OutboxEvent(stream=get_recommendation_stream(patient_id), payload=json.dumps(data)))
+    await db.commit()
+
+
+async def bulk_insert(db, patient_id, recommendations_text):
+    await insert_recommendations(db, build_recommendation_rows(patient_id, recommendations_text))
+    await db.commit()
+
+
+async def run(write, requests, recommendations):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{directory}/bench.db")
+        statements = 0
+
+        def count_statement(*args):
+            nonlocal statements
+            statements += 1
+        event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        async with session_factory() as db:
+            patient = Patient(first_name="Bench", last_name="Mark", age=70, bmi=35.0, chronic_pain=True, recent_surgery=True)
+            db.add(patient)
+            await db.commit()
+            patient_id = patient.id
+
+        recommendations_text = (RECOMMENDATIONS * recommendations)[:recommendations]
+        statements = 0
+        start = time.perf_counter()
+        for _ in range(requests):
+            async with session_factory() as db:
+                await write(db, patient_id, recommendations_text)
+        elapsed = time.perf_counter() - start
+        await engine.dispose()
+        return statements / requests, elapsed / requests * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--recommendations", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests with {args.recommendations} recommendations each")
+    print(f"{'write path':<28}{'statements/request':>20}{'ms/request':>12}")
+    for name, write in (("flush per recommendation", flush_per_recommendation), ("bulk insert", bulk_insert)):
+        statements, latency = await run(write, args.requests, args.recommendations)
+        print(f"{name:<28}{statements:>20.1f}{latency:>12.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+"""
+Benchmark of the recommendation rules.
+
+Compares the previous hard-coded chain of if statements with the compiled rule table for one patient at a time
+and with the NumPy evaluator scoring the whole cohort in one pass, on a random cohort of patients: from the
+PatientData objects (as /evaluate/batch does) and from arrays already loaded column by column (offline scoring).
+Every evaluator is checked to give the same recommendations as the previous function.
+
+    python benchmarks/bench_recommendation_rules.py --patients 100000
+"""
+from pathlib import Path
+import argparse
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pydantic import BaseModel
+from rules import FIELDS, RuleEngine
+import numpy as np
+
+
+class PatientData(BaseModel):
+    # Same fields as main.PatientData, without importing the app
+    first_name: str
+    last_name: str
+    age: int
+    bmi: float
+    chronic_pain: bool
+    recent_surgery: bool
+
+
+def previous_generate_recommendation(patient_data):
+    # Rules before the change
+    recommendations = []
+    if patient_data.recent_surgery:
+        recommendations.append("Post-Op Rehabilitation Plan")
+    if patient_data.age > 65 and patient_data.chronic_pain:
+        recommendations.append("Physical Therapy")
+    if patient_data.bmi > 30:
+        recommendations.append("Weight Management Program")
+    if not recommendations:
+        recommendations.append("General Health Checkup")
+    return recommendations
+
+
+def cohort(size, seed=0):
+    rng = random.Random(seed)
+    return [
+        PatientData(
+            first_name="Bench", last_name=str(i), age=rng.randint(18, 95), bmi=round(rng.uniform(16, 45), 1),
+            chronic_pain=rng.random() < 0.3, recent_surgery=rng.random() < 0.1
+        )
+        for i in range(size)
+    ]
+
+
+def measure(score, patients, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = score(patients)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    patients = cohort(args.patients)
+    engine = RuleEngine()
+    expected = [previous_generate_recommendation(patient) for patient in patients]
+    columns = {field: np.array([getattr(patient, field) for patient in patients], dtype=dtype) for field, dtype in FIELDS.items()}
+
+    rows = (
+        ("previous if chain", lambda patients: [previous_generate_recommendation(patient) for patient in patients]),
+        ("compiled rules", lambda patients: [engine.evaluate(patient) for patient in patients]),
+        ("numpy, objects", engine.evaluate_many),
+        ("numpy, columns", lambda patients: engine.evaluate_columns(columns)),
+    )
+    print(f"{args.patients} patients, best of {args.repeat}")
+    print(f"{'evaluator':<20}{'ms':>10}{'patients/s':>14}")
+    for name, score in rows:
+        result, seconds = measure(score, patients, args.repeat)
+        assert result == expected, f"{name} differs from the previous rules"
+        print(f"{name:<20}{seconds * 1000:>10.1f}{args.patients / seconds:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
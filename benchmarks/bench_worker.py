@@ -0,0 +1,112 @@
+"""
+Throughput of the recommendation worker.
+
+Publishes --events recommendation events for --patients patients to the shard streams of an in-process Redis
+stand-in, then runs the worker's consume loop (consumer group reads, coalescing, handler pool, batched acks)
+until every event is handled. The notification sender is replaced by a fixed delay (--send-ms).
+Reports the events and notifications handled per second and the lag percentiles from publication to handling.
+Results can be compared with / saved as a JSON baseline like bench_load.py.
+
+    python benchmarks/bench_worker.py --events 20000 --patients 2000 --send-ms 1
+    python benchmarks/bench_worker.py --baseline benchmarks/baselines/worker.json
+"""
+from pathlib import Path
+from unittest.mock import patch
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "worker"))
+
+from harness import compare_to_baseline, latency_summary, save_baseline
+import fakeredis
+import worker
+
+
+async def publish(redis_worker, events, patients):
+    # Events are pipelined per shard in chunks, each one stamped with its publication time
+    async with redis_worker.pipeline(transaction=False) as pipe:
+        for i in range(events):
+            patient_id = i % patients
+            pipe.xadd(worker.get_shard_stream(worker.get_patient_shard(patient_id)), {"data": json.dumps({
+                "patient_id": patient_id,
+                "recommendation_id": str(i),
+                "recommendation": "Physical Therapy",
+                "published": time.perf_counter(),
+            })})
+            if len(pipe) >= 1000:
+                await pipe.execute()
+        await pipe.execute()
+
+
+async def run(args):
+    redis_worker = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    streams = {worker.get_shard_stream(shard): ">" for shard in range(worker.RECOMMENDATION_SHARDS)}
+    for stream in streams:
+        await worker.ensure_consumer_group(redis_worker, stream)
+    await publish(redis_worker, args.events, args.patients)
+
+    lags = []
+    notifications = 0
+
+    async def handle(events):
+        nonlocal notifications
+        await asyncio.sleep(args.send_ms / 1000)
+        notifications += 1
+        now = time.perf_counter()
+        lags.extend(now - event["published"] for event in events)
+
+    pool = worker.HandlerPool(redis_worker, concurrency=args.concurrency, coalesce_window_ms=args.coalesce_window_ms)
+    start = time.perf_counter()
+    with patch("worker.handle_processing_worker", handle):
+        while len(lags) < args.events:
+            await worker.consume_once(redis_worker, pool, streams, block_ms=1)
+        await pool.drain()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "config": {
+            "events": args.events, "patients": args.patients, "concurrency": args.concurrency,
+            "send_ms": args.send_ms, "coalesce_window_ms": args.coalesce_window_ms
+        },
+        "events_per_second": args.events / elapsed,
+        "notifications_per_second": notifications / elapsed,
+        "lag": latency_summary(lags),
+    }
+
+
+async def bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=worker.WORKER_CONCURRENCY)
+    parser.add_argument("--send-ms", type=float, default=1.0, help="simulated notification delivery time")
+    parser.add_argument("--coalesce-window-ms", type=int, default=worker.COALESCE_WINDOW_MS)
+    parser.add_argument("--baseline", help="JSON baseline to compare with")
+    parser.add_argument("--save-baseline", help="write the results to this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline (fraction)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    results = await run(args)
+    print(f"{args.events} events of {args.patients} patients, {args.concurrency} concurrent handlers, {args.send_ms} ms per notification")
+    print(f"events/s: {results['events_per_second']:.0f}, notifications/s: {results['notifications_per_second']:.0f}")
+    lag = results["lag"]
+    print(f"lag from publication: p50 {lag['p50_ms']:.1f} ms, p95 {lag['p95_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms")
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+    if args.baseline:
+        # Notifications depend on how the events happen to be coalesced, only the event throughput is compared
+        regressions = compare_to_baseline(args.baseline, {"events_per_second": (results["events_per_second"], True)}, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,123 @@
+"""
+Runs the real FastAPI app in process for the benchmarks: httpx.ASGITransport in front of the app,
+a SQLite database and an in-process Redis stand-in (fakeredis) instead of PostgreSQL and Redis.
+Also reads and writes the JSON baselines the benchmark results are compared with.
+"""
+from contextlib import asynccontextmanager
+from pathlib import Path
+from unittest.mock import patch
+import json
+import os
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-not-for-production")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+import bcrypt
+import fakeredis
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import main
+from models import Base
+
+ADMIN_PASSWORD = "admin123"
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def latency_summary(latencies):
+    # Latencies in seconds, summary in milliseconds
+    return {
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+@asynccontextmanager
+async def bench_app(database_path=None):
+    """
+    Yields an AsyncClient bound to the app with a fresh database and Redis stand-in.
+    The database is in memory behind a single connection, or a SQLite file at `database_path` (WAL mode,
+    one connection per session) when requests run concurrently.
+    The admin password is configured as a bcrypt hash, like in production.
+    """
+    if database_path:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}", connect_args={"timeout": 30}, pool_size=32)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_wal(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+    else:
+        engine = create_async_engine("sqlite+aiosqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, autoflush=False)
+
+    async def get_bench_db():
+        async with session_factory() as session:
+            yield session
+
+    password_hash = bcrypt.hashpw(ADMIN_PASSWORD.encode("utf-8"), bcrypt.gensalt())
+    main.app.dependency_overrides[main.get_db] = get_bench_db
+    main.app.dependency_overrides[main.get_read_db] = get_bench_db
+    with patch("main.redis_client", fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)), \
+         patch.dict(main.fake_users_db, {"password": password_hash}):
+        async with AsyncClient(transport=ASGITransport(app=main.app), base_url="http://bench") as client:
+            client.session_factory = session_factory
+            yield client
+    main.app.dependency_overrides.clear()
+    await engine.dispose()
+
+
+async def login(client):
+    response = await client.post("/token", data={"username": main.fake_users_db["username"], "password": ADMIN_PASSWORD})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def compare_to_baseline(path, metrics, tolerance):
+    """
+    Compare {name: (value, higher_is_better)} with the same names in the baseline file.
+    Returns the regressions, i.e. the metrics more than `tolerance` (a fraction) worse than the baseline.
+    """
+    with open(path) as file:
+        baseline = flatten(json.load(file))
+    regressions = []
+    for name, (value, higher_is_better) in metrics.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if higher_is_better and value < previous * (1 - tolerance) or not higher_is_better and value > previous * (1 + tolerance):
+            regressions.append(f"{name}: {value:.3f} (baseline {previous:.3f})")
+    return regressions
+
+
+def flatten(results, prefix=""):
+    # {"a": {"b": 1}} -> {"a.b": 1}
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
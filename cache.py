@@ -0,0 +1,270 @@
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+import anyio
+from redis.exceptions import WatchError
+
+
+logger = logging.getLogger(__name__)
+
+
+def entry_size(key, value) -> int:
+    # Approximate memory used by an entry, exact for the JSON strings kept by the two-tier cache
+    size = len(key) if isinstance(key, (str, bytes)) else sys.getsizeof(key)
+    size += len(value) if isinstance(value, (str, bytes)) else sys.getsizeof(value)
+    return size
+
+
+class LocalCache:
+    """
+    In-process LRU cache with a per-entry expiry, bounded by a number of entries and optionally by memory.
+    Lookups and inserts are O(1): entries live in an OrderedDict ordered from least to most recently used,
+    expired entries are dropped when they are read and the least recently used ones when the cache is full.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self.delete(key)
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        # The entry never outlives the cache ttl, a shorter ttl can be given per entry
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        size = entry_size(key, value) if self.max_bytes is not None else 0
+        if ttl <= 0 or self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        self.delete(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+async def listen_for_invalidations(redis_client, local_cache: LocalCache, channel: str, retry_seconds: float = 1):
+    """
+    Evict the keys published on `channel` (a JSON list of keys) from the local cache.
+    Messages sent while the subscription was down are lost, so the whole local cache is dropped on every (re)connection.
+    """
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                for key in json.loads(message["data"]):
+                    local_cache.delete(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cache invalidation subscription lost: {e}")
+            await asyncio.sleep(retry_seconds)
+        finally:
+            await pubsub.reset()
+
+
+def jittered_ttl(ttl: int, jitter: float) -> int:
+    # Spread the expiration of keys written together over [ttl * (1 - jitter), ttl]
+    return max(1, int(ttl * (1 - random.uniform(0, jitter))))
+
+
+def should_refresh_early(ttl_remaining: float, delta: float, beta: float = 1.0) -> bool:
+    """
+    Probabilistic early expiration (XFetch): the closer the entry is to its expiration and the longer it takes to load
+    (`delta` seconds), the more likely a read is treated as a miss, so one caller reloads it before it actually expires.
+    """
+    if ttl_remaining <= 0:
+        return ttl_remaining != -1  # -1: the key has no expiration
+    return -delta * beta * math.log(1.0 - random.random()) >= ttl_remaining
+
+
+class _Call:
+    def __init__(self):
+        self.done = anyio.Event()
+        self.finished = False
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent loads of the same key: the first caller runs the loader,
+    the others wait for it and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, loader):
+        while key in self._calls:
+            call = self._calls[key]
+            await call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if call.finished:
+                return call.result
+            # The loading caller was cancelled, the next one in line loads the key
+
+        call = self._calls[key] = _Call()
+        try:
+            call.result = await loader()
+            call.finished = True
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+
+
+class CacheWriteBatch:
+    """
+    Collects the cache writes of a request and sends them to Redis in a single MULTI/EXEC round trip.
+    Deleted (or explicitly invalidated) keys are published on the invalidation channel in the same transaction,
+    and the local cache is updated once the transaction has been executed.
+    """
+
+    def __init__(self, redis_client, local_cache: LocalCache, invalidation_channel: str, ttl_jitter: float = 0.0):
+        self.redis_client = redis_client
+        self.local_cache = local_cache
+        self.invalidation_channel = invalidation_channel
+        self.ttl_jitter = ttl_jitter
+        self._commands = []  # (command, args, kwargs)
+        self._cached = {}
+        self._invalidated = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _queue(self, command, *args, **kwargs) -> int:
+        # Returns the position of the reply of the command in the results of execute()
+        self._commands.append((command, args, kwargs))
+        return len(self._commands) - 1
+
+    def set(self, key, value, ex: int, get: bool = False, jitter: bool = True, invalidate: bool = False) -> int:
+        """
+        Queue a SET, returns the position of its reply in the results of execute() (the previous value when get=True).
+        With invalidate=True the other replicas drop their local copy of the key.
+        """
+        ttl = jittered_ttl(ex, self.ttl_jitter) if jitter else ex
+        self._cached[key] = value
+        if invalidate:
+            self._invalidated.append(key)
+        return self._queue("set", key, value, ex=ttl, get=get)
+
+    def push(self, key, values, max_length: int) -> int:
+        """
+        Queue a push of the values to the head of the list at `key` (the last value ends up first), trimmed to max_length.
+        Only an existing list is updated (LPUSHX): an absent list is built from the database when it's read.
+        Copies of the values already in the list are removed first, a list rebuilt after the values were committed
+        but before this push already holds them.
+        """
+        for value in values:
+            self._queue("lrem", key, 0, value)
+        position = self._queue("lpushx", key, *values)
+        self._queue("ltrim", key, 0, max_length - 1)
+        return position
+
+    def incr(self, key, ex: int) -> int:
+        # Queue an increment of the counter at `key`, kept for `ex` seconds after its last increment
+        position = self._queue("incr", key)
+        self._queue("expire", key, ex)
+        return position
+
+    def delete(self, *keys) -> int:
+        for key in keys:
+            self._cached.pop(key, None)
+        self._invalidated.extend(keys)
+        return self._queue("delete", *keys)
+
+    async def execute(self) -> list:
+        if not self._commands:
+            return []
+        commands, cached, invalidated = self._commands, self._cached, self._invalidated
+        self._commands, self._cached, self._invalidated = [], {}, []
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for command, args, kwargs in commands:
+                getattr(pipe, command)(*args, **kwargs)
+            if invalidated:
+                pipe.publish(self.invalidation_channel, json.dumps(invalidated))
+            results = await pipe.execute()
+
+        for key in invalidated:
+            self.local_cache.delete(key)
+        for key, value in cached.items():
+            self.local_cache.set(key, value)
+        return results
+
+
+async def replace_list_if_unchanged(redis_client, key, values, ex: int, version_key, version, ttl_jitter: float = 0.0) -> bool:
+    """
+    Replace the list at `key` by the values, in order, unless the counter at `version_key` moved away from `version`
+    (read before loading the values): a writer that updated the source in the meantime bumps it, so a list built
+    from older data is never cached. Returns whether the list was replaced.
+    """
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(version_key)
+            if await pipe.get(version_key) != version:
+                return False
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(key, *values)
+            pipe.expire(key, jittered_ttl(ex, ttl_jitter))
+            await pipe.execute()
+            return True
+        except WatchError:
+            return False
@@ -1,22 +1,109 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from models import Base
+from metrics import instrument_engine
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Database URL .env file
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional read replica used by the read-only endpoints, the primary database is used when it's not set
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
 
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set")
 
+# Connection pool of each engine
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+# Connections are replaced after this age, before the server or a proxy drops them
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+
+
+class PoolMetrics:
+    """
+    Checkouts, connections in use and time spent waiting for a connection of one pool.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def checked_out(self):
+        self.checkouts += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def checked_in(self):
+        self.in_use -= 1
+
+    def waited(self, seconds):
+        self.wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def stats(self):
+        return {
+            "checkouts": self.checkouts,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "avg_wait_ms": self.wait_seconds / self.checkouts * 1000 if self.checkouts else 0.0,
+            "max_wait_ms": self.max_wait_seconds * 1000,
+        }
+
+
+# Metrics of each pool, by engine name ("write", "read")
+pool_metrics = {}
+
+
+class MeasuredQueuePool(AsyncAdaptedQueuePool):
+    # Queue pool that records how long each checkout waited for a free connection
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            pool_metrics[self.logging_name].waited(time.perf_counter() - start)
+
+
+def build_engine(database_url, name):
+    """
+    Async engine with an explicitly sized pool whose connections are checked before use (pre-ping) and recycled.
+    SQLite keeps the pool of its driver (a single connection for in-memory databases), without sizing or wait times.
+    """
+    options = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE_SECONDS, "pool_logging_name": name}
+    if make_url(database_url).get_backend_name() != "sqlite":
+        options.update(
+            poolclass=MeasuredQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        )
+    engine = create_async_engine(database_url, **options) # |echo=True to log SQL queries (debugging)
+
+    metrics = pool_metrics[name] = PoolMetrics(name)
+    event.listen(engine.sync_engine, "checkout", lambda *args: metrics.checked_out())
+    event.listen(engine.sync_engine, "checkin", lambda *args: metrics.checked_in())
+    instrument_engine(engine, name)
+    return engine
+
+
 #engine = create_engine(DATABASE_URL) # Sync engine sqlalchemy
-engine = create_async_engine(DATABASE_URL) # Async engine sqlalchemy |echo=True to log SQL queries (debugging)
+engine = build_engine(DATABASE_URL, "write") # Async engine sqlalchemy
+read_engine = build_engine(DATABASE_READ_URL, "read") if DATABASE_READ_URL else engine
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession) # Async session sqlalchemy, add class_=AsyncSession
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine, class_=AsyncSession) if DATABASE_READ_URL else SessionLocal
 
 # Create all tables (if they don't exist)
 #Base.metadata.create_all(bind=engine) # Sync engine sqlalchemy
@@ -26,8 +113,10 @@ async def get_db():
     async with SessionLocal() as session:
         yield session
 
-# Create all tables async
-async def create_all_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+# Dependency to get a session of the read replica, for the endpoints that only read and tolerate replication lag
+async def get_read_db():
+    async with ReadSessionLocal() as session:
+        yield session
 
+def get_pool_stats():
+    return {name: {**metrics.stats(), "status": (engine if name == "write" else read_engine).pool.status()} for name, metrics in pool_metrics.items()}
@@ -0,0 +1,153 @@
+"""
+Offline bulk ingest of patient evaluations from a JSONL file, one PatientData object per line.
+
+The file is streamed line by line and evaluated in batches of INGEST_BATCH_SIZE records through the same set-based path
+as /evaluate/batch (bulk statements for the patients and recommendations, the events written to the outbox in the same
+transaction), then the outbox is relayed to the Redis Streams in batches. Both go through the Redis client of the app
+(main.redis_client). Invalid lines are logged and skipped.
+
+After each committed batch the byte offset reached is saved to the checkpoint file, so an interrupted run resumes
+after the last committed batch. A crash between the commit and the checkpoint replays that batch only.
+
+    python ingest.py patients.jsonl --batch-size 1000
+"""
+from pydantic import ValidationError
+from connection_db import SessionLocal, engine, read_engine
+from main import PatientData, MAX_BATCH_SIZE, RECOMMENDATION_STREAM_MAXLEN, evaluate_batch
+from outbox import relay_outbox_batch
+import argparse
+import asyncio
+import logging
+import main
+import orjson
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", str(MAX_BATCH_SIZE)))
+# Minimum time between two progress logs
+INGEST_PROGRESS_SECONDS = float(os.getenv("INGEST_PROGRESS_SECONDS", "5"))
+
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"offset": 0, "line": 0, "records": 0, "invalid": 0}
+    with open(path, "rb") as checkpoint:
+        return orjson.loads(checkpoint.read())
+
+
+def save_checkpoint(path: str, state: dict):
+    # Written to a temporary file first, so a crash never leaves a partial checkpoint
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as checkpoint:
+        checkpoint.write(orjson.dumps(state))
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(temp_path, path)
+
+
+def read_batches(file, batch_size: int, line: int):
+    """
+    Yield (patients, invalid lines, lines read) for every batch of up to `batch_size` valid records,
+    the file position after a batch is where the next one starts.
+    """
+    patients, invalid, lines = [], 0, 0
+    for raw in iter(file.readline, b""):
+        line += 1
+        lines += 1
+        if raw.strip():
+            try:
+                patients.append(PatientData.model_validate(orjson.loads(raw)))
+            except (orjson.JSONDecodeError, ValidationError) as e:
+                invalid += 1
+                logger.error(f"Skipping invalid record at line {line}: {e}")
+        if len(patients) == batch_size:
+            yield patients, invalid, lines
+            patients, invalid, lines = [], 0, 0
+    if patients or invalid or lines:
+        yield patients, invalid, lines
+
+
+async def relay_outbox(session_factory):
+    # Publish the events of the batch, one Redis pipeline per outbox batch
+    while True:
+        async with session_factory() as db:
+            if not await relay_outbox_batch(db, main.redis_client, RECOMMENDATION_STREAM_MAXLEN):
+                return
+
+
+async def ingest(
+    path: str,
+    session_factory=SessionLocal,
+    batch_size: int = INGEST_BATCH_SIZE,
+    checkpoint_path: str = None,
+) -> dict:
+    """
+    Ingest the file from its checkpoint. Returns the totals of the file: {"offset", "line", "records", "invalid"}.
+    """
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    state = load_checkpoint(checkpoint_path)
+    start, records_at_start = time.perf_counter(), state["records"]
+    last_progress = start
+
+    with open(path, "rb") as file:
+        if state["offset"] > os.fstat(file.fileno()).st_size:
+            raise ValueError(f"The checkpoint {checkpoint_path} is past the end of {path}, remove it to start over")
+        file.seek(state["offset"])
+        if state["offset"]:
+            logger.info(f"Resuming {path} at line {state['line'] + 1}")
+
+        for patients, invalid, lines in read_batches(file, batch_size, state["line"]):
+            if patients:
+                async with session_factory() as db:
+                    await evaluate_batch(db, patients)
+                await relay_outbox(session_factory)
+
+            state = {
+                "offset": file.tell(),
+                "line": state["line"] + lines,
+                "records": state["records"] + len(patients),
+                "invalid": state["invalid"] + invalid,
+            }
+            save_checkpoint(checkpoint_path, state)
+
+            now = time.perf_counter()
+            if now - last_progress >= INGEST_PROGRESS_SECONDS:
+                last_progress = now
+                rate = (state["records"] - records_at_start) / (now - start)
+                logger.info(f"Ingested {state['records']} records ({rate:.0f} records/s)")
+
+    elapsed = time.perf_counter() - start
+    state["records_per_second"] = (state["records"] - records_at_start) / elapsed if elapsed else 0.0
+    return state
+
+
+async def run(path: str, batch_size: int, checkpoint_path: str) -> dict:
+    # Command line run: the connections are closed once the file is ingested or the run fails
+    try:
+        return await ingest(path, batch_size=batch_size, checkpoint_path=checkpoint_path)
+    finally:
+        await main.redis_pool.disconnect()
+        for db_engine in dict.fromkeys((engine, read_engine)):
+            await db_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="JSONL file with one patient per line")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--checkpoint", help="checkpoint file, <path>.checkpoint by default")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and ingest the whole file again")
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or f"{args.path}.checkpoint"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    totals = asyncio.run(run(args.path, args.batch_size, checkpoint_path))
+    print(
+        f"{totals['records']} records ingested, {totals['invalid']} invalid lines skipped, "
+        f"{totals['records_per_second']:.0f} records/s"
+    )
@@ -1,20 +1,43 @@
-from fastapi import FastAPI, Depends, HTTPException, status 
+import time
+# The startup milestones (time to ready and to the first request) are measured from the import of the app
+STARTED_AT = time.perf_counter()
+
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status 
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 #from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from sqlalchemy.future import select
+from sqlalchemy import insert, tuple_, exists, func
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from models import Patient, Recommendation
-from connection_db import get_db, create_all_tables
+from models import Patient, Recommendation, OutboxEvent, uuid7
+from connection_db import get_db, get_read_db, get_pool_stats, engine, read_engine, SessionLocal, ReadSessionLocal
+from outbox import OutboxRelay
+from retention import RetentionJob
+from rules import recommendation_rules
+from metrics import InstrumentedRedis, MetricsMiddleware, record_cache
+from profiling import PROFILING_ENABLED, ProfilingMiddleware
+from warmup import FirstRequestMiddleware, StartupTimes, open_db_connections, open_redis_connections
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from cache import (
+    LocalCache, SingleFlight, CacheWriteBatch, listen_for_invalidations, jittered_ttl, should_refresh_early, replace_list_if_unchanged
+)
+from contextlib import asynccontextmanager
 from typing import List, Optional
 from datetime import date, datetime, timedelta
 import redis.asyncio as redis 
 import json
+import orjson
+import base64
+import hashlib
 import jwt
 import os
 import logging
 import asyncio
+import anyio
+from anyio.lowlevel import RunVar
 import bcrypt
 
 
@@ -23,15 +46,112 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified tokens are cached in process, an entry never outlives the token's exp claim
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", str(ACCESS_TOKEN_EXPIRE_MINUTES * 60)))
+# When enabled, every request also checks the token against the revocation list kept in Redis
+TOKEN_REVOCATION_ENABLED = os.getenv("TOKEN_REVOCATION_ENABLED", "false").lower() == "true"
+
+# Admin credentials. The password is configured as a bcrypt hash, so nothing is hashed when the app starts
+ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
+ADMIN_PASSWORD_HASH = os.getenv("ADMIN_PASSWORD_HASH")
+DEV_ADMIN_PASSWORD = "admin123"
+# Maximum number of bcrypt hashes/checks running at the same time, the other logins wait for a free slot.
+# By default half of the CPUs, so the event loop keeps a core to serve the other requests
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(max(1, (os.cpu_count() or 2) // 2))))
+
+# Maximum number of patients accepted by /evaluate/batch in a single request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+# Patients per multi-row upsert statement of a batch, keeps the bind parameters under the limits of the drivers
+UPSERT_CHUNK_SIZE = int(os.getenv("UPSERT_CHUNK_SIZE", "1000"))
+
+# Keyset pagination of the /patients and /recommendations listings, and rows fetched per round trip when streaming them
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+# Most recent recommendations of a patient kept in Redis, updated by every evaluation. Every evaluation also bumps
+# a version of the list, a read rebuilding it from the database doesn't cache it when the version moved meanwhile
+LATEST_RECOMMENDATIONS_SIZE = int(os.getenv("LATEST_RECOMMENDATIONS_SIZE", "20"))
+LATEST_RECOMMENDATIONS_TTL_SECONDS = int(os.getenv("LATEST_RECOMMENDATIONS_TTL_SECONDS", "3600"))
+
 # Redis information
 REDIS_HOST = os.getenv("REDIS_HOST") 
 REDIS_PORT = os.getenv("REDIS_PORT")
+# Connections shared by all the requests of the process, a request waits up to REDIS_POOL_TIMEOUT_SECONDS for a free one
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT_SECONDS = float(os.getenv("REDIS_POOL_TIMEOUT_SECONDS", "5"))
+
+# Local (L1) cache in front of the recommendation entries in Redis. Keys deleted or overwritten by a replica
+# are published on CACHE_INVALIDATION_CHANNEL so every replica evicts them
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", "10000"))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LOCAL_CACHE_TTL_SECONDS = float(os.getenv("LOCAL_CACHE_TTL_SECONDS", "60"))
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache_invalidation")
+
+# Cache stampede protection. The Redis TTLs are shortened by up to CACHE_TTL_JITTER (a fraction) so keys written together
+# don't expire together, and entries close to their expiration are reloaded early with a probability driven by
+# CACHE_EARLY_REFRESH_BETA and the time it took to load them (CACHE_LOAD_DELTA_SECONDS until it's measured)
+CACHE_TTL_JITTER = float(os.getenv("CACHE_TTL_JITTER", "0.1"))
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", "1.0"))
+CACHE_LOAD_DELTA_SECONDS = float(os.getenv("CACHE_LOAD_DELTA_SECONDS", "0.05"))
+# Coalesce the loads of a key across API replicas with a short Redis lock, the other replicas wait for the cached value
+CACHE_LOCK_ENABLED = os.getenv("CACHE_LOCK_ENABLED", "false").lower() == "true"
+CACHE_LOCK_TTL_MS = int(os.getenv("CACHE_LOCK_TTL_MS", "5000"))
+CACHE_LOCK_POLL_SECONDS = float(os.getenv("CACHE_LOCK_POLL_SECONDS", "0.05"))
+
+# Recommendation events are appended to Redis Streams consumed by the workers (trimmed to roughly MAXLEN entries).
+# Events are partitioned by patient_id over RECOMMENDATION_SHARDS streams, both values must match the worker
+RECOMMENDATION_STREAM = os.getenv("RECOMMENDATION_STREAM", "recommendation_stream")
+RECOMMENDATION_SHARDS = int(os.getenv("RECOMMENDATION_SHARDS", "8"))
+RECOMMENDATION_STREAM_MAXLEN = int(os.getenv("RECOMMENDATION_STREAM_MAXLEN", "100000"))
+
+# Warm-up of the replica before GET /ready succeeds: connections opened in each pool (the database ones beyond
+# DB_POOL_SIZE are closed again once released), retried every WARMUP_RETRY_SECONDS while a backend is unreachable
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", "5"))
+WARMUP_REDIS_CONNECTIONS = int(os.getenv("WARMUP_REDIS_CONNECTIONS", "5"))
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "1"))
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+startup_times = StartupTimes(STARTED_AT)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start the background jobs and the warm-up, the schema is managed by `python migrate.py` before the deployment.
+    The connections are closed on shutdown.
+    """
+    global outbox_relay
+    app.state.ready = False
+    outbox_relay = OutboxRelay(SessionLocal, redis_client, RECOMMENDATION_STREAM_MAXLEN)
+    tasks = [
+        asyncio.create_task(outbox_relay.run()),
+        asyncio.create_task(listen_for_invalidations(redis_client, local_cache, CACHE_INVALIDATION_CHANNEL)),
+        # Archives the expired months of the recommendations
+        asyncio.create_task(RetentionJob(SessionLocal, evict=evict_archived_recommendations).run()),
+        asyncio.create_task(warm_up(app)),
+    ]
+    startup_times.mark("started")
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await redis_pool.disconnect()
+        for db_engine in dict.fromkeys((engine, read_engine)):
+            await db_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+# Inside the metrics middleware, which counts the database and Redis time reported in the profiles
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(FirstRequestMiddleware, startup_times=startup_times)
     
 # Request and Response models for json data
 class PatientData(BaseModel):
@@ -56,6 +176,10 @@ class RecommendationResponse(BaseModel):
     patient_id: int
     recommendation: str
     timestamp: datetime
+
+class EvaluationResponse(BaseModel):
+    message: Optional[str] = None
+    recommendations: List[str]
     
 class Token(BaseModel):
     access_token: str
@@ -67,7 +191,19 @@ class TokenData(BaseModel):
 
 
 # Redis Connection
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+redis_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT_SECONDS,
+    decode_responses=True
+)
+redis_client = InstrumentedRedis(connection_pool=redis_pool)
+
+local_cache = LocalCache(max_entries=LOCAL_CACHE_MAX_ENTRIES, ttl=LOCAL_CACHE_TTL_SECONDS, max_bytes=LOCAL_CACHE_MAX_BYTES)
+cache_loads = SingleFlight()
+# Last measured load time of each key, used by the probabilistic early refresh
+cache_load_durations = LocalCache(max_entries=LOCAL_CACHE_MAX_ENTRIES, ttl=86400)
 
 # Security
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -80,15 +216,93 @@ def hash_password(password):
 
 
 fake_users_db = {
-    "username": "admin",
-    "password": hash_password("admin123"),
+    "username": ADMIN_USERNAME,
+    "password": ADMIN_PASSWORD_HASH.encode("utf-8") if ADMIN_PASSWORD_HASH else None,
 }
 
+# Limiter of the bcrypt threads, one per event loop
+password_limiter = RunVar("password_limiter")
+
+
+async def run_password_hashing(func, *args):
+    """
+    Run a bcrypt function in a worker thread so it doesn't block the event loop (bcrypt releases the GIL).
+    At most PASSWORD_HASH_CONCURRENCY run at the same time, the others wait for a free slot.
+    """
+    try:
+        limiter = password_limiter.get()
+    except LookupError:
+        limiter = anyio.CapacityLimiter(PASSWORD_HASH_CONCURRENCY)
+        password_limiter.set(limiter)
+    return await anyio.to_thread.run_sync(func, *args, limiter=limiter)
+
+
+async def get_admin_password_hash():
+    if fake_users_db["password"] is None:
+        # Development fallback, hashed once on the first login instead of at import
+        logger.warning("ADMIN_PASSWORD_HASH is not set, using the development password")
+        fake_users_db["password"] = await run_password_hashing(hash_password, DEV_ADMIN_PASSWORD)
+    return fake_users_db["password"]
+
+
+# Relays the recommendation events committed to the outbox to Redis, started with the app
+outbox_relay: Optional[OutboxRelay] = None
+
+
+# Patient evaluated by the warm-up, its writes are rolled back
+WARMUP_PATIENT = PatientData(first_name="warmup", last_name="warmup", age=70, bmi=35.0, chronic_pain=True, recent_surgery=True)
+
+
+async def warm_up_hot_paths(session_factory=SessionLocal, read_session_factory=ReadSessionLocal):
+    """
+    Run the code of the hot requests once, so the first requests don't pay for the lazy initializations
+    (SQL statement compilation, first use of the libraries). Nothing is written: the evaluation is rolled back.
+    """
+    patient_data = PatientData.model_validate(orjson.loads(orjson.dumps(WARMUP_PATIENT.model_dump())))
+    recommendations_text = generate_recommendation(patient_data)
+    recommendation_rules.evaluate_many([patient_data])
+    fingerprint = get_patient_fingerprint(patient_data)
+    if SECRET_KEY and ALGORITHM:
+        jwt.decode(create_access_token({"sub": ADMIN_USERNAME}), SECRET_KEY, algorithms=[ALGORITHM])
 
-# Create all table on startup
-@app.on_event("startup")
-async def on_startup():
-    await create_all_tables()
+    async with session_factory() as db:
+        patient_id, _ = await upsert_patient(db, patient_data)
+        recommendation_rows = build_recommendation_rows(patient_id, recommendations_text)
+        await insert_recommendations(db, recommendation_rows)
+        orjson.dumps(recommendation_rows)
+        await db.rollback()
+    async with read_session_factory() as db:
+        await db.execute(select(Recommendation).filter_by(id=recommendation_rows[0]["id"]))
+        await db.execute(select(Patient).order_by(Patient.id).limit(1))
+
+    # Same round trip as a cache lookup, without counting it in the cache metrics
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(get_recommendations_cache_key_by_fingerprint(fingerprint))
+        pipe.pttl(get_recommendations_cache_key_by_fingerprint(fingerprint))
+        await pipe.execute()
+
+
+async def warm_up(app: FastAPI):
+    # Open the connections of the pools and run the hot paths, then report the replica as ready
+    while True:
+        try:
+            await asyncio.gather(
+                *(open_db_connections(db_engine, WARMUP_DB_CONNECTIONS) for db_engine in dict.fromkeys((engine, read_engine))),
+                open_redis_connections(redis_pool, WARMUP_REDIS_CONNECTIONS),
+            )
+            await warm_up_hot_paths()
+            break
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {WARMUP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(WARMUP_RETRY_SECONDS)
+    startup_times.mark("ready")
+    app.state.ready = True
+
+
+def notify_outbox_relay():
+    # Wake the relay up so that new events are published without waiting for the next poll
+    if outbox_relay is not None:
+        outbox_relay.notify()
     
     
 def verify_password(plain_password, hashed_password):
@@ -107,12 +321,52 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
         
         
+token_cache = LocalCache(max_entries=TOKEN_CACHE_MAX_ENTRIES, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+# CPU time spent verifying tokens, used to estimate the time saved by the cache
+token_decode_stats = {"decodes": 0, "cpu_seconds": 0.0}
+
+
+def get_revoked_token_key(token: str) -> str:
+    return f"revoked_token:{hashlib.sha256(token.encode('utf-8')).hexdigest()}"
+
+
+async def is_token_revoked(token: str) -> bool:
+    return bool(await redis_client.exists(get_revoked_token_key(token)))
+
+
+async def revoke_token(token: str, expires_at: float):
+    # The revocation is kept until the token would have expired anyway
+    ttl = max(1, int(expires_at - time.time()))
+    await redis_client.set(get_revoked_token_key(token), 1, ex=ttl)
+    token_cache.delete(token)
+
+
+def get_token_cache_stats() -> dict:
+    stats = token_cache.stats()
+    average_decode_ms = token_decode_stats["cpu_seconds"] / token_decode_stats["decodes"] * 1000 if token_decode_stats["decodes"] else 0.0
+    lookups = stats["hits"] + stats["misses"]
+    stats["average_decode_cpu_ms"] = average_decode_ms
+    stats["cpu_ms_saved"] = stats["hits"] * average_decode_ms
+    stats["cpu_ms_saved_per_request"] = stats["cpu_ms_saved"] / lookups if lookups else 0.0
+    return stats
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if TOKEN_REVOCATION_ENABLED and await is_token_revoked(token):
+        raise HTTPException(status_code=401, detail="Token revoked!")
+    
+    # Token already verified, skip the signature check
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+    
+    start = time.process_time()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user = payload.get("sub")
@@ -122,12 +376,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired!")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token!")
+    finally:
+        token_decode_stats["decodes"] += 1
+        token_decode_stats["cpu_seconds"] += time.process_time() - start
     
     if token_data.username != fake_users_db["username"]:
         raise credentials_exception
 
+    token_cache.set(token, user, ttl=payload["exp"] - time.time())
     return user
 
 
@@ -139,29 +397,282 @@ def get_recommendations_cache_key_by_id(recommendation_id: str) -> str:
     return f"recommendation:{recommendation_id}"
 
 
-def generate_recommendation(patient_data: PatientData) -> List[str]:
-    recommendations = []
+def get_latest_recommendations_key(patient_id: int) -> str:
+    return f"patient:{patient_id}:latest_recommendations"
+
+
+def get_latest_recommendations_version_key(patient_id: int) -> str:
+    return f"patient:{patient_id}:latest_recommendations:version"
+
+
+def get_recommendation_stream(patient_id: int) -> str:
+    # All the events of a patient go to the same shard, so a single worker handles them in order
+    return f"{RECOMMENDATION_STREAM}:{patient_id % RECOMMENDATION_SHARDS}"
+
+
+def get_recommendations_cache_key_by_fingerprint(fingerprint: str) -> str:
+    return f"recommendation:fingerprint:{fingerprint}"
+
+
+def get_patient_fingerprint_key(patient_first_name: str, patient_last_name: str) -> str:
+    return f"patient:fingerprint:{patient_first_name}:{patient_last_name}"
+
+
+def get_patient_fingerprint(patient_data: PatientData) -> str:
+    # Hash of everything that identifies the patient and drives the recommendations
+    payload = json.dumps([
+        patient_data.first_name,
+        patient_data.last_name,
+        patient_data.age,
+        patient_data.bmi,
+        patient_data.chronic_pain,
+        patient_data.recent_surgery
+    ])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def cache_read(key: str, family: str, related_keys: List[str] = ()):
+    """
+    Two-tier read: local cache first, then Redis. An entry about to expire in Redis may be reported
+    as a miss (probabilistic early refresh), so that a single caller reloads it ahead of the expiration.
+    The related keys are read from Redis in the same round trip when the key isn't in the local cache.
+    Hits and misses are counted under the key family. Returns (value, related_values).
+    """
+    value = local_cache.get(key)
+    if value is not None:
+        record_cache(family, "local_hit")
+        return value, [None] * len(related_keys)
     
-    if patient_data.recent_surgery:
-        recommendations.append("Post-Op Rehabilitation Plan")
-        
-    if patient_data.age > 65 and patient_data.chronic_pain:
-        recommendations.append("Physical Therapy")
-        
-    if patient_data.bmi > 30:
-        recommendations.append("Weight Management Program")
-        
-    if not recommendations:
-        recommendations.append("General Health Checkup")
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(key)
+        pipe.pttl(key)
+        for related_key in related_keys:
+            pipe.get(related_key)
+        value, ttl_ms, *related_values = await pipe.execute()
+    if value is None:
+        record_cache(family, "miss")
+        return None, related_values
     
-    return recommendations
+    delta = cache_load_durations.get(key, CACHE_LOAD_DELTA_SECONDS)
+    if should_refresh_early(ttl_ms / 1000, delta, CACHE_EARLY_REFRESH_BETA):
+        logger.info(f"Refreshing cache key {key} before its expiration")
+        record_cache(family, "miss")
+        return None, related_values
+    record_cache(family, "redis_hit")
+    if ttl_ms > 0:
+        local_cache.set(key, value, ttl=ttl_ms / 1000)
+    return value, related_values
+
+
+async def cache_get(key: str, family: str) -> Optional[str]:
+    value, _ = await cache_read(key, family)
+    return value
+
+
+async def evict_archived_recommendations(ids: List[str], patient_ids):
+    # Archived recommendations are no longer served by id, and the latest recommendations of their patients are rebuilt
+    await cache_delete(
+        *(get_recommendations_cache_key_by_id(id) for id in ids),
+        *(get_latest_recommendations_key(patient_id) for patient_id in patient_ids)
+    )
+
+
+def cache_batch() -> CacheWriteBatch:
+    # Cache writes of a request, sent to Redis in a single round trip
+    return CacheWriteBatch(redis_client, local_cache, CACHE_INVALIDATION_CHANNEL, CACHE_TTL_JITTER)
+
+
+async def cache_set(key: str, value: str, ex: int = 86400):
+    await redis_client.set(key, value, ex=jittered_ttl(ex, CACHE_TTL_JITTER))
+    local_cache.set(key, value)
+
+
+async def release_cache_lock(lock_key: str, token: str):
+    # Only delete the lock if it's still ours, it may have expired and been taken by another replica
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(lock_key)
+            if await pipe.get(lock_key) == token:
+                pipe.multi()
+                pipe.delete(lock_key)
+                await pipe.execute()
+        except redis.WatchError:
+            pass
+
+
+async def load_with_lock(key: str, loader, from_cache):
+    """
+    Run the loader while holding a short Redis lock on the key. If another replica holds it, wait for the value
+    it caches instead (converted with from_cache), and load it here only if it doesn't show up before the lock expires.
+    """
+    lock_key = f"lock:{key}"
+    token = uuid7()
+    if await redis_client.set(lock_key, token, nx=True, px=CACHE_LOCK_TTL_MS):
+        try:
+            return await loader()
+        finally:
+            await release_cache_lock(lock_key, token)
+    
+    deadline = time.monotonic() + CACHE_LOCK_TTL_MS / 1000
+    while time.monotonic() < deadline:
+        await anyio.sleep(CACHE_LOCK_POLL_SECONDS)
+        value = await redis_client.get(key)
+        if value is not None:
+            local_cache.set(key, value)
+            return from_cache(value) if from_cache else value
+    return await loader()
+
+
+async def load_once(key: str, loader, from_cache=None):
+    """
+    Load a missing (or early refreshed) cache entry once: concurrent callers in this process share a single load,
+    and with CACHE_LOCK_ENABLED the other replicas wait for it too. The loader caches the value under `key`
+    and returns the result shared by the callers, from_cache builds that result from the cached value (the value itself by default).
+    """
+    async def timed_loader():
+        started = time.perf_counter()
+        result = await (load_with_lock(key, loader, from_cache) if CACHE_LOCK_ENABLED else loader())
+        cache_load_durations.set(key, time.perf_counter() - started)
+        return result
+    
+    return await cache_loads.do(key, timed_loader)
+
+
+async def cache_delete(*keys: str):
+    # Delete the keys from Redis and from the local cache of every replica
+    batch = cache_batch()
+    batch.delete(*keys)
+    await batch.execute()
+
+
+async def cache_fingerprint(
+    batch: CacheWriteBatch, patient_data: PatientData, fingerprint: str, previous_fingerprint: Optional[str], recommendations_json: str
+):
+    """
+    Map the fingerprint to the recommendations so that the same patient with the same conditions is served without the database.
+    The patient keeps a pointer to its current fingerprint, so the previous one is dropped when the data changes.
+    The writes are sent with the other writes queued in `batch`, in a single round trip.
+    """
+    pointer_key = get_patient_fingerprint_key(patient_data.first_name, patient_data.last_name)
+    # The pointer isn't jittered so it never expires before the fingerprint entry it points to
+    pointer = batch.set(pointer_key, fingerprint, ex=86400, get=True, jitter=False)
+    if previous_fingerprint and previous_fingerprint != fingerprint:
+        batch.delete(get_recommendations_cache_key_by_fingerprint(previous_fingerprint))
+    batch.set(get_recommendations_cache_key_by_fingerprint(fingerprint), recommendations_json, ex=86400)
+    replaced_fingerprint = (await batch.execute())[pointer]
+    
+    # The pointer was read before the database work, another request may have moved it in the meantime
+    if replaced_fingerprint and replaced_fingerprint not in (previous_fingerprint, fingerprint):
+        await cache_delete(get_recommendations_cache_key_by_fingerprint(replaced_fingerprint))
+
+
+def upsert_patients_statement(dialect: str, patients: List[dict]):
+    """
+    INSERT ... ON CONFLICT (first_name, last_name) DO UPDATE of the patients (dicts of the Patient columns).
+    The update only fires when the data is different, so RETURNING only yields the inserted and changed patients.
+    """
+    dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    stmt = dialect_insert(Patient).values(patients)
+    return stmt.on_conflict_do_update(
+        index_elements=[Patient.first_name, Patient.last_name],
+        set_={column: stmt.excluded[column] for column in ("age", "bmi", "chronic_pain", "recent_surgery")},
+        where=(
+            (Patient.age != stmt.excluded.age)
+            | (Patient.bmi != stmt.excluded.bmi)
+            | (Patient.chronic_pain != stmt.excluded.chronic_pain)
+            | (Patient.recent_surgery != stmt.excluded.recent_surgery)
+        )
+    )
+
+
+async def upsert_patient(db: AsyncSession, patient_data: PatientData):
+    """
+    Insert the patient or update its data with a single INSERT ... ON CONFLICT ... DO UPDATE statement.
+    The update only fires when the data is different. Returns (patient_id, changed), where changed
+    is True when the patient was inserted or its data was updated.
+    """
+    dialect = db.get_bind().dialect.name
+    stmt = upsert_patients_statement(dialect, [patient_data.model_dump()]).returning(Patient.id)
+    patient_filter = (Patient.first_name == patient_data.first_name) & (Patient.last_name == patient_data.last_name)
+
+    if dialect == "postgresql":
+        # Both CTEs share the statement snapshot, so "old" sees the patient as it was before the upsert
+        upserted = stmt.cte("upserted")
+        old = select(Patient.id).where(patient_filter).cte("old")
+        result = await db.execute(select(
+            func.coalesce(select(upserted.c.id).scalar_subquery(), select(old.c.id).scalar_subquery()).label("id"),
+            exists(select(upserted.c.id)).label("changed")
+        ))
+        row = result.one()
+        patient_id, changed = row.id, row.changed
+    else:
+        patient_id = (await db.execute(stmt)).scalar()
+        changed = patient_id is not None
+
+    if patient_id is None:
+        # Nothing was written because the data is unchanged (or the same row was inserted concurrently)
+        patient_id = (await db.execute(select(Patient.id).where(patient_filter))).scalar_one()
+
+    return patient_id, changed
+
+
+def build_recommendation_rows(patient_id: int, recommendations_text: List[str], timestamp: Optional[datetime] = None) -> List[dict]:
+    # Ids and timestamps are generated here instead of by the database, so the rows can be inserted without reading them back.
+    # The rows of an evaluation share the timestamp and their ids increase from the last recommendation to the first,
+    # so the newest first listings (timestamp DESC, id DESC) return them in priority order
+    timestamp = timestamp or datetime.utcnow()
+    ids = [uuid7() for _ in recommendations_text][::-1]
+    return [
+        {"id": recommendation_id, "patient_id": patient_id, "recommendation": rec, "timestamp": timestamp}
+        for recommendation_id, rec in zip(ids, recommendations_text)
+    ]
+
+
+async def insert_recommendations(db: AsyncSession, recommendation_rows: List[dict]):
+    """
+    Insert the recommendations and their events with one bulk statement each.
+    The events are committed with the recommendations and published by the outbox relay.
+    """
+    if not recommendation_rows:
+        return
+    await db.execute(insert(Recommendation), recommendation_rows)
+    await db.execute(insert(OutboxEvent), [
+        {
+            "stream": get_recommendation_stream(row["patient_id"]),
+            "payload": json.dumps({
+                "patient_id": row["patient_id"],
+                "recommendation_id": row["id"],
+                "recommendation": row["recommendation"],
+                "timestamp": row["timestamp"].isoformat()
+            })
+        }
+        for row in recommendation_rows
+    ])
+
+
+def push_latest_recommendations(batch: CacheWriteBatch, recommendation_rows: List[dict]):
+    # Add the new recommendations to the cached latest recommendations of their patients, newest first.
+    # They're encoded like recommendation_row(), so the copies held by a list rebuilt from the database are replaced
+    values_by_patient = {}
+    for row in sorted(recommendation_rows, key=lambda row: (row["timestamp"], row["id"])):
+        values_by_patient.setdefault(row["patient_id"], []).append(orjson.dumps(row))
+    for patient_id, values in values_by_patient.items():
+        batch.push(get_latest_recommendations_key(patient_id), values, LATEST_RECOMMENDATIONS_SIZE)
+        batch.incr(get_latest_recommendations_version_key(patient_id), ex=LATEST_RECOMMENDATIONS_TTL_SECONDS)
+
+
+def generate_recommendation(patient_data: PatientData) -> List[str]:
+    # The rules and their priority order are declared in rules.RULES
+    return recommendation_rules.evaluate(patient_data)
 
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     #logger.info(f"User: {form_data.username} is trying to login with password {form_data.password}") # debug
     
-    if form_data.username != fake_users_db["username"] or not verify_password(form_data.password, fake_users_db["password"]):
+    if form_data.username != fake_users_db["username"] or not await run_password_hashing(
+        verify_password, form_data.password, await get_admin_password_hash()
+    ):
         raise HTTPException(
             status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Bearer"}
         )
@@ -177,7 +688,79 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return jwt_token
 
 
-@app.post("/evaluate")
+@app.post("/token/revoke", status_code=204)
+async def revoke_access_token(token: str = Depends(oauth2_scheme), current_user: TokenData = Depends(get_current_user)):
+    # Revoke the token used to call this endpoint (logout)
+    if not TOKEN_REVOCATION_ENABLED:
+        raise HTTPException(status_code=400, detail="Token revocation is disabled")
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
+    await revoke_token(token, payload["exp"])
+
+
+def json_response(body) -> Response:
+    # The body is already serialized: no response model validation nor JSON encoding by FastAPI
+    return Response(content=body, media_type="application/json")
+
+
+CACHED_EVALUATION_PREFIX = b'{"message":"Patient recommendations retreived from cache","recommendations":'
+
+def cached_evaluation(recommendations_json) -> bytes:
+    # The cached recommendations are already JSON, they're embedded in the response body as they are
+    if isinstance(recommendations_json, str):
+        recommendations_json = recommendations_json.encode("utf-8")
+    return CACHED_EVALUATION_PREFIX + recommendations_json + b"}"
+
+
+async def evaluate_uncached(db: AsyncSession, patient_data: PatientData, fingerprint: str, previous_fingerprint: Optional[str]) -> bytes:
+    # Returns the response body
+    # Insert the patient, or update it if some of the data has changed, i.e, same first_name and last_name
+    patient_id, changed = await upsert_patient(db, patient_data)
+    cache_key = get_recommendations_cache_key(patient_id, patient_data.first_name, patient_data.last_name)
+    batch = cache_batch()
+    
+    # When the patient data has changed the old cache data is replaced below, together with the other cache writes
+    if not changed:
+        cached_recommentations = await cache_get(cache_key, "patient")
+        
+        if cached_recommentations:
+            logger.info("Returning cached recommendations")
+            await cache_fingerprint(batch, patient_data, fingerprint, previous_fingerprint, cached_recommentations)
+            return cached_evaluation(cached_recommentations)
+    
+    recommendations_text = generate_recommendation(patient_data)
+    
+    # today = date.today()
+    # existing_recommendations = await db.execute(select(Recommendation).filter(
+    #     Recommendation.patient_id == patient.id,
+    #     Recommendation.timestamp >= datetime(today.year, today.month, today.day),
+    #     Recommendation.timestamp < datetime(today.year, today.month, today.day + 1)
+    # ))
+    
+    # existing_recommendations = existing_recommendations.scalars().all()
+    
+    # if existing_recommendations:
+    #     # Return patient recommendations if they already exist for that day
+    #     return {
+    #         "message" : "Patient already have recommendations for today",
+    #         "recommendations": [rec.recommendation for rec in existing_recommendations]
+    #     }
+    
+    # Add recommendations to database if they don't exist, with their events for the outbox relay in the same transaction
+    recommendation_rows = build_recommendation_rows(patient_id, recommendations_text)
+    await insert_recommendations(db, recommendation_rows)
+        
+    await db.commit()
+    notify_outbox_relay()
+    # The other replicas drop their local copy of the old cache data
+    recommendations_json = orjson.dumps(recommendations_text)
+    batch.set(cache_key, recommendations_json, ex=86400, invalidate=changed) # 86400 sec = 24 hours expiration
+    push_latest_recommendations(batch, recommendation_rows)
+    await cache_fingerprint(batch, patient_data, fingerprint, previous_fingerprint, recommendations_json)
+    
+    return orjson.dumps({"recommendations": recommendations_text})
+
+
+@app.post("/evaluate", response_model=EvaluationResponse, response_model_exclude_none=True)
 async def evaluate_pacient(
     patient_data: PatientData,
     #db: Session = Depends(get_db)
@@ -185,93 +768,169 @@ async def evaluate_pacient(
     current_user: TokenData = Depends(get_current_user)
 ):  
     try:
-        # Check if patient already exists, i.e, same first_name and last_name
-        result = await db.execute(select(Patient).filter_by(
-            first_name=patient_data.first_name,
-            last_name=patient_data.last_name
-        ))
-        patient = result.scalars().first()
-        
-        if not patient:
-            # Add patient to database
-            patient = Patient(
-                first_name=patient_data.first_name,
-                last_name=patient_data.last_name,
-                age=patient_data.age,
-                bmi=patient_data.bmi,
-                chronic_pain=patient_data.chronic_pain,
-                recent_surgery=patient_data.recent_surgery
-            )
-            db.add(patient)
-            await db.commit()
-            await db.refresh(patient)
-            
-        # If patient exists and some of the data has changed, update the patient data
-        elif patient.age != patient_data.age or patient.bmi != patient_data.bmi or patient.chronic_pain != patient_data.chronic_pain or patient.recent_surgery != patient_data.recent_surgery:
-            patient.age = patient_data.age
-            patient.bmi = patient_data.bmi
-            patient.chronic_pain = patient_data.chronic_pain
-            patient.recent_surgery = patient_data.recent_surgery
-            await db.commit()
-            await db.refresh(patient)
-            
-            # The patient data has changed, delete the old cache data
-            cache_key = get_recommendations_cache_key(patient.id, patient.first_name, patient.last_name)
-            await redis_client.delete(cache_key) # If for some reason the cache_key doen't exist, this will not raise an error
-        
-        # Generate cache key
-        cache_key = get_recommendations_cache_key(patient.id, patient.first_name, patient.last_name)
-        cached_recommentations = await redis_client.get(cache_key)
+        # Same patient with the same conditions: serve the cached recommendations without touching the database
+        fingerprint = get_patient_fingerprint(patient_data)
+        fingerprint_key = get_recommendations_cache_key_by_fingerprint(fingerprint)
+        pointer_key = get_patient_fingerprint_key(patient_data.first_name, patient_data.last_name)
+        cached_recommentations, (previous_fingerprint,) = await cache_read(fingerprint_key, "fingerprint", [pointer_key])
         
         if cached_recommentations:
             logger.info("Returning cached recommendations")
-            return {
-                "message": "Patient recommendations retreived from cache",
-                "recommendations": json.loads(cached_recommentations)
-            }
-        
-        recommendations_text = generate_recommendation(patient_data)
-        
-        # today = date.today()
-        # existing_recommendations = await db.execute(select(Recommendation).filter(
-        #     Recommendation.patient_id == patient.id,
-        #     Recommendation.timestamp >= datetime(today.year, today.month, today.day),
-        #     Recommendation.timestamp < datetime(today.year, today.month, today.day + 1)
-        # ))
-        
-        # existing_recommendations = existing_recommendations.scalars().all()
+            return json_response(cached_evaluation(cached_recommentations))
         
-        # if existing_recommendations:
-        #     # Return patient recommendations if they already exist for that day
-        #     return {
-        #         "message" : "Patient already have recommendations for today",
-        #         "recommendations": [rec.recommendation for rec in existing_recommendations]
-        #     }
-        
-        # Add recommendation to database if it doesn't exist
-        for rec in recommendations_text:
-            recommendation = Recommendation(
-                patient_id=patient.id,
-                recommendation=rec
+        # Concurrent evaluations of the same patient with the same conditions share a single database round
+        return json_response(await load_once(
+            fingerprint_key,
+            lambda: evaluate_uncached(db, patient_data, fingerprint, previous_fingerprint),
+            from_cache=cached_evaluation
+        ))
+    
+    except Exception as e:
+        logger.error(f"Error evaluating the patient: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    
+
+async def evaluate_batch(db: AsyncSession, patients_data: List[PatientData]) -> List[dict]:
+    """
+    Evaluate a list of patients with set-based statements: one multi-row INSERT ... ON CONFLICT DO UPDATE of the
+    patients (its RETURNING tells which ones are new or changed), one SELECT of the ids of the unchanged ones,
+    one bulk INSERT for the recommendations and their outbox events and pipelined Redis round trips. Results are
+    returned in input order. If the same patient appears more than once, each entry is evaluated against the state
+    left by the previous one: the n-th entries of the patients are upserted by the n-th statement.
+    """
+    if not patients_data:
+        return []
+
+    dialect = db.get_bind().dialect.name
+    rounds = []
+    occurrences = {}
+    plan = []
+    for patient_data in patients_data:
+        name = (patient_data.first_name, patient_data.last_name)
+        occurrence = occurrences.get(name, 0)
+        occurrences[name] = occurrence + 1
+        if occurrence == len(rounds):
+            rounds.append({})
+        rounds[occurrence][name] = patient_data.model_dump()
+        plan.append((patient_data, name, occurrence))
+
+    # A patient created or changed concurrently is handled by the ON CONFLICT clause, never by a unique violation
+    patient_ids = {}
+    changed = [set() for _ in rounds]
+    for occurrence, patients in enumerate(rounds):
+        rows = list(patients.values())
+        for offset in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            upserted = await db.execute(
+                upsert_patients_statement(dialect, rows[offset:offset + UPSERT_CHUNK_SIZE])
+                .returning(Patient.id, Patient.first_name, Patient.last_name)
             )
-            db.add(recommendation)
-            await db.flush()
-            
-            data = {
-                "patient_id": patient.id,
-                "recommendation_id": recommendation.id,
-                "recommendation": rec,
-                "timestamp": recommendation.timestamp.isoformat()
-            }
-            await redis_client.publish("recommendation_channel", json.dumps(data))
+            for row in upserted:
+                patient_ids[(row.first_name, row.last_name)] = row.id
+                changed[occurrence].add((row.first_name, row.last_name))
+    unchanged = {name for _, name, _ in plan} - patient_ids.keys()
+    if unchanged:
+        result = await db.execute(
+            select(Patient.id, Patient.first_name, Patient.last_name)
+            .where(tuple_(Patient.first_name, Patient.last_name).in_(unchanged))
+        )
+        for row in result:
+            patient_ids[(row.first_name, row.last_name)] = row.id
+    plan = [
+        (patient_data, name, "generate" if name in changed[occurrence] else "cache")
+        for patient_data, name, occurrence in plan
+    ]
+
+    # Patients unchanged by their first entry already have cached recommendations: read them from the local cache,
+    # then the rest in one round trip
+    cached = {}
+    cache_keys = {
+        name: get_recommendations_cache_key(patient_ids[name], name[0], name[1])
+        for name in dict.fromkeys(name for _, name, action in plan if action == "cache" and name not in changed[0])
+    }
+    missing = []
+    for name, cache_key in cache_keys.items():
+        value = local_cache.get(cache_key)
+        if value is None:
+            missing.append(name)
+        else:
+            record_cache("patient", "local_hit")
+            cached[name] = orjson.loads(value)
+    if missing:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for name in missing:
+                pipe.get(cache_keys[name])
+            cached_values = await pipe.execute()
+        for name, value in zip(missing, cached_values):
+            record_cache("patient", "redis_hit" if value else "miss")
+            if value:
+                local_cache.set(cache_keys[name], value)
+                cached[name] = orjson.loads(value)
+
+    results = []
+    generated = {}
+    generated_data = {}
+    recommendation_rows = []
+    timestamp = datetime.utcnow()
+    # Score every patient of the batch at once, the cached ones are only used on a cache miss
+    scored = recommendation_rules.evaluate_many([patient_data for patient_data, _, _ in plan])
+    for (patient_data, name, action), recommendations_text in zip(plan, scored):
+        if action == "cache":
+            recommendations = generated.get(name, cached.get(name))
+            if recommendations:
+                results.append({
+                    "message": "Patient recommendations retreived from cache",
+                    "recommendations": recommendations
+                })
+                continue
+
+        generated[name] = recommendations_text
+        generated_data[name] = patient_data
+        recommendation_rows.extend(build_recommendation_rows(patient_ids[name], recommendations_text, timestamp))
+        results.append({"recommendations": recommendations_text})
+
+    await insert_recommendations(db, recommendation_rows)
+    await db.commit()
+    notify_outbox_relay()
+
+    if generated:
+        batch = cache_batch()
+        fingerprints = {}
+        pointers = {}
+        for name, recommendations_text in generated.items():
+            cache_key = get_recommendations_cache_key(patient_ids[name], name[0], name[1])
+            recommendations_json = orjson.dumps(recommendations_text)
+            # New and changed patients aren't told apart, the other replicas drop any local copy
+            batch.set(cache_key, recommendations_json, ex=86400, invalidate=True) # 86400 sec = 24 hours expiration
             
-        await db.commit()
-        await redis_client.set(cache_key, json.dumps(recommendations_text), ex=86400) # 86400 sec = 24 hours expiration
-        
-        return {"recommendations": recommendations_text}
+            # Keep the fingerprint fast path of /evaluate in sync with the new patient data
+            fingerprints[name] = get_patient_fingerprint(generated_data[name])
+            pointers[name] = batch.set(get_patient_fingerprint_key(name[0], name[1]), fingerprints[name], ex=86400, get=True, jitter=False)
+            batch.set(get_recommendations_cache_key_by_fingerprint(fingerprints[name]), recommendations_json, ex=86400)
+        push_latest_recommendations(batch, recommendation_rows)
+        replies = await batch.execute()
+
+        # The pointers held the fingerprints of the previous patient data, their entries are stale
+        stale = {replies[pointers[name]] for name in generated} - {None, *fingerprints.values()}
+        if stale:
+            await cache_delete(*(get_recommendations_cache_key_by_fingerprint(fingerprint) for fingerprint in stale))
+
+    return results
+
+
+@app.post("/evaluate/batch", response_model=List[EvaluationResponse], response_model_exclude_none=True)
+async def evaluate_pacients_batch(
+    patients_data: List[PatientData],
+    db: AsyncSession = Depends(get_db),
+    current_user: TokenData = Depends(get_current_user)
+):
+    if len(patients_data) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch size exceeds the limit of {MAX_BATCH_SIZE} patients")
+    
+    try:
+        return await evaluate_batch(db, patients_data)
     
     except Exception as e:
-        logger.error(f"Error evaluating the patient: {e}")
+        logger.error(f"Error evaluating the patients batch: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
     
 
@@ -279,45 +938,264 @@ async def evaluate_pacient(
 async def get_recommendation_by_id(
     id: str, 
     #db: Session = Depends(get_db)
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     current_user: TokenData = Depends(get_current_user)
 ):
     cache_key = get_recommendations_cache_key_by_id(id)
-    cached_recommendation_by_id = await redis_client.get(cache_key)
+    cached_recommendation_by_id = await cache_get(cache_key, "id")
     if cached_recommendation_by_id:
         logger.info("Returning cached recommendation by id")
-        return json.loads(cached_recommendation_by_id)
-    
-    #recommendation_result = db.query(Recommendation).filter(Recommendation.id == id).first()
-    recommendation_result = await db.execute(select(Recommendation).filter_by(id=id))
-    recommendation_result = recommendation_result.scalars().first()
-    if not recommendation_result:
-        raise HTTPException(status_code=404, detail="Recommendation not found")
-    
-    recommendation_data = {
-        "id": recommendation_result.id,
-        "patient_id": recommendation_result.patient_id,
-        "recommendation": recommendation_result.recommendation,
-        "timestamp": recommendation_result.timestamp.isoformat()
+        return json_response(cached_recommendation_by_id)
+    
+    async def load_recommendation():
+        #recommendation_result = db.query(Recommendation).filter(Recommendation.id == id).first()
+        recommendation_result = await db.execute(select(Recommendation).filter_by(id=id))
+        recommendation_result = recommendation_result.scalars().first()
+        if not recommendation_result:
+            raise HTTPException(status_code=404, detail="Recommendation not found")
+        
+        recommendation_data = {
+            "id": recommendation_result.id,
+            "patient_id": recommendation_result.patient_id,
+            "recommendation": recommendation_result.recommendation,
+            "timestamp": recommendation_result.timestamp.isoformat()
+        }
+        
+        # The cache holds the response body, served as it is on the next requests
+        body = orjson.dumps(recommendation_data)
+        await cache_set(cache_key, body, ex=86400) # 86400 sec = 24 hours expiration
+        
+        return body
+    
+    # Concurrent misses of the same recommendation share a single database query
+    return json_response(await load_once(cache_key, load_recommendation))
+
+
+def encode_cursor(*values) -> str:
+    # Opaque cursor with the sort key of the last row of a page
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode("ascii")
+
+
+def decode_cursor(cursor: str, types: tuple) -> list:
+    # Values of the cursor, which must have the given types (a crafted cursor must not reach the queries)
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or not all(isinstance(value, type_) and not isinstance(value, bool) for value, type_ in zip(values, types))
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def decode_recommendation_cursor(cursor: str):
+    # (timestamp, id) of the last recommendation of the previous page
+    timestamp, id = decode_cursor(cursor, (str, str))
+    try:
+        return datetime.fromisoformat(timestamp), id
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def patient_row(patient: Patient) -> dict:
+    return {
+        "id": patient.id,
+        "first_name": patient.first_name,
+        "last_name": patient.last_name,
+        "age": patient.age,
+        "bmi": patient.bmi,
+        "chronic_pain": patient.chronic_pain,
+        "recent_surgery": patient.recent_surgery
     }
+
+
+def recommendation_row(recommendation: Recommendation) -> dict:
+    return {
+        "id": recommendation.id,
+        "patient_id": recommendation.patient_id,
+        "recommendation": recommendation.recommendation,
+        "timestamp": recommendation.timestamp
+    }
+
+
+def stream_ndjson(db: AsyncSession, query, to_row) -> StreamingResponse:
+    """
+    Stream the rows of the query as NDJSON. The rows are read through a server-side cursor,
+    STREAM_CHUNK_SIZE at a time, so memory use doesn't depend on the size of the table.
+    """
+    async def lines():
+        result = await db.stream_scalars(query.execution_options(yield_per=STREAM_CHUNK_SIZE))
+        async for rows in result.partitions():
+            yield b"".join(orjson.dumps(to_row(row)) + b"\n" for row in rows)
     
-    await redis_client.set(cache_key, json.dumps(recommendation_data), ex=86400) # 86400 sec = 24 hours expiration
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def page_response(rows, limit: int, to_row, cursor_of) -> Response:
+    # A full page may be followed by more rows, the cursor of the next page is sent in the X-Next-Cursor header
+    response = json_response(orjson.dumps([to_row(row) for row in rows]))
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(*cursor_of(rows[-1]))
+    return response
+
+
+async def get_latest_recommendations(db: AsyncSession, patient_id: int, limit: int) -> Optional[list]:
+    """
+    The latest `limit` recommendations of the patient (JSON encoded) from the cached view.
+    On a miss the view is built from the database, None if the patient has no recommendations. It's only cached
+    if no evaluation of the patient pushed recommendations since the version of the view was read.
+    """
+    key = get_latest_recommendations_key(patient_id)
+    version_key = get_latest_recommendations_version_key(patient_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.lrange(key, 0, limit - 1)
+        pipe.get(version_key)
+        cached, version = await pipe.execute()
+    record_cache("latest", "redis_hit" if cached else "miss")
+    if cached:
+        return cached
     
-    return recommendation_result
+    latest = await db.execute(
+        select(Recommendation)
+        .where(Recommendation.patient_id == patient_id)
+        .order_by(Recommendation.timestamp.desc(), Recommendation.id.desc())
+        .limit(LATEST_RECOMMENDATIONS_SIZE)
+    )
+    values = [orjson.dumps(recommendation_row(recommendation)).decode("utf-8") for recommendation in latest.scalars()]
+    if not values:
+        return None
+    if not await replace_list_if_unchanged(
+        redis_client, key, values, LATEST_RECOMMENDATIONS_TTL_SECONDS, version_key, version, CACHE_TTL_JITTER
+    ):
+        logger.info(f"Recommendations of patient {patient_id} evaluated meanwhile, not caching their latest view")
+    return values[:limit]
+
+
+@app.get("/patients/{id}/recommendations", response_model=List[RecommendationResponse])
+async def get_patient_recommendations(
+    id: int,
+    limit: int = Query(LATEST_RECOMMENDATIONS_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: TokenData = Depends(get_current_user)
+):
+    """
+    Recommendations of the patient, newest first: the latest `limit` ones, optionally with timestamp in [since, until),
+    and the older ones page by page with the X-Next-Cursor header. Served by a range scan of the (patient_id, timestamp) index,
+    the latest ones come from a cached view kept up to date by /evaluate.
+    """
+    if since is None and until is None and cursor is None and limit <= LATEST_RECOMMENDATIONS_SIZE:
+        latest = await get_latest_recommendations(db, id, limit)
+        if latest:
+            response = json_response("[" + ",".join(latest) + "]")
+            if len(latest) == limit:
+                last = orjson.loads(latest[-1])
+                response.headers["X-Next-Cursor"] = encode_cursor(last["timestamp"], last["id"])
+            return response
+        recommendations = []
+    
+    else:
+        query = (
+            select(Recommendation)
+            .where(Recommendation.patient_id == id)
+            .order_by(Recommendation.timestamp.desc(), Recommendation.id.desc())
+        )
+        if since is not None:
+            query = query.where(Recommendation.timestamp >= since)
+        if until is not None:
+            query = query.where(Recommendation.timestamp < until)
+        if cursor:
+            before_timestamp, before_id = decode_recommendation_cursor(cursor)
+            query = query.where(tuple_(Recommendation.timestamp, Recommendation.id) < (before_timestamp, before_id))
+        recommendations = (await db.execute(query.limit(limit))).scalars().all()
+    
+    if not recommendations and not cursor:
+        patient = await db.execute(select(exists().where(Patient.id == id)))
+        if not patient.scalar():
+            raise HTTPException(status_code=404, detail="Patient not found")
+    
+    return page_response(
+        recommendations, limit, recommendation_row,
+        lambda recommendation: (recommendation.timestamp.isoformat(), recommendation.id)
+    )
+
+
+@app.get("/ready")
+async def readiness():
+    # Readiness probe: 503 until the warm-up is done, then the startup milestones in seconds
+    if not getattr(app.state, "ready", False):
+        return Response(content=orjson.dumps({"ready": False}), status_code=503, media_type="application/json")
+    return json_response(orjson.dumps({"ready": True, "startup_seconds": startup_times.milestones}))
 
 
 #---------------------------------------------
 # Debug endpoints
+@app.get("/debug/token-cache")
+async def get_token_cache_stats_debug():
+    return get_token_cache_stats()
+
+@app.get("/debug/local-cache")
+async def get_local_cache_stats_debug():
+    return local_cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/debug/db-pools")
+async def get_db_pools_stats_debug():
+    return get_pool_stats()
+
 @app.get("/patients", response_model=List[PatientResponse])
-async def get_patients_debug(db: AsyncSession = Depends(get_db)):
+async def get_patients_debug(
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Patients ordered by id, one page of `limit` rows after `cursor` (the X-Next-Cursor header of the previous page).
+    With stream=true every patient after the cursor is streamed as NDJSON instead.
+    """
     #patients = db.query(Patient).all()
-    patients = await db.execute(select(Patient))
-    return patients.scalars().all()
+    query = select(Patient).order_by(Patient.id)
+    if cursor:
+        after_id, = decode_cursor(cursor, (int,))
+        query = query.where(Patient.id > after_id)
+    
+    if stream:
+        return stream_ndjson(db, query, patient_row)
+    
+    patients = await db.execute(query.limit(limit))
+    return page_response(patients.scalars().all(), limit, patient_row, lambda patient: (patient.id,))
 
 @app.get("/recommendations", response_model=List[RecommendationResponse])
-async def get_recommendations_debug(db: AsyncSession = Depends(get_db)):
+async def get_recommendations_debug(
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Recommendations ordered by (timestamp, id), one page of `limit` rows after `cursor` (the X-Next-Cursor header of the previous page).
+    With stream=true every recommendation after the cursor is streamed as NDJSON instead.
+    """
     #recommendations = db.query(Recommendation).all()
-    recommendations = await db.execute(select(Recommendation))
-    return recommendations.scalars().all()
+    query = select(Recommendation).order_by(Recommendation.timestamp, Recommendation.id)
+    if cursor:
+        after_timestamp, after_id = decode_recommendation_cursor(cursor)
+        query = query.where(tuple_(Recommendation.timestamp, Recommendation.id) > (after_timestamp, after_id))
     
-
+    if stream:
+        return stream_ndjson(db, query, recommendation_row)
+    
+    recommendations = await db.execute(query.limit(limit))
+    return page_response(
+        recommendations.scalars().all(), limit, recommendation_row,
+        lambda recommendation: (recommendation.timestamp.isoformat(), recommendation.id)
+    )
@@ -0,0 +1,158 @@
+"""
+Prometheus metrics of the API, exported in the text format by GET /metrics.
+
+- http_request_duration_seconds: latency of each route (the path template, not the raw path), method and status.
+- db_query_duration_seconds: every SQL statement, from the SQLAlchemy engine events, and per request the number of
+  statements and their total time (http_request_db_queries / http_request_db_seconds).
+- redis_command_duration_seconds: every Redis command, a pipeline or MULTI/EXEC transaction counts as one round trip.
+- cache_requests_total: cache lookups per key family and result (hit in the local cache, hit in Redis or miss).
+- app_startup_seconds: time from the import of the app to each startup milestone (see warmup.py).
+"""
+from contextvars import ContextVar
+from prometheus_client import Counter, Gauge, Histogram
+from redis.asyncio.client import Pipeline
+from sqlalchemy import event
+import redis.asyncio as redis
+import time
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Latency of the HTTP requests", ["method", "route", "status"]
+)
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements executed per HTTP request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent executing SQL statements per HTTP request", ["route"]
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Duration of the SQL statements", ["engine"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+REDIS_COMMAND_DURATION = Histogram(
+    "redis_command_duration_seconds", "Duration of the Redis round trips", ["command"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests", "Cache lookups by key family and result (local_hit, redis_hit, miss)", ["family", "result"]
+)
+STARTUP_SECONDS = Gauge(
+    "app_startup_seconds", "Seconds from the import of the app to each startup milestone", ["milestone"]
+)
+
+
+class RequestStats:
+    # SQL statements and Redis round trips of the current request, shared with the tasks it spawns through the context variable
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_commands = 0
+        self.redis_seconds = 0.0
+
+
+request_stats: ContextVar[RequestStats] = ContextVar("request_stats", default=None)
+
+
+def record_cache(family: str, result: str):
+    CACHE_REQUESTS.labels(family=family, result=result).inc()
+
+
+def instrument_engine(engine, name: str):
+    """
+    Time the statements of an async engine. The start time is kept on the connection,
+    which runs a single statement at a time. Returns a function removing the listeners.
+    """
+    histogram = DB_QUERY_DURATION.labels(engine=name)
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("query_start", time.perf_counter())
+        histogram.observe(elapsed)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_seconds += elapsed
+
+    def remove():
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+
+    return remove
+
+
+def observe_redis(command: str, elapsed: float):
+    REDIS_COMMAND_DURATION.labels(command=command).observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.redis_commands += 1
+        stats.redis_seconds += elapsed
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            observe_redis("MULTI" if self.is_transaction else "PIPELINE", time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.Redis):
+    # Redis client that times every command and pipeline
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            observe_redis(str(args[0]).upper(), time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class StatusRecorder:
+    # ASGI send callable remembering the status of the response, 500 until the response starts
+    def __init__(self, send):
+        self.send = send
+        self.status = 500
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        await self.send(message)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of each request until its response is sent (streamed bodies included),
+    and the SQL statements it executed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        send_with_status = StatusRecorder(send)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            # The router stores the matched route in the scope, unmatched paths share one label
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(method=scope["method"], route=route, status=str(send_with_status.status)).observe(elapsed)
+            HTTP_REQUEST_DB_QUERIES.labels(route=route).observe(stats.db_queries)
+            HTTP_REQUEST_DB_SECONDS.labels(route=route).observe(stats.db_seconds)
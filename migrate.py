@@ -0,0 +1,132 @@
+"""
+Schema migration, run once per deployment before the API replicas start (they don't touch the schema at boot):
+creates the missing tables, upgrades the existing ones, creates the indexes missing from them and on PostgreSQL
+the upcoming partitions of the recommendations. Running it again on an up to date schema changes nothing.
+
+Upgrade steps of existing tables:
+- patients registered twice under the same name are merged before the unique (first_name, last_name) index is created.
+- a recommendations table created before the (id, timestamp) primary key (and on PostgreSQL the partitioning by month)
+  is rebuilt: the current table is created next to it with its indexes and partitions, the rows are copied in and the
+  previous table is dropped, in the migration transaction.
+
+    python migrate.py
+"""
+from datetime import datetime
+from sqlalchemy import inspect, text
+from connection_db import engine
+from models import Base, Recommendation
+from retention import PARTITION_MONTHS_AHEAD, ensure_partitions, month_start
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Patients registered after another patient of the same name, before the unique index existed
+DUPLICATE_PATIENTS = (
+    "SELECT duplicate.id FROM patients duplicate JOIN patients original "
+    "ON original.first_name = duplicate.first_name AND original.last_name = duplicate.last_name AND original.id < duplicate.id"
+)
+
+
+async def index_names(conn, table: str) -> set:
+    indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes(table))
+    return {index["name"] for index in indexes}
+
+
+async def merge_duplicate_patients(conn) -> int:
+    """
+    Keep the oldest patient of each name, the one the previous versions kept updating: the recommendations of the
+    other ones are moved to it and they are deleted. Returns the number of patients deleted.
+    """
+    await conn.execute(text(
+        "UPDATE recommendations SET patient_id = ("
+        "SELECT MIN(original.id) FROM patients original JOIN patients duplicate "
+        "ON original.first_name = duplicate.first_name AND original.last_name = duplicate.last_name "
+        "WHERE duplicate.id = recommendations.patient_id"
+        f") WHERE patient_id IN ({DUPLICATE_PATIENTS})"
+    ))
+    result = await conn.execute(text(f"DELETE FROM patients WHERE id IN ({DUPLICATE_PATIENTS})"))
+    return result.rowcount
+
+
+async def add_patients_name_index(conn):
+    # Conflict target of the patient upserts. create_all doesn't add indexes to a table created by a previous version
+    if "ix_patients_first_name_last_name" in await index_names(conn, "patients"):
+        return
+    merged = await merge_duplicate_patients(conn)
+    if merged:
+        logger.info(f"Merged {merged} duplicate patients")
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_patients_first_name_last_name ON patients (first_name, last_name)"
+    ))
+
+
+async def recommendations_need_rebuild(conn) -> bool:
+    if conn.dialect.name == "postgresql":
+        relkind = await conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('recommendations')"))
+        return relkind.scalar() != "p"
+    primary_key = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_pk_constraint("recommendations"))
+    return primary_key["constrained_columns"] != ["id", "timestamp"]
+
+
+async def rebuild_recommendations(conn):
+    """
+    Replace the recommendations table of a previous version by the current one. Recommendations without a timestamp
+    (it was nullable) get the time of the migration. On PostgreSQL the partitions of the months of the rows are
+    created before the copy.
+    """
+    previous = "recommendations_previous"
+    await conn.execute(text(f"ALTER TABLE recommendations RENAME TO {previous}"))
+    # Index names are unique in the schema: the indexes of the previous table are dropped and its primary key renamed
+    for name in await index_names(conn, previous):
+        await conn.execute(text(f"DROP INDEX {name}"))
+    if conn.dialect.name == "postgresql":
+        primary_key = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_pk_constraint(previous))
+        await conn.execute(text(f"ALTER TABLE {previous} RENAME CONSTRAINT {primary_key['name']} TO {previous}_pkey"))
+    await conn.run_sync(Recommendation.__table__.create)
+
+    now = datetime.utcnow()
+    oldest = (await conn.execute(text(f'SELECT MIN("timestamp") FROM {previous}'))).scalar()
+    if oldest is not None and conn.dialect.name == "postgresql":
+        first, current = month_start(oldest), month_start(now)
+        months = (current.year - first.year) * 12 + current.month - first.month
+        await ensure_partitions(conn, today=first, months_ahead=months + PARTITION_MONTHS_AHEAD)
+    copied = await conn.execute(text(
+        'INSERT INTO recommendations (id, patient_id, recommendation, "timestamp") '
+        f'SELECT id, patient_id, recommendation, COALESCE("timestamp", :now) FROM {previous}'
+    ), {"now": now})
+    await conn.execute(text(f"DROP TABLE {previous}"))
+    logger.info(f"Rebuilt the recommendations table, {copied.rowcount} recommendations copied")
+
+
+def create_missing_indexes(sync_conn):
+    # create_all skips the tables that already exist, the indexes declared since they were created are added here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def upgrade_schema(conn):
+    await conn.run_sync(Base.metadata.create_all)
+    await add_patients_name_index(conn)
+    if await recommendations_need_rebuild(conn):
+        await rebuild_recommendations(conn)
+    await conn.run_sync(create_missing_indexes)
+    await ensure_partitions(conn)
+
+
+async def migrate():
+    start = time.perf_counter()
+    try:
+        async with engine.begin() as conn:
+            await upgrade_schema(conn)
+    finally:
+        await engine.dispose()
+    logger.info(f"Schema up to date in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate())
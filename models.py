@@ -1,12 +1,49 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 #from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import declarative_base
 import uuid
 import datetime
+import os
+import threading
+import time
 
 Base = declarative_base()
 
+
+# Last (unix_ms, counter) of the process, ids are strictly increasing within it
+_uuid7_state = [0, 0]
+_uuid7_lock = threading.Lock()
+
+
+def uuid7() -> str:
+    """
+    Time-ordered UUID (RFC 9562 version 7): 48 bits of unix milliseconds, a 12 bit counter (rand_a, method 1)
+    and random bits. The counter starts at a random value in the lower half of its range every millisecond and is
+    incremented for each id of the same millisecond, so the ids of a process are strictly increasing: new ids sort
+    after the previous ones and inserts append to the right of the primary key index. When the counter overflows,
+    or the clock goes back, the timestamp of the previous id is advanced instead.
+    """
+    rand = int.from_bytes(os.urandom(8), "big")
+    unix_ms = time.time_ns() // 1_000_000
+    with _uuid7_lock:
+        last_ms, counter = _uuid7_state
+        if unix_ms > last_ms:
+            counter = int.from_bytes(os.urandom(2), "big") & 0x7FF
+        else:
+            unix_ms = last_ms
+            counter += 1
+            if counter > 0xFFF:
+                unix_ms, counter = last_ms + 1, 0
+        _uuid7_state[:] = unix_ms, counter
+    value = (unix_ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76  # version
+    value |= counter << 64  # rand_a, the counter
+    value |= 0b10 << 62  # variant
+    value |= rand & ((1 << 62) - 1)  # rand_b
+    return str(uuid.UUID(int=value))
+
+
 class Patient(Base):
     __tablename__ = "patients"
 
@@ -21,15 +58,45 @@ class Patient(Base):
     # Relationship to recommendations (one-to-many). A patient can have multiple recommendations
     recommendations = relationship("Recommendation", back_populates="patient", cascade="all, delete-orphan")
 
+    # A patient is identified by first_name and last_name. The unique index serves the lookups and is the conflict target of the upsert
+    __table_args__ = (
+        Index("ix_patients_first_name_last_name", "first_name", "last_name", unique=True),
+    )
+
 class Recommendation(Base):
     __tablename__ = "recommendations"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4())) # Generate a random UUID when inserting a new recommendation
-    patient_id = Column(Integer, ForeignKey("patients.id", ondelete="CASCADE"), nullable=False, index=True)
+    id = Column(String, primary_key=True, default=uuid7) # Generate a time-ordered UUID when inserting a new recommendation
+    patient_id = Column(Integer, ForeignKey("patients.id", ondelete="CASCADE"), nullable=False)
     recommendation = Column(String, nullable=False)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow) # Generate the current timestamp when inserting a new recommendation
+    # Generate the current timestamp when inserting a new recommendation. It's part of the primary key
+    # because PostgreSQL partitions the table by month on it (see retention.py)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.datetime.utcnow)
 
     # Relationship to patient (many-to-one). Many recommendation can belong to one patient
     patient = relationship("Patient", back_populates="recommendations")
-    
 
+    # Sort key of the keyset pagination of /recommendations
+    __table_args__ = (
+        Index("ix_recommendations_timestamp_id", "timestamp", "id"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+# History of a patient, newest first (/patients/{id}/recommendations). It also serves the foreign key lookups.
+# On PostgreSQL the recommendation text is included in the index, so the history is read with index-only scans
+Index(
+    "ix_recommendations_patient_id_timestamp",
+    Recommendation.patient_id,
+    Recommendation.timestamp.desc(),
+    Recommendation.id.desc(),
+    postgresql_include=["recommendation"],
+)
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+
+    # Events written in the same transaction as the recommendations and relayed to Redis afterwards (see outbox.py)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    stream = Column(String, nullable=False)
+    payload = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
@@ -0,0 +1,78 @@
+from sqlalchemy import delete, text
+from sqlalchemy.future import select
+from models import OutboxEvent
+import asyncio
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "1"))
+
+# Key of the PostgreSQL advisory lock that lets a single relay drain the outbox at a time, which keeps the events in order
+OUTBOX_LOCK_KEY = 727001
+
+
+async def relay_outbox_batch(db, redis_client, stream_maxlen, batch_size=OUTBOX_BATCH_SIZE) -> int:
+    """
+    Publish the oldest outbox events to their Redis Streams in one pipeline and delete them.
+    Events are deleted only after Redis accepted them, so delivery is at-least-once.
+    Returns the number of events relayed.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        locked = await db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": OUTBOX_LOCK_KEY})
+        if not locked.scalar():
+            # Another replica is relaying
+            return 0
+
+    result = await db.execute(select(OutboxEvent.id, OutboxEvent.stream, OutboxEvent.payload).order_by(OutboxEvent.id).limit(batch_size))
+    events = result.all()
+    if not events:
+        await db.rollback()
+        return 0
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for event in events:
+            pipe.xadd(event.stream, {"data": event.payload}, maxlen=stream_maxlen, approximate=True)
+        await pipe.execute()
+
+    await db.execute(delete(OutboxEvent).where(OutboxEvent.id.in_([event.id for event in events])))
+    await db.commit()
+    return len(events)
+
+
+class OutboxRelay:
+    """
+    Background task that drains the outbox to Redis in batches.
+    It polls every OUTBOX_POLL_INTERVAL_SECONDS and is woken up right away when a request commits new events.
+    """
+
+    def __init__(self, session_factory, redis_client, stream_maxlen, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL_SECONDS):
+        self.session_factory = session_factory
+        self.redis_client = redis_client
+        self.stream_maxlen = stream_maxlen
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.wakeup = asyncio.Event()
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            relayed = 0
+            try:
+                async with self.session_factory() as db:
+                    relayed = await relay_outbox_batch(db, self.redis_client, self.stream_maxlen, self.batch_size)
+            except Exception as e:
+                logger.error(f"Error relaying outbox events: {e}")
+
+            if relayed < self.batch_size:
+                # Caught up, wait for new events
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
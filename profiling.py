@@ -0,0 +1,176 @@
+"""
+On-demand profiling of individual requests.
+
+With PROFILING_ENABLED a middleware profiles a request with cProfile when it's sampled (PROFILING_SAMPLE_RATE)
+or when it carries a valid X-Profile header, signed with PROFILING_SECRET (see `profile_header`). For each profiled
+request it writes to PROFILING_DIR:
+- `<name>.prof`: the call tree (pstats format, e.g. `python -m pstats` or snakeviz);
+- `<name>.json`: a summary with the wall time of the request, the time waiting on the database and Redis, and the
+  profiled time per phase (jwt, bcrypt, orm, sql, redis, serialization, framework, app).
+Only the newest PROFILING_MAX_PROFILES profiles are kept.
+
+cProfile follows the event loop thread, so a single request is profiled at a time (the others aren't sampled meanwhile)
+and the coroutines of concurrent requests that run in between are included. Threads (bcrypt) only show as the time
+spent waiting for them. When PROFILING_ENABLED is false the middleware isn't installed at all.
+"""
+from metrics import RequestStats, StatusRecorder, request_stats
+import anyio
+import cProfile
+import hashlib
+import hmac
+import orjson
+import os
+import pstats
+import random
+import re
+import time
+
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# Fraction of the requests profiled, on top of the ones asking for it with the X-Profile header
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+# Key of the X-Profile header signature, the header is ignored when it's not set
+PROFILING_SECRET = os.getenv("PROFILING_SECRET")
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+PROFILING_MAX_PROFILES = int(os.getenv("PROFILING_MAX_PROFILES", "100"))
+
+PROFILE_HEADER = b"x-profile"
+
+# Phase of the profiled functions, by the first matching part of their file path
+PHASES = (
+    ("/jwt/", "jwt"),
+    ("/bcrypt/", "bcrypt"),
+    ("/sqlalchemy/orm/", "orm"),
+    ("/sqlalchemy/", "sql"),
+    ("/aiosqlite/", "sql"),
+    ("/asyncpg/", "sql"),
+    ("/redis/", "redis"),
+    ("/fakeredis/", "redis"),
+    ("/pydantic", "serialization"),
+    ("/orjson/", "serialization"),
+    ("/json/", "serialization"),
+    ("/fastapi/", "framework"),
+    ("/starlette/", "framework"),
+    ("/anyio/", "framework"),
+    ("/asyncio/", "framework"),
+)
+
+
+def sign(secret: str, expires: int) -> str:
+    return hmac.new(secret.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+
+
+def profile_header(secret: str = PROFILING_SECRET, ttl_seconds: int = 300) -> str:
+    # Value of the X-Profile header asking for a profile of the request, valid for ttl_seconds
+    expires = int(time.time()) + ttl_seconds
+    return f"{expires}.{sign(secret, expires)}"
+
+
+def valid_profile_header(value: str, secret: str) -> bool:
+    expires, _, signature = value.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign(secret, int(expires)))
+
+
+def phase_of(filename: str) -> str:
+    filename = filename.replace("\\", "/")
+    for part, phase in PHASES:
+        if part in filename:
+            return phase
+    return "app"
+
+
+def phase_summary(profiler: cProfile.Profile) -> dict:
+    # Own time of the profiled functions, added up per phase
+    phases = {}
+    for (filename, _, _), (_, _, own_time, _, _) in pstats.Stats(profiler).stats.items():
+        phase = phase_of(filename)
+        phases[phase] = phases.get(phase, 0.0) + own_time
+    return dict(sorted(phases.items(), key=lambda item: item[1], reverse=True))
+
+
+def write_profile(directory: str, name: str, profiler: cProfile.Profile, summary: dict, max_profiles: int):
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+    with open(os.path.join(directory, f"{name}.json"), "wb") as file:
+        file.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+    # Names start with the time of the request, the oldest profiles are removed first
+    names = sorted({filename.rsplit(".", 1)[0] for filename in os.listdir(directory) if filename.endswith((".prof", ".json"))})
+    for old_name in names[:max(0, len(names) - max_profiles)]:
+        for extension in (".prof", ".json"):
+            try:
+                os.remove(os.path.join(directory, old_name + extension))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the sampled requests and the ones with a valid X-Profile header.
+    """
+
+    def __init__(self, app, sample_rate=PROFILING_SAMPLE_RATE, secret=PROFILING_SECRET, directory=PROFILING_DIR, max_profiles=PROFILING_MAX_PROFILES):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.profiling = False
+
+    def should_profile(self, scope) -> bool:
+        if self.profiling:
+            return False
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if self.secret:
+            for header, value in scope["headers"]:
+                if header == PROFILE_HEADER:
+                    return valid_profile_header(value.decode("latin-1"), self.secret)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        send_with_status = StatusRecorder(send)
+
+        # The metrics middleware already counts the database and Redis time of the request
+        stats = request_stats.get()
+        token = None
+        if stats is None:
+            stats = RequestStats()
+            token = request_stats.set(stats)
+
+        self.profiling = True
+        profiler = cProfile.Profile()
+        started_at = time.time()
+        start = time.perf_counter()
+        db_seconds, redis_seconds = stats.db_seconds, stats.redis_seconds
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            self.profiling = False
+            if token is not None:
+                request_stats.reset(token)
+
+            route = getattr(scope.get("route"), "path", scope["path"])
+            summary = {
+                "method": scope["method"],
+                "route": route,
+                "path": scope["path"],
+                "status": send_with_status.status,
+                "started_at": started_at,
+                "total_seconds": elapsed,
+                "db_seconds": stats.db_seconds - db_seconds,
+                "redis_seconds": stats.redis_seconds - redis_seconds,
+                "profiled_seconds": phase_summary(profiler),
+            }
+            # Microseconds since the epoch first, so the names sort by time
+            name = f"{int(started_at * 1e6)}-{scope['method']}-{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'}"
+            await anyio.to_thread.run_sync(write_profile, self.directory, name, profiler, summary, self.max_profiles)
@@ -0,0 +1,338 @@
+"""
+Time partitioning and retention of the recommendations.
+
+On PostgreSQL `recommendations` is partitioned by month on `timestamp`: the partitions of the next months are created ahead
+of time (by migrate.py and by `python retention.py`, never by the API replicas) and the ones older than RETENTION_MONTHS
+are archived and dropped as a whole. Rows of the default partition
+(older than the first partition, or inserted before the partition of their month existed) are archived and deleted
+month by month, and moved to the partition of their month when it's created. On SQLite (no partitioning) the same
+API archives and deletes the old rows month by month.
+
+Once a month is archived, `evict(ids, patient_ids)` is called for each row group of its archive so the caches stop
+serving the archived recommendations.
+
+Archives are gzip files with one JSON line per row group of up to ARCHIVE_ROW_GROUP_SIZE rows, stored column by column
+(the recommendation text is dictionary encoded). Run once with `python retention.py`.
+"""
+from datetime import date, datetime
+from sqlalchemy import delete, func, text
+from sqlalchemy.future import select
+from models import Recommendation
+import anyio
+import asyncio
+import gzip
+import logging
+import orjson
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+# Months of recommendations kept in the database, 0 keeps every recommendation
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "0"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_ROW_GROUP_SIZE = int(os.getenv("ARCHIVE_ROW_GROUP_SIZE", "10000"))
+# Partitions created ahead of the current month, so inserts never fall into the default partition
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+
+# Key of the PostgreSQL advisory lock that lets a single replica archive a month at a time
+RETENTION_LOCK_KEY = 727002
+
+PARTITION_NAME = re.compile(r"^recommendations_p(\d{4})(\d{2})$")
+
+
+def month_start(day) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"recommendations_p{month:%Y%m}"
+
+
+def archive_path(directory: str, month: date) -> str:
+    return os.path.join(directory, f"recommendations_{month:%Y_%m}.jsonl.gz")
+
+
+def month_range(month: date):
+    return datetime.combine(month, datetime.min.time()), datetime.combine(add_months(month, 1), datetime.min.time())
+
+
+async def table_exists(conn, name: str) -> bool:
+    return (await conn.execute(text("SELECT to_regclass(:name)"), {"name": name})).scalar() is not None
+
+
+async def default_partition_has_rows(conn, month: date) -> bool:
+    if not await table_exists(conn, "recommendations_default"):
+        return False
+    start, end = month_range(month)
+    result = await conn.execute(text(
+        'SELECT EXISTS (SELECT 1 FROM recommendations_default WHERE "timestamp" >= :start AND "timestamp" < :end)'
+    ), {"start": start, "end": end})
+    return result.scalar()
+
+
+async def ensure_partitions(conn, today: date = None, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """
+    Create the partitions from the current month to `months_ahead` months ahead, and the default partition that
+    catches anything else. Nothing to do on databases without partitioning.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+    # Replicas and the migration may run this at the same time
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RETENTION_LOCK_KEY})
+    current = month_start(today or datetime.utcnow())
+    await conn.execute(text("CREATE TABLE IF NOT EXISTS recommendations_default PARTITION OF recommendations DEFAULT"))
+    for months in range(months_ahead + 1):
+        month = add_months(current, months)
+        name = partition_name(month)
+        bounds = f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        if not await table_exists(conn, name) and await default_partition_has_rows(conn, month):
+            # CREATE ... PARTITION OF fails while the default partition holds rows of the month: the partition is
+            # created on its own, the rows are moved to it and it's attached (its indexes are created by ATTACH)
+            start, end = month_range(month)
+            await conn.execute(text(f"CREATE TABLE {name} (LIKE recommendations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            await conn.execute(text(
+                f'WITH moved AS (DELETE FROM recommendations_default WHERE "timestamp" >= :start AND "timestamp" < :end RETURNING *) '
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ), {"start": start, "end": end})
+            await conn.execute(text(f"ALTER TABLE recommendations ATTACH PARTITION {name} {bounds}"))
+            logger.info(f"Moved the recommendations of {month:%Y-%m} from the default partition to {name}")
+        else:
+            await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF recommendations {bounds}"))
+
+
+def row_group(rows) -> dict:
+    # Columns of a row group, the few distinct recommendation texts are stored once
+    dictionary = {}
+    codes = [dictionary.setdefault(row.recommendation, len(dictionary)) for row in rows]
+    return {
+        "rows": len(rows),
+        "id": [row.id for row in rows],
+        "patient_id": [row.patient_id for row in rows],
+        "recommendation": {"dictionary": list(dictionary), "codes": codes},
+        "timestamp": [row.timestamp.isoformat() for row in rows],
+    }
+
+
+def read_row_groups(path: str):
+    with gzip.open(path, "rb") as archive:
+        for line in archive:
+            yield orjson.loads(line)
+
+
+def read_archive(path: str):
+    # Rows of an archive file, as dicts
+    for group in read_row_groups(path):
+        dictionary = group["recommendation"]["dictionary"]
+        for i in range(group["rows"]):
+            yield {
+                "id": group["id"][i],
+                "patient_id": group["patient_id"][i],
+                "recommendation": dictionary[group["recommendation"]["codes"][i]],
+                "timestamp": group["timestamp"][i],
+            }
+
+
+class ArchiveWriter:
+    """
+    Writes an archive to a temporary file that replaces the archive of the month once it's complete.
+    If the month was already archived (e.g. the rows weren't deleted after a crash) the rows of the previous
+    archive are kept, except the ones written again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.existing = os.path.exists(path)
+        self.ids = set()
+        self.rows = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = gzip.open(self.temp_path, "wb")
+
+    def write(self, rows):
+        self.file.write(orjson.dumps(row_group(rows)) + b"\n")
+        self.rows += len(rows)
+        if self.existing:
+            self.ids.update(row.id for row in rows)
+
+    def close(self):
+        if self.existing:
+            for group in read_row_groups(self.path):
+                keep = [i for i, id in enumerate(group["id"]) if id not in self.ids]
+                if len(keep) < group["rows"]:
+                    codes = group["recommendation"]["codes"]
+                    group = {
+                        "rows": len(keep),
+                        "id": [group["id"][i] for i in keep],
+                        "patient_id": [group["patient_id"][i] for i in keep],
+                        "recommendation": {"dictionary": group["recommendation"]["dictionary"], "codes": [codes[i] for i in keep]},
+                        "timestamp": [group["timestamp"][i] for i in keep],
+                    }
+                if keep:
+                    self.file.write(orjson.dumps(group) + b"\n")
+                    self.rows += len(keep)
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+async def evict_archive(path: str, evict):
+    # Evict the rows of the archive from the caches, one row group at a time
+    groups = read_row_groups(path)
+    while True:
+        group = await anyio.to_thread.run_sync(next, groups, None)
+        if group is None:
+            return
+        await evict(group["id"], set(group["patient_id"]))
+
+
+async def archive_month(db, month: date, directory: str, row_group_size: int = ARCHIVE_ROW_GROUP_SIZE, evict=None) -> int:
+    """
+    Write the recommendations of the month to its archive file, then remove them from the database:
+    on PostgreSQL the partition is detached and dropped and the rows of the default partition deleted, the rows are
+    deleted on SQLite. Rows are read through a server-side cursor one row group at a time.
+    Once committed, the archived rows are evicted from the caches with `evict`. Returns the number of rows archived.
+    """
+    postgresql = db.get_bind().dialect.name == "postgresql"
+    if postgresql:
+        # A single replica archives a month, there is nothing left if another one already did
+        await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RETENTION_LOCK_KEY})
+        has_partition = await table_exists(db, partition_name(month))
+        in_default = await default_partition_has_rows(db, month)
+        if not has_partition and not in_default:
+            await db.rollback()
+            return 0
+
+    start, end = month_range(month)
+    query = (
+        select(Recommendation.id, Recommendation.patient_id, Recommendation.recommendation, Recommendation.timestamp)
+        .where(Recommendation.timestamp >= start, Recommendation.timestamp < end)
+        .order_by(Recommendation.timestamp, Recommendation.id)
+        .execution_options(yield_per=row_group_size)
+    )
+    writer = await anyio.to_thread.run_sync(ArchiveWriter, archive_path(directory, month))
+    try:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            await anyio.to_thread.run_sync(writer.write, rows)
+    except BaseException:
+        writer.discard()
+        raise
+    if writer.rows or writer.existing:
+        await anyio.to_thread.run_sync(writer.close)
+    else:
+        # Empty month, no archive file
+        writer.discard()
+
+    if postgresql and has_partition:
+        await db.execute(text(f"ALTER TABLE recommendations DETACH PARTITION {partition_name(month)}"))
+        await db.execute(text(f"DROP TABLE {partition_name(month)}"))
+    if not postgresql or in_default:
+        await db.execute(delete(Recommendation).where(Recommendation.timestamp >= start, Recommendation.timestamp < end))
+    await db.commit()
+
+    if evict is not None and writer.rows:
+        await evict_archive(archive_path(directory, month), evict)
+    return writer.rows
+
+
+async def expired_months(db, cutoff: date):
+    # Months before the cutoff that still have recommendations in the database
+    if db.get_bind().dialect.name == "postgresql":
+        partitions = await db.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'recommendations'"
+        ))
+        months = []
+        for name in partitions.scalars():
+            match = PARTITION_NAME.match(name)
+            if match:
+                month = date(int(match.group(1)), int(match.group(2)), 1)
+                if month < cutoff:
+                    months.append(month)
+        if await table_exists(db, "recommendations_default"):
+            default_months = await db.execute(text(
+                'SELECT DISTINCT date_trunc(\'month\', "timestamp") FROM recommendations_default WHERE "timestamp" < :cutoff'
+            ), {"cutoff": datetime.combine(cutoff, datetime.min.time())})
+            months.extend(month_start(month) for month in default_months.scalars())
+        return sorted(set(months))
+
+    oldest = (await db.execute(select(func.min(Recommendation.timestamp)))).scalar()
+    if oldest is None:
+        return []
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+    months, month = [], month_start(oldest)
+    while month < cutoff:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+async def run_retention(
+    session_factory, retention_months: int = RETENTION_MONTHS, directory: str = ARCHIVE_DIR, today: date = None, evict=None
+) -> dict:
+    """
+    Archive every month older than `retention_months` months, evicting the archived rows with `evict(ids, patient_ids)`.
+    Returns {month: rows archived}.
+    """
+    if retention_months <= 0:
+        return {}
+    cutoff = add_months(month_start(today or datetime.utcnow()), -retention_months)
+    archived = {}
+    async with session_factory() as db:
+        months = await expired_months(db, cutoff)
+        await db.rollback()
+        for month in months:
+            archived[month] = await archive_month(db, month, directory, evict=evict)
+            logger.info(f"Archived {archived[month]} recommendations of {month:%Y-%m}")
+    return archived
+
+
+class RetentionJob:
+    """
+    Background task that archives the expired months every RETENTION_INTERVAL_SECONDS. The partitions are created by
+    migrate.py and `python retention.py`, outside the API.
+    """
+
+    def __init__(self, session_factory, retention_months=RETENTION_MONTHS, directory=ARCHIVE_DIR, interval=RETENTION_INTERVAL_SECONDS, evict=None):
+        self.session_factory = session_factory
+        self.retention_months = retention_months
+        self.directory = directory
+        self.interval = interval
+        self.evict = evict
+
+    async def run(self):
+        while True:
+            try:
+                await run_retention(self.session_factory, self.retention_months, self.directory, evict=self.evict)
+            except Exception as e:
+                logger.error(f"Error running the recommendations retention: {e}")
+            await asyncio.sleep(self.interval)
+
+
+if __name__ == "__main__":
+    from connection_db import engine, SessionLocal
+    from main import evict_archived_recommendations
+
+    async def main():
+        async with engine.begin() as conn:
+            await ensure_partitions(conn)
+        archived = await run_retention(SessionLocal, evict=evict_archived_recommendations)
+        for month, rows in archived.items():
+            print(f"{month:%Y-%m}: {rows} recommendations archived")
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
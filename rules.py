@@ -0,0 +1,125 @@
+"""
+Recommendation rules.
+
+Each rule is a row of RULES: the recommendation, its priority (lower comes first in the list returned to the patient)
+and the conditions over the patient data that must all hold. A patient that matches no rule gets DEFAULT_RECOMMENDATION.
+
+The table is compiled once into:
+- a Python function for a single patient (`RuleEngine.evaluate`), generated from the conditions so there is no
+  interpretation of the table per call;
+- a NumPy evaluator (`RuleEngine.evaluate_columns` / `evaluate_many`) that checks every rule over whole columns of patients
+  in one pass and packs the matches of each patient in a bit mask, decoded through the list of each distinct mask.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+import operator
+import numpy as np
+
+
+# Patient fields the rules can test, with the NumPy type of their column
+FIELDS = {"age": np.int64, "bmi": np.float64, "chronic_pain": np.bool_, "recent_surgery": np.bool_}
+
+OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq, "!=": operator.ne}
+
+
+@dataclass(frozen=True)
+class Rule:
+    recommendation: str
+    priority: int
+    # (field, operator, value) conditions, all of them must hold
+    conditions: Tuple[Tuple[str, str, object], ...]
+
+    def __post_init__(self):
+        for field, op, _ in self.conditions:
+            if field not in FIELDS:
+                raise ValueError(f"Unknown patient field in rule {self.recommendation!r}: {field}")
+            if op not in OPERATORS:
+                raise ValueError(f"Unknown operator in rule {self.recommendation!r}: {op}")
+
+
+RULES = (
+    Rule("Post-Op Rehabilitation Plan", priority=1, conditions=(("recent_surgery", "==", True),)),
+    Rule("Physical Therapy", priority=2, conditions=(("age", ">", 65), ("chronic_pain", "==", True))),
+    Rule("Weight Management Program", priority=3, conditions=(("bmi", ">", 30),)),
+)
+DEFAULT_RECOMMENDATION = "General Health Checkup"
+
+
+def compile_rules(rules: Sequence[Rule], default: str = DEFAULT_RECOMMENDATION):
+    """
+    Generate the source of a function evaluating the rules in priority order for one patient and compile it.
+    """
+    lines = ["def evaluate(patient):"]
+    fields = sorted({field for rule in rules for field, _, _ in rule.conditions})
+    lines += [f"    {field} = patient.{field}" for field in fields]
+    lines.append("    recommendations = []")
+    for rule in rules:
+        condition = " and ".join(f"{field} {op} {value!r}" for field, op, value in rule.conditions) or "True"
+        lines.append(f"    if {condition}:")
+        lines.append(f"        recommendations.append({rule.recommendation!r})")
+    lines.append("    if not recommendations:")
+    lines.append(f"        recommendations.append({default!r})")
+    lines.append("    return recommendations")
+
+    namespace = {}
+    exec(compile("\n".join(lines), "<recommendation rules>", "exec"), namespace)
+    return namespace["evaluate"]
+
+
+class RuleEngine:
+    """
+    Evaluates a rule table for one patient or for arrays of patients. Both give the same lists, in priority order.
+    At most 64 rules, the matches of a patient are packed in a 64 bit mask.
+    """
+
+    def __init__(self, rules: Sequence[Rule] = RULES, default: str = DEFAULT_RECOMMENDATION):
+        if len(rules) > 64:
+            raise ValueError("At most 64 recommendation rules are supported")
+        self.rules = sorted(rules, key=lambda rule: rule.priority)
+        self.default = default
+        self.evaluate = compile_rules(self.rules, default)
+        # Recommendations of each bit mask seen so far
+        self._recommendations: Dict[int, List[str]] = {0: [default]}
+
+    def __call__(self, patient) -> List[str]:
+        return self.evaluate(patient)
+
+    def masks(self, columns: Dict[str, np.ndarray]) -> np.ndarray:
+        # Bit mask of the rules matched by each patient, bit i set when self.rules[i] matches
+        size = len(next(iter(columns.values())))
+        masks = np.zeros(size, dtype=np.uint64)
+        for bit, rule in enumerate(self.rules):
+            matched = np.ones(size, dtype=bool)
+            for field, op, value in rule.conditions:
+                matched &= OPERATORS[op](columns[field], value)
+            masks |= matched.astype(np.uint64) << np.uint64(bit)
+        return masks
+
+    def recommendations(self, mask: int) -> List[str]:
+        recommendations = self._recommendations.get(mask)
+        if recommendations is None:
+            recommendations = [rule.recommendation for bit, rule in enumerate(self.rules) if mask >> bit & 1] or [self.default]
+            self._recommendations[mask] = recommendations
+        return recommendations
+
+    def evaluate_columns(self, columns: Dict[str, np.ndarray]) -> List[List[str]]:
+        """
+        Recommendations of each patient given as one array per field of FIELDS.
+        Patients with the same result share the same list, which must not be modified.
+        """
+        masks = self.masks(columns)
+        for mask in np.unique(masks).tolist():
+            self.recommendations(mask)
+        by_mask = self._recommendations
+        return [by_mask[mask] for mask in masks.tolist()]
+
+    def evaluate_many(self, patients: Sequence) -> List[List[str]]:
+        # Recommendations of each patient (objects with the FIELDS attributes), see evaluate_columns
+        columns = {
+            field: np.fromiter(map(operator.attrgetter(field), patients), dtype=dtype, count=len(patients))
+            for field, dtype in FIELDS.items()
+        }
+        return self.evaluate_columns(columns)
+
+
+recommendation_rules = RuleEngine()
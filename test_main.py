@@ -4,10 +4,34 @@ from httpx import ASGITransport, AsyncClient
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
-from sqlalchemy import text
-from unittest.mock import patch, AsyncMock
-from main import app, get_db, get_current_user, redis_client
+from sqlalchemy import inspect, text
+from unittest.mock import patch, AsyncMock, MagicMock
+from main import app, get_db, get_read_db, get_current_user, redis_client, upsert_patient, PatientData, create_access_token, token_cache
+from fastapi import HTTPException
+from datetime import timedelta
+import jwt
+from outbox import relay_outbox_batch
+import fakeredis
+import redis
+import bcrypt
 import json
+import orjson
+import time
+import main
+import asyncio
+from cache import LocalCache, SingleFlight, listen_for_invalidations, entry_size, jittered_ttl, should_refresh_early
+import anyio
+from retention import run_retention, read_archive, archive_path
+from datetime import date
+from rules import RuleEngine, Rule
+import itertools
+import uuid
+from ingest import ingest, load_checkpoint
+from metrics import InstrumentedRedis, instrument_engine
+from prometheus_client import REGISTRY
+from profiling import ProfilingMiddleware, profile_header
+from warmup import FirstRequestMiddleware, StartupTimes, open_db_connections, open_redis_connections
+from migrate import upgrade_schema
  
 # Creating a test database to test the endpoints
 engine = create_async_engine(
@@ -18,7 +42,7 @@ engine = create_async_engine(
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
 
 # Create and drop tables
-async def create_tables():
+async def create_tables(engine=engine):
     async with engine.begin() as conn:
         await conn.execute(text(
             """
@@ -36,17 +60,38 @@ async def create_tables():
         await conn.execute(text(
             """
             CREATE TABLE recommendations (
-                id TEXT PRIMARY KEY,
+                id TEXT NOT NULL,
                 patient_id INTEGER NOT NULL,
                 recommendation TEXT NOT NULL,
                 timestamp DATETIME NOT NULL,
+                PRIMARY KEY (id, timestamp),
                 FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE
             )
             """
         ))
+        await conn.execute(text(
+            "CREATE UNIQUE INDEX ix_patients_first_name_last_name ON patients (first_name, last_name)"
+        ))
+        await conn.execute(text(
+            "CREATE INDEX ix_recommendations_timestamp_id ON recommendations (timestamp, id)"
+        ))
+        await conn.execute(text(
+            "CREATE INDEX ix_recommendations_patient_id_timestamp ON recommendations (patient_id, timestamp DESC, id DESC)"
+        ))
+        await conn.execute(text(
+            """
+            CREATE TABLE outbox_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                stream TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at DATETIME NOT NULL
+            )
+            """
+        ))
 
 async def drop_tables():
     async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS outbox_events"))
         await conn.execute(text("DROP TABLE IF EXISTS recommendations"))
         await conn.execute(text("DROP TABLE IF EXISTS patients"))
 
@@ -68,6 +113,7 @@ async def override_get_db():
             yield session
 
     app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_read_db] = get_test_db
     yield 
     app.dependency_overrides.clear()
   
@@ -96,6 +142,37 @@ async def async_client(mock_get_current_user):
 
     app.dependency_overrides.clear() 
 
+@pytest.fixture(autouse=True)
+def clear_local_cache():
+    # The local cache outlives a single test, entries cached by one test must not leak into the next
+    main.local_cache.clear()
+    yield
+    main.local_cache.clear()
+
+
+class MockPipeline:
+    # Queues the commands and runs them against the mocked client on execute
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+
+
 @pytest.fixture
 def mock_redis():
     with patch("main.redis_client", new_callable=AsyncMock) as mock_redis:
@@ -108,9 +185,18 @@ def mock_redis():
         mock_redis.set.return_value = AsyncMock()
         mock_redis.delete.return_value = AsyncMock()
         mock_redis.publish.return_value = AsyncMock()
+        mock_redis.pttl.return_value = 86400 * 1000
+        mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: MockPipeline(mock_redis))
         yield mock_redis
 
 
+@pytest.fixture
+def fake_redis():
+    # In-process Redis stand-in for the code paths that rely on pipelines
+    with patch("main.redis_client", fakeredis.FakeAsyncRedis(decode_responses=True)) as fake_redis:
+        yield fake_redis
+
+
 @pytest.mark.anyio
 @pytest.mark.parametrize(
     "patient_data",
@@ -218,6 +304,15 @@ async def test_login_for_access_token_success(async_client):
         assert "access_token" in json_response
         assert json_response["token_type"] == "bearer"
 
+@pytest.mark.anyio
+async def test_login_for_access_token_with_configured_hash(async_client):
+    password_hash = bcrypt.hashpw(b"s3cret", bcrypt.gensalt(rounds=4))
+    with patch.dict("main.fake_users_db", {"password": password_hash}), patch("main.SECRET_KEY", "mysecretkey_mocked"):
+        response = await async_client.post("/token", data={"username": "admin", "password": "s3cret"})
+        assert response.status_code == 200
+        response = await async_client.post("/token", data={"username": "admin", "password": "admin123"})
+        assert response.status_code == 401
+
 @pytest.mark.anyio
 async def test_login_for_access_token_fail(async_client):
     with patch("main.verify_password", return_value=False):
@@ -225,3 +320,925 @@ async def test_login_for_access_token_fail(async_client):
         print("RESPONSE test_login_for_access_token_fail: ", response.json())
         assert response.status_code == 401
         assert response.json() == {"detail": "Incorrect username or password"}
+
+
+@pytest.mark.anyio
+async def test_upsert_patient(db_session):
+    patient_data = PatientData(first_name="Upsert", last_name="Patient", age=40, bmi=24.0, chronic_pain=False, recent_surgery=False)
+
+    patient_id, changed = await upsert_patient(db_session, patient_data)
+    assert changed
+
+    assert await upsert_patient(db_session, patient_data) == (patient_id, False)
+
+    patient_data.bmi = 31.0
+    assert await upsert_patient(db_session, patient_data) == (patient_id, True)
+    await db_session.commit()
+
+    patients = await db_session.execute(text("SELECT id, bmi FROM patients WHERE first_name = 'Upsert'"))
+    assert patients.all() == [(patient_id, 31.0)]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_batch(async_client, fake_redis, db_session, override_get_db):
+    batch = [
+        {"first_name": "Batch", "last_name": "One", "age": 30, "bmi": 25.0, "chronic_pain": False, "recent_surgery": True},
+        {"first_name": "Batch", "last_name": "Two", "age": 67, "bmi": 37.0, "chronic_pain": True, "recent_surgery": False},
+        {"first_name": "Batch", "last_name": "One", "age": 30, "bmi": 25.0, "chronic_pain": False, "recent_surgery": True},
+        {"first_name": "Batch", "last_name": "One", "age": 30, "bmi": 32.0, "chronic_pain": False, "recent_surgery": False},
+    ]
+    response = await async_client.post("/evaluate/batch", json=batch)
+
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["recommendations"] for result in results] == [
+        ["Post-Op Rehabilitation Plan"],
+        ["Physical Therapy", "Weight Management Program"],
+        ["Post-Op Rehabilitation Plan"],
+        ["Weight Management Program"],
+    ]
+    assert "message" in results[2] and "message" not in results[3]
+
+    patients = await db_session.execute(text("SELECT age, bmi FROM patients WHERE first_name = 'Batch' AND last_name = 'One'"))
+    assert patients.all() == [(30, 32.0)]
+    recommendations = await db_session.execute(text(
+        "SELECT COUNT(*) FROM recommendations JOIN patients ON patients.id = recommendations.patient_id WHERE first_name = 'Batch'"
+    ))
+    assert recommendations.scalar() == 4
+
+    # Same patients again with unchanged data are served from the cache
+    response = await async_client.post("/evaluate/batch", json=batch[1:2])
+    assert response.json() == [{
+        "message": "Patient recommendations retreived from cache",
+        "recommendations": ["Physical Therapy", "Weight Management Program"]
+    }]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_batch_patient_created_concurrently(async_client, fake_redis, db_session, override_get_db):
+    patient = {"first_name": "Racing", "last_name": "Patient", "age": 70, "bmi": 28.0, "chronic_pain": True, "recent_surgery": False}
+    assert (await async_client.post("/evaluate", json=patient)).status_code == 200
+    old_fingerprint_key = main.get_recommendations_cache_key_by_fingerprint(main.get_patient_fingerprint(PatientData(**patient)))
+    assert await fake_redis.exists(old_fingerprint_key)
+
+    # Created by another request after the batch was sent: the batch upserts it instead of failing on the unique index
+    async with TestingSessionLocal() as other_db:
+        await upsert_patient(other_db, PatientData(first_name="Racing", last_name="Other", age=30, bmi=25.0, chronic_pain=False, recent_surgery=False))
+        await other_db.commit()
+    batch = [
+        {**patient, "bmi": 33.0},
+        {"first_name": "Racing", "last_name": "Other", "age": 30, "bmi": 25.0, "chronic_pain": False, "recent_surgery": False},
+    ]
+    response = await async_client.post("/evaluate/batch", json=batch)
+    assert response.status_code == 200
+    assert [result["recommendations"] for result in response.json()] == [
+        ["Physical Therapy", "Weight Management Program"], ["General Health Checkup"]
+    ]
+    patients = await db_session.execute(text("SELECT COUNT(*) FROM patients WHERE first_name = 'Racing'"))
+    assert patients.scalar() == 2
+    # The fingerprint of the previous data of the changed patient is dropped
+    assert not await fake_redis.exists(old_fingerprint_key)
+
+
+@pytest.mark.anyio
+async def test_evaluate_batch_too_large(async_client):
+    with patch("main.MAX_BATCH_SIZE", 1):
+        patient = {"first_name": "Alex", "last_name": "Doe", "age": 30, "bmi": 37.0, "chronic_pain": False, "recent_surgery": False}
+        response = await async_client.post("/evaluate/batch", json=[patient, patient])
+        assert response.status_code == 413
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_fingerprint_fast_path(async_client, fake_redis, db_session, override_get_db):
+    patient_data = {"first_name": "Finger", "last_name": "Print", "age": 70, "bmi": 28.0, "chronic_pain": True, "recent_surgery": False}
+    changed_data = {**patient_data, "bmi": 33.0}
+
+    response = await async_client.post("/evaluate", json=patient_data)
+    assert response.json() == {"recommendations": ["Physical Therapy"]}
+
+    # Same patient with the same conditions never reaches the database
+    with patch("main.upsert_patient", new_callable=AsyncMock) as mock_upsert:
+        response = await async_client.post("/evaluate", json=patient_data)
+        mock_upsert.assert_not_called()
+    assert response.json()["message"] == "Patient recommendations retreived from cache"
+    assert response.json()["recommendations"] == ["Physical Therapy"]
+
+    response = await async_client.post("/evaluate", json=changed_data)
+    assert response.json() == {"recommendations": ["Physical Therapy", "Weight Management Program"]}
+
+    # Going back to the previous conditions must update the patient again instead of serving the old fingerprint
+    response = await async_client.post("/evaluate", json=patient_data)
+    assert response.json() == {"recommendations": ["Physical Therapy"]}
+    patients = await db_session.execute(text("SELECT bmi FROM patients WHERE first_name = 'Finger'"))
+    assert patients.scalar() == 28.0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_writes_events_to_outbox(async_client, fake_redis, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM outbox_events"))
+    await db_session.commit()
+
+    patient_data = {"first_name": "Out", "last_name": "Box", "age": 70, "bmi": 35.0, "chronic_pain": True, "recent_surgery": True}
+    response = await async_client.post("/evaluate", json=patient_data)
+    assert response.status_code == 200
+
+    # Nothing is published from the request, the events wait in the outbox
+    assert await fake_redis.keys("recommendation_stream:*") == []
+    outbox = await db_session.execute(text("SELECT stream, payload FROM outbox_events ORDER BY id"))
+    events = outbox.all()
+    assert [json.loads(payload)["recommendation"] for _, payload in events] == response.json()["recommendations"]
+
+    assert await relay_outbox_batch(db_session, fake_redis, stream_maxlen=1000, batch_size=2) == 2
+    assert await relay_outbox_batch(db_session, fake_redis, stream_maxlen=1000, batch_size=2) == 1
+    assert await relay_outbox_batch(db_session, fake_redis, stream_maxlen=1000, batch_size=2) == 0
+
+    stream = events[0][0]
+    published = await fake_redis.xrange(stream)
+    assert [fields["data"] for _, fields in published] == [payload for _, payload in events]
+    remaining = await db_session.execute(text("SELECT COUNT(*) FROM outbox_events"))
+    assert remaining.scalar() == 0
+
+
+@pytest.fixture
+def jwt_settings():
+    with patch("main.SECRET_KEY", "mysecretkey_mocked_with_32_bytes_at_least"), patch("main.ALGORITHM", "HS256"):
+        token_cache.clear()
+        yield
+        token_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_caches_verified_tokens(jwt_settings):
+    token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=30))
+
+    with patch("main.jwt.decode", wraps=jwt.decode) as mock_decode:
+        assert await get_current_user(token) == "admin"
+        assert await get_current_user(token) == "admin"
+        assert mock_decode.call_count == 1
+
+    stats = main.get_token_cache_stats()
+    assert stats["hits"] >= 1 and stats["cpu_ms_saved"] >= 0
+
+
+@pytest.mark.anyio
+async def test_token_cache_entry_expires_with_the_token(jwt_settings):
+    token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(seconds=1))
+    await get_current_user(token)
+
+    with patch("cache.time.monotonic", return_value=time.monotonic() + 2):
+        assert token_cache.get(token) is None
+
+
+@pytest.mark.anyio
+async def test_get_current_user_rejects_invalid_token(jwt_settings):
+    with pytest.raises(HTTPException) as error:
+        await get_current_user("not-a-jwt")
+    assert error.value.status_code == 401
+    assert error.value.detail == "Invalid token!"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_revoked_token_is_rejected(jwt_settings, fake_redis):
+    token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=30))
+    assert await get_current_user(token) == "admin"
+
+    with patch("main.TOKEN_REVOCATION_ENABLED", True):
+        await main.revoke_token(token, jwt.decode(token, options={"verify_signature": False})["exp"])
+        with pytest.raises(HTTPException) as error:
+            await get_current_user(token)
+    assert error.value.detail == "Token revoked!"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_reads_from_local_cache(async_client, fake_redis, override_get_db):
+    patient_data = {"first_name": "Local", "last_name": "Cache", "age": 30, "bmi": 22.0, "chronic_pain": False, "recent_surgery": False}
+
+    first = await async_client.post("/evaluate", json=patient_data)
+
+    # The second request is served from the in-process cache without reaching Redis
+    with patch.object(fake_redis, "get", wraps=fake_redis.get) as redis_get:
+        second = await async_client.post("/evaluate", json=patient_data)
+
+    assert second.status_code == 200
+    assert second.json()["message"] == "Patient recommendations retreived from cache"
+    assert second.json()["recommendations"] == first.json()["recommendations"]
+    redis_get.assert_not_called()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_local_cache_invalidation_message(fake_redis):
+    local_cache = LocalCache(max_entries=10, ttl=60)
+
+    listener = asyncio.create_task(listen_for_invalidations(fake_redis, local_cache, "cache_invalidation"))
+    try:
+        # Wait until the listener is subscribed, then publish as another replica would
+        while (await fake_redis.pubsub_numsub("cache_invalidation"))[0][1] == 0:
+            await asyncio.sleep(0.01)
+        local_cache.set("recommendation:1", "[]")
+        local_cache.set("recommendation:2", "[]")
+        await fake_redis.publish("cache_invalidation", json.dumps(["recommendation:1"]))
+        for _ in range(100):
+            if local_cache.get("recommendation:1") is None:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        listener.cancel()
+
+    assert local_cache.get("recommendation:1") is None
+    assert local_cache.get("recommendation:2") == "[]"
+
+
+@pytest.mark.anyio
+async def test_local_cache_evicts_by_size():
+    local_cache = LocalCache(max_entries=100, ttl=60, max_bytes=2 * entry_size("a", "x" * 100))
+    local_cache.set("a", "x" * 100)
+    local_cache.set("b", "x" * 100)
+    local_cache.get("a")
+    local_cache.set("c", "x" * 100)
+
+    # The least recently used entry is evicted once the size budget is exceeded
+    assert local_cache.get("b") is None
+    assert local_cache.get("a") is not None
+    assert local_cache.get("c") is not None
+    assert local_cache.stats()["evictions"] == 1
+
+
+@pytest.mark.anyio
+async def test_single_flight_coalesces_concurrent_loads():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await anyio.sleep(0.05)
+        return "value"
+
+    results = []
+
+    async def load():
+        results.append(await single_flight.do("recommendation:1", loader))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(10):
+            tg.start_soon(load)
+
+    assert calls == 1
+    assert results == ["value"] * 10
+    assert len(single_flight) == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_load_once_waits_for_the_replica_holding_the_lock(fake_redis):
+    loader = AsyncMock(return_value="loaded here")
+
+    # Another replica holds the lock and caches the value a moment later
+    await fake_redis.set("lock:recommendation:1", "other-replica", px=5000)
+
+    async def other_replica():
+        await asyncio.sleep(0.1)
+        await fake_redis.set("recommendation:1", json.dumps({"id": "1"}))
+
+    with patch("main.CACHE_LOCK_ENABLED", True):
+        _, result = await asyncio.gather(other_replica(), main.load_once("recommendation:1", loader))
+
+    assert json.loads(result) == {"id": "1"}
+    loader.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_cache_ttl_jitter_and_early_refresh():
+    ttls = {jittered_ttl(86400, 0.1) for _ in range(100)}
+    assert all(77760 <= ttl <= 86400 for ttl in ttls)
+    assert len(ttls) > 1
+
+    # Far from the expiration the entry is served, expired entries are always reloaded
+    assert not should_refresh_early(3600, delta=0.05)
+    assert should_refresh_early(-2, delta=0.05)
+    assert not should_refresh_early(-1, delta=0.05)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evaluate_changed_patient_redis_round_trips(async_client, fake_redis, override_get_db):
+    patient_data = {"first_name": "Round", "last_name": "Trip", "age": 40, "bmi": 24.0, "chronic_pain": False, "recent_surgery": False}
+    await async_client.post("/evaluate", json=patient_data)
+
+    # One round trip to read the cache before the database work and one transaction for every cache write after it
+    send_packed_command = redis.asyncio.connection.Connection.send_packed_command
+    with patch.object(redis.asyncio.connection.Connection, "send_packed_command", autospec=True, side_effect=send_packed_command) as send:
+        response = await async_client.post("/evaluate", json={**patient_data, "bmi": 31.0})
+
+    assert response.json() == {"recommendations": ["Weight Management Program"]}
+    assert send.call_count == 2
+
+    # The new data is served from the cache and the old fingerprint is gone
+    main.local_cache.clear()
+    response = await async_client.post("/evaluate", json={**patient_data, "bmi": 31.0})
+    assert response.json()["message"] == "Patient recommendations retreived from cache"
+    old_fingerprint = main.get_patient_fingerprint(PatientData(**patient_data))
+    assert await fake_redis.get(main.get_recommendations_cache_key_by_fingerprint(old_fingerprint)) is None
+
+    # Unchanged patient whose fingerprint entry is missing: the patient's cache entry is read in a third round trip
+    fingerprint = main.get_patient_fingerprint(PatientData(**{**patient_data, "bmi": 31.0}))
+    await fake_redis.delete(main.get_recommendations_cache_key_by_fingerprint(fingerprint))
+    main.local_cache.clear()
+    with patch.object(redis.asyncio.connection.Connection, "send_packed_command", autospec=True, side_effect=send_packed_command) as send:
+        response = await async_client.post("/evaluate", json={**patient_data, "bmi": 31.0})
+    assert response.json()["message"] == "Patient recommendations retreived from cache"
+    assert send.call_count == 3
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_get_recommendation_by_id_caches_response_body(async_client, fake_redis, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    await db_session.execute(text(
+        "INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES (1, 'John', 'Doe', 30, 25.0, 0, 0)"
+    ))
+    await db_session.execute(text(
+        "INSERT INTO recommendations (id, patient_id, recommendation, timestamp) VALUES ('1', 1, 'General Health Checkup', '2025-03-16T19:56:28.855702')"
+    ))
+    await db_session.commit()
+
+    response = await async_client.get("/recommendation/1")
+    assert response.status_code == 200
+    body = response.content
+
+    # The cached entry is the response body, sent back as it is on a hit
+    assert await fake_redis.get("recommendation:1") == body.decode()
+    main.local_cache.clear()
+    response = await async_client.get("/recommendation/1")
+    assert response.content == body
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {
+        "id": "1",
+        "patient_id": 1,
+        "recommendation": "General Health Checkup",
+        "timestamp": "2025-03-16T19:56:28.855702"
+    }
+
+
+@pytest.mark.anyio
+async def test_patients_and_recommendations_keyset_pagination(async_client, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    for i in range(1, 6):
+        await db_session.execute(text(
+            f"INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES ({i}, 'Page', '{i}', 30, 25.0, 0, 0)"
+        ))
+    # Two recommendations share a timestamp, the id breaks the tie
+    for id, timestamp in (("a", "2025-03-16 10:00:00"), ("c", "2025-03-16 10:00:00"), ("b", "2025-03-16 11:00:00")):
+        await db_session.execute(text(
+            f"INSERT INTO recommendations (id, patient_id, recommendation, timestamp) VALUES ('{id}', 1, 'Physical Therapy', '{timestamp}')"
+        ))
+    await db_session.commit()
+
+    ids, cursor = [], None
+    while True:
+        response = await async_client.get("/patients", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        ids.extend(patient["id"] for patient in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert ids == [1, 2, 3, 4, 5]
+
+    response = await async_client.get("/recommendations", params={"limit": 2})
+    assert [recommendation["id"] for recommendation in response.json()] == ["a", "c"]
+    response = await async_client.get("/recommendations", params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+    assert [recommendation["id"] for recommendation in response.json()] == ["b"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = await async_client.get("/patients", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+    # Decodable cursors with values of the wrong type are rejected before reaching the queries
+    for path, values in (
+        ("/patients", ["x"]), ("/patients", [True]), ("/patients", [1.5]),
+        ("/recommendations", ["2025-03-16T10:00:00", 1]), ("/recommendations", ["not-a-date", "a"]),
+        ("/patients/1/recommendations", [None, "a"]),
+    ):
+        cursor = main.encode_cursor(*values)
+        assert (await async_client.get(path, params={"cursor": cursor})).status_code == 400, (path, values)
+
+
+@pytest.mark.anyio
+async def test_patients_and_recommendations_ndjson_stream(async_client, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    for i in range(1, 6):
+        await db_session.execute(text(
+            f"INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES ({i}, 'Stream', '{i}', 30, 25.0, 0, 0)"
+        ))
+        await db_session.execute(text(
+            f"INSERT INTO recommendations (id, patient_id, recommendation, timestamp) VALUES ('{i}', {i}, 'Physical Therapy', '2025-03-16 10:00:0{i}')"
+        ))
+    await db_session.commit()
+
+    with patch("main.STREAM_CHUNK_SIZE", 2):
+        patients = await async_client.get("/patients", params={"stream": True})
+        recommendations = await async_client.get("/recommendations", params={"stream": True})
+
+    assert patients.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in patients.text.splitlines()] == [1, 2, 3, 4, 5]
+    lines = [json.loads(line) for line in recommendations.text.splitlines()]
+    assert [recommendation["id"] for recommendation in lines] == ["1", "2", "3", "4", "5"]
+    assert lines[0]["timestamp"] == "2025-03-16T10:00:01"
+
+
+def test_uuid7_is_strictly_increasing():
+    # Thousands of ids per millisecond go through the counter, and its overflow into the next millisecond
+    ids = [main.uuid7() for _ in range(10000)]
+    assert ids == sorted(set(ids))
+    assert all(uuid.UUID(id).version == 7 for id in ids)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_patient_recommendations_history(async_client, fake_redis, db_session, override_get_db):
+    patient_data = {"first_name": "History", "last_name": "Patient", "age": 70, "bmi": 22.0, "chronic_pain": True, "recent_surgery": False}
+    await async_client.post("/evaluate", json=patient_data)
+    patient_id = (await db_session.execute(text("SELECT id FROM patients WHERE first_name = 'History'"))).scalar()
+
+    # The first read builds the cached view of the latest recommendations
+    response = await async_client.get(f"/patients/{patient_id}/recommendations")
+    assert [recommendation["recommendation"] for recommendation in response.json()] == ["Physical Therapy"]
+    assert await fake_redis.llen(main.get_latest_recommendations_key(patient_id)) == 1
+
+    # New evaluations are pushed to the cached view, newest first
+    await async_client.post("/evaluate", json={**patient_data, "bmi": 32.0})
+    await async_client.post("/evaluate", json={**patient_data, "recent_surgery": True})
+    response = await async_client.get(f"/patients/{patient_id}/recommendations", params={"limit": 2})
+    latest = response.json()
+    assert [recommendation["recommendation"] for recommendation in latest] == ["Post-Op Rehabilitation Plan", "Physical Therapy"]
+    assert await fake_redis.llen(main.get_latest_recommendations_key(patient_id)) == 5
+
+    # The cached view and the database agree on the order and the following pages
+    await fake_redis.delete(main.get_latest_recommendations_key(patient_id))
+    assert (await async_client.get(f"/patients/{patient_id}/recommendations", params={"limit": 2})).json() == latest
+    pages = [latest]
+    cursor = response.headers["X-Next-Cursor"]
+    while cursor:
+        response = await async_client.get(f"/patients/{patient_id}/recommendations", params={"limit": 2, "cursor": cursor})
+        pages.append(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+    history = [recommendation for page in pages for recommendation in page]
+    assert len(history) == 5
+    assert history == sorted(history, key=lambda recommendation: (recommendation["timestamp"], recommendation["id"]), reverse=True)
+    assert history[-1]["recommendation"] == "Physical Therapy"
+
+    # Time range filters
+    first_timestamp = history[-1]["timestamp"]
+    response = await async_client.get(f"/patients/{patient_id}/recommendations", params={"until": first_timestamp})
+    assert response.json() == []
+    response = await async_client.get(f"/patients/{patient_id}/recommendations", params={"since": history[0]["timestamp"]})
+    assert [recommendation["recommendation"] for recommendation in response.json()] == ["Post-Op Rehabilitation Plan", "Physical Therapy"]
+
+    response = await async_client.get("/patients/999999/recommendations")
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_latest_recommendations_view_is_not_cached_when_evaluated_meanwhile(fake_redis, db_session):
+    patient_data = PatientData(first_name="Latest", last_name="Race", age=70, bmi=25.0, chronic_pain=True, recent_surgery=False)
+    patient_id, _ = await upsert_patient(db_session, patient_data)
+    await main.insert_recommendations(db_session, main.build_recommendation_rows(patient_id, ["Physical Therapy"]))
+    await db_session.commit()
+    key = main.get_latest_recommendations_key(patient_id)
+
+    class EvaluatedDuringRead:
+        # An evaluation of the patient commits and pushes its recommendations right after the read's query
+        async def execute(self, query):
+            result = await db_session.execute(query)
+            batch = main.cache_batch()
+            main.push_latest_recommendations(batch, main.build_recommendation_rows(patient_id, ["Weight Management Program"]))
+            await batch.execute()
+            return result
+
+    assert len(await main.get_latest_recommendations(EvaluatedDuringRead(), patient_id, 5)) == 1
+    assert not await fake_redis.exists(key)
+
+    assert len(await main.get_latest_recommendations(db_session, patient_id, 5)) == 1
+    assert await fake_redis.llen(key) == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_latest_recommendations_rebuilt_before_the_push_has_no_duplicates(fake_redis, db_session):
+    patient_data = PatientData(first_name="Latest", last_name="Rebuilt", age=70, bmi=25.0, chronic_pain=True, recent_surgery=False)
+    patient_id, _ = await upsert_patient(db_session, patient_data)
+    await main.insert_recommendations(db_session, main.build_recommendation_rows(patient_id, ["General Health Checkup"]))
+    await db_session.commit()
+    key = main.get_latest_recommendations_key(patient_id)
+
+    # An evaluation commits, a read rebuilds the view with its recommendations before the evaluation pushes them
+    rows = main.build_recommendation_rows(patient_id, ["Physical Therapy", "Weight Management Program"])
+    await main.insert_recommendations(db_session, rows)
+    await db_session.commit()
+    rebuilt = await main.get_latest_recommendations(db_session, patient_id, 5)
+    assert await fake_redis.llen(key) == 3
+    batch = main.cache_batch()
+    main.push_latest_recommendations(batch, rows)
+    await batch.execute()
+
+    cached = await main.get_latest_recommendations(db_session, patient_id, 5)
+    assert cached == rebuilt
+    assert [orjson.loads(value)["recommendation"] for value in cached] == [
+        "Physical Therapy", "Weight Management Program", "General Health Checkup"
+    ]
+
+
+@pytest.mark.anyio
+async def test_retention_archives_expired_months(db_session, tmp_path):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    await db_session.execute(text(
+        "INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES (1, 'Old', 'Patient', 30, 25.0, 0, 0)"
+    ))
+    rows = [
+        ("jan-1", "Physical Therapy", "2025-01-05 10:00:00.000000"),
+        ("jan-2", "Weight Management Program", "2025-01-31 23:59:59.000000"),
+        ("feb-1", "Physical Therapy", "2025-02-10 08:00:00.000000"),
+        ("apr-1", "General Health Checkup", "2025-04-01 00:00:00.000000"),
+    ]
+    for id, recommendation, timestamp in rows:
+        await db_session.execute(text(
+            f"INSERT INTO recommendations (id, patient_id, recommendation, timestamp) VALUES ('{id}', 1, '{recommendation}', '{timestamp}')"
+        ))
+    await db_session.commit()
+
+    evicted = []
+
+    async def evict(ids, patient_ids):
+        evicted.append((ids, patient_ids))
+
+    # Keep the last month: January and February are archived, April stays in the database
+    archived = await run_retention(TestingSessionLocal, retention_months=1, directory=str(tmp_path), today=date(2025, 4, 15), evict=evict)
+    assert archived == {date(2025, 1, 1): 2, date(2025, 2, 1): 1}
+    # The archived rows are evicted from the caches
+    assert evicted == [(["jan-1", "jan-2"], {1}), (["feb-1"], {1})]
+
+    remaining = await db_session.execute(text("SELECT id FROM recommendations"))
+    assert remaining.scalars().all() == ["apr-1"]
+    january = list(read_archive(archive_path(str(tmp_path), date(2025, 1, 1))))
+    assert [(row["id"], row["recommendation"], row["patient_id"]) for row in january] == [
+        ("jan-1", "Physical Therapy", 1), ("jan-2", "Weight Management Program", 1)
+    ]
+    assert january[0]["timestamp"] == "2025-01-05T10:00:00"
+
+    # Nothing left to archive
+    assert await run_retention(TestingSessionLocal, retention_months=1, directory=str(tmp_path), today=date(2025, 4, 15)) == {}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_evict_archived_recommendations(fake_redis):
+    await fake_redis.set(main.get_recommendations_cache_key_by_id("jan-1"), "{}")
+    await fake_redis.set(main.get_recommendations_cache_key_by_id("apr-1"), "{}")
+    await fake_redis.rpush(main.get_latest_recommendations_key(1), "{}")
+    main.local_cache.set(main.get_recommendations_cache_key_by_id("jan-1"), "{}")
+
+    await main.evict_archived_recommendations(["jan-1"], {1})
+
+    assert not await fake_redis.exists(main.get_recommendations_cache_key_by_id("jan-1"), main.get_latest_recommendations_key(1))
+    assert main.local_cache.get(main.get_recommendations_cache_key_by_id("jan-1")) is None
+    assert await fake_redis.exists(main.get_recommendations_cache_key_by_id("apr-1"))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_read_endpoints_use_the_read_replica(async_client, fake_redis, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    await db_session.commit()
+
+    # A second database plays the replica, it only has the patient the primary doesn't have
+    replica_engine = create_async_engine("sqlite+aiosqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    await create_tables(replica_engine)
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine, class_=AsyncSession)
+    async with ReplicaSessionLocal() as replica:
+        await replica.execute(text(
+            "INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES (7, 'Replica', 'Only', 30, 25.0, 0, 0)"
+        ))
+        await replica.commit()
+
+    async def get_replica_db():
+        async with ReplicaSessionLocal() as session:
+            yield session
+
+    app.dependency_overrides[get_read_db] = get_replica_db
+    try:
+        response = await async_client.post("/evaluate", json={
+            "first_name": "Primary", "last_name": "Write", "age": 70, "bmi": 35.0, "chronic_pain": True, "recent_surgery": False
+        })
+        assert response.status_code == 200
+
+        # The write went to the primary, the reads are served by the replica
+        primary_patients = await db_session.execute(text("SELECT first_name FROM patients"))
+        assert primary_patients.scalars().all() == ["Primary"]
+        recommendation_id = (await db_session.execute(text("SELECT id FROM recommendations"))).scalars().first()
+        response = await async_client.get("/patients")
+        assert [patient["id"] for patient in response.json()] == [7]
+        response = await async_client.get("/recommendations")
+        assert response.json() == []
+        main.local_cache.clear()
+        await fake_redis.flushall()
+        response = await async_client.get(f"/recommendation/{recommendation_id}")
+        assert response.status_code == 404
+    finally:
+        await replica_engine.dispose()
+
+    # Without DATABASE_READ_URL there is a single pool
+    response = await async_client.get("/debug/db-pools")
+    assert list(response.json()) == ["write"]
+    assert {"checkouts", "in_use", "avg_wait_ms", "max_wait_ms"} <= set(response.json()["write"])
+
+
+@pytest.mark.anyio
+async def test_rule_engine_matches_the_previous_rules():
+    def previous_generate_recommendation(patient):
+        recommendations = []
+        if patient.recent_surgery:
+            recommendations.append("Post-Op Rehabilitation Plan")
+        if patient.age > 65 and patient.chronic_pain:
+            recommendations.append("Physical Therapy")
+        if patient.bmi > 30:
+            recommendations.append("Weight Management Program")
+        return recommendations or ["General Health Checkup"]
+
+    # Every combination around the thresholds of the rules
+    patients = [
+        PatientData(first_name="Rule", last_name="Grid", age=age, bmi=bmi, chronic_pain=chronic_pain, recent_surgery=recent_surgery)
+        for age, bmi, chronic_pain, recent_surgery in itertools.product((0, 65, 66, 90), (18.5, 30.0, 30.01, 45.0), (False, True), (False, True))
+    ]
+    expected = [previous_generate_recommendation(patient) for patient in patients]
+    engine = RuleEngine()
+    assert [main.generate_recommendation(patient) for patient in patients] == expected
+    assert engine.evaluate_many(patients) == expected
+    assert engine.evaluate_many([]) == []
+
+    # The priority decides the order, not the position in the table
+    reversed_engine = RuleEngine(list(reversed(engine.rules)))
+    assert reversed_engine.evaluate_many(patients) == expected
+    assert [reversed_engine.evaluate(patient) for patient in patients] == expected
+
+    with pytest.raises(ValueError):
+        Rule("Unknown Field", priority=1, conditions=(("height", ">", 2),))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_ingest_resumes_from_checkpoint(fake_redis, db_session, tmp_path):
+    await fake_redis.flushall()
+    await db_session.execute(text("DELETE FROM outbox_events"))
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    await db_session.commit()
+
+    path = tmp_path / "patients.jsonl"
+    lines = [
+        json.dumps({"first_name": "Ingest", "last_name": str(i), "age": 70, "bmi": 35.0, "chronic_pain": True, "recent_surgery": False})
+        for i in range(5)
+    ]
+    lines.insert(2, '{"first_name": "Broken"}')
+    path.write_text("\n".join(lines) + "\n")
+
+    # The run is interrupted while the second batch is evaluated
+    evaluate_batch = main.evaluate_batch
+    calls = 0
+
+    async def interrupted_evaluate_batch(db, patients_data):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise RuntimeError("Interrupted")
+        return await evaluate_batch(db, patients_data)
+
+    with patch("ingest.evaluate_batch", interrupted_evaluate_batch), pytest.raises(RuntimeError):
+        await ingest(str(path), session_factory=TestingSessionLocal, batch_size=2)
+    checkpoint = load_checkpoint(f"{path}.checkpoint")
+    assert checkpoint["records"] == 2 and checkpoint["line"] == 2
+
+    totals = await ingest(str(path), session_factory=TestingSessionLocal, batch_size=2)
+    assert totals["records"] == 5
+    assert totals["invalid"] == 1
+    assert totals["line"] == 6
+
+    # Every record was evaluated once and its events published
+    patients = await db_session.execute(text("SELECT count(*) FROM patients"))
+    assert patients.scalar() == 5
+    recommendations = await db_session.execute(text("SELECT count(*) FROM recommendations"))
+    assert recommendations.scalar() == 10
+    outbox = await db_session.execute(text("SELECT count(*) FROM outbox_events"))
+    assert outbox.scalar() == 0
+    assert sum([await fake_redis.xlen(key) for key in await fake_redis.keys("recommendation_stream:*")]) == 10
+
+    # Nothing left to ingest
+    assert (await ingest(str(path), session_factory=TestingSessionLocal, batch_size=2))["records"] == 5
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_metrics_endpoint(async_client, db_session, override_get_db):
+    await db_session.execute(text("DELETE FROM recommendations"))
+    await db_session.execute(text("DELETE FROM patients"))
+    await db_session.commit()
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    # The listeners are removed at the end, the engine is shared with the other tests
+    remove_listeners = instrument_engine(engine, "test")
+    try:
+        before = {
+            "requests": sample("http_request_duration_seconds_count", method="POST", route="/evaluate", status="200"),
+            "queries": sample("http_request_db_queries_sum", route="/evaluate"),
+            "misses": sample("cache_requests_total", family="fingerprint", result="miss"),
+            "hits": sample("cache_requests_total", family="fingerprint", result="local_hit"),
+            "pipelines": sample("redis_command_duration_seconds_count", command="PIPELINE"),
+        }
+        patient = {"first_name": "Metrics", "last_name": "Patient", "age": 70, "bmi": 35.0, "chronic_pain": True, "recent_surgery": False}
+        with patch("main.redis_client", InstrumentedRedis(connection_pool=fakeredis.FakeAsyncRedis(decode_responses=True).connection_pool)):
+            assert (await async_client.post("/evaluate", json=patient)).status_code == 200
+            assert (await async_client.post("/evaluate", json=patient)).status_code == 200
+
+        assert sample("http_request_duration_seconds_count", method="POST", route="/evaluate", status="200") == before["requests"] + 2
+        # The first evaluation writes the patient and its recommendations, the second one is served by the fingerprint cache
+        assert sample("http_request_db_queries_sum", route="/evaluate") > before["queries"]
+        assert sample("cache_requests_total", family="fingerprint", result="miss") == before["misses"] + 1
+        assert sample("cache_requests_total", family="fingerprint", result="local_hit") == before["hits"] + 1
+        assert sample("redis_command_duration_seconds_count", command="PIPELINE") > before["pipelines"]
+
+        response = await async_client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'http_request_duration_seconds_bucket{le="0.005",method="POST",route="/evaluate",status="200"}' in response.text
+        assert 'db_query_duration_seconds_count{engine="test"}' in response.text
+    finally:
+        remove_listeners()
+    statements = sample("db_query_duration_seconds_count", engine="test")
+    await db_session.execute(text("SELECT 1"))
+    assert sample("db_query_duration_seconds_count", engine="test") == statements
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_profiling_middleware(mock_get_current_user, fake_redis, override_get_db, tmp_path):
+    app.dependency_overrides[get_current_user] = mock_get_current_user
+    profiled_app = ProfilingMiddleware(app, sample_rate=0, secret="profiling-secret", directory=str(tmp_path), max_profiles=2)
+    patient = {"first_name": "Profiled", "last_name": "Patient", "age": 70, "bmi": 35.0, "chronic_pain": True, "recent_surgery": False}
+
+    async with AsyncClient(transport=ASGITransport(app=profiled_app), base_url="http://test") as client:
+        # Requests without a valid signature aren't profiled
+        assert (await client.get("/patients")).status_code == 200
+        assert (await client.get("/patients", headers={"X-Profile": profile_header("another-secret")})).status_code == 200
+        assert (await client.get("/patients", headers={"X-Profile": profile_header("profiling-secret", ttl_seconds=-1)})).status_code == 200
+        assert list(tmp_path.iterdir()) == []
+
+        headers = {"X-Profile": profile_header("profiling-secret")}
+        assert (await client.get("/patients", headers=headers)).status_code == 200
+        assert (await client.post("/evaluate", json=patient, headers=headers)).status_code == 200
+        assert (await client.post("/evaluate", json=patient, headers=headers)).status_code == 200
+
+    # Only the two newest profiles are kept
+    files = sorted(path.name for path in tmp_path.iterdir())
+    assert len(files) == 4
+    assert all(name.endswith(("-POST-evaluate.json", "-POST-evaluate.prof")) for name in files)
+    summary = json.loads((tmp_path / files[0]).read_text())
+    assert summary["route"] == "/evaluate"
+    assert summary["status"] == 200
+    assert summary["total_seconds"] > 0
+    assert {"db_seconds", "redis_seconds"} <= set(summary)
+    assert "framework" in summary["profiled_seconds"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_warm_up_and_readiness(fake_redis, db_session, mock_get_current_user, override_get_db):
+    patients = (await db_session.execute(text("SELECT COUNT(*) FROM patients"))).scalar()
+    await open_db_connections(engine, 3)
+    await open_redis_connections(fake_redis.connection_pool, 3)
+    await main.warm_up_hot_paths(TestingSessionLocal, TestingSessionLocal)
+    # The evaluation run by the warm-up is rolled back
+    assert (await db_session.execute(text("SELECT COUNT(*) FROM patients"))).scalar() == patients
+    assert (await db_session.execute(text("SELECT COUNT(*) FROM recommendations WHERE patient_id NOT IN (SELECT id FROM patients)"))).scalar() == 0
+
+    app.dependency_overrides[get_current_user] = mock_get_current_user
+    startup_times = StartupTimes(time.perf_counter())
+    timed_app = FirstRequestMiddleware(app, startup_times)
+    async with AsyncClient(transport=ASGITransport(app=timed_app), base_url="http://test") as client:
+        app.state.ready = False
+        assert (await client.get("/ready")).status_code == 503
+        app.state.ready = True
+        response = await client.get("/ready")
+        assert response.status_code == 200
+        assert response.json()["ready"] is True
+        # The probes don't count as the first request
+        assert "first_request" not in startup_times.milestones
+
+        assert (await client.get("/patients")).status_code == 200
+        first_request = startup_times.milestones["first_request"]
+        assert first_request > 0
+        assert (await client.get("/patients")).status_code == 200
+        assert startup_times.milestones["first_request"] == first_request
+    assert REGISTRY.get_sample_value("app_startup_seconds", {"milestone": "first_request"}) == first_request
+    del app.state.ready
+
+
+async def create_baseline_tables(engine):
+    # Schema created by the first version of the app, before the unique name index
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            """
+            CREATE TABLE patients (
+                id INTEGER NOT NULL,
+                first_name VARCHAR NOT NULL,
+                last_name VARCHAR NOT NULL,
+                age INTEGER NOT NULL,
+                bmi FLOAT NOT NULL,
+                chronic_pain BOOLEAN NOT NULL,
+                recent_surgery BOOLEAN NOT NULL,
+                PRIMARY KEY (id)
+            )
+            """
+        ))
+        await conn.execute(text(
+            """
+            CREATE TABLE recommendations (
+                id VARCHAR NOT NULL,
+                patient_id INTEGER NOT NULL,
+                recommendation VARCHAR NOT NULL,
+                timestamp DATETIME,
+                PRIMARY KEY (id),
+                FOREIGN KEY(patient_id) REFERENCES patients (id) ON DELETE CASCADE
+            )
+            """
+        ))
+        await conn.execute(text("CREATE INDEX ix_recommendations_patient_id ON recommendations (patient_id)"))
+        await conn.execute(text(
+            "INSERT INTO patients (id, first_name, last_name, age, bmi, chronic_pain, recent_surgery) VALUES "
+            "(1, 'John', 'Doe', 30, 25.0, 0, 0), (2, 'Jane', 'Roe', 40, 31.0, 0, 0), (3, 'John', 'Doe', 31, 25.0, 0, 0)"
+        ))
+        await conn.execute(text(
+            "INSERT INTO recommendations (id, patient_id, recommendation, timestamp) VALUES "
+            "('a', 1, 'General Health Checkup', '2025-03-16 19:56:28.855702'), "
+            "('b', 2, 'Weight Management Program', '2025-03-16 19:57:28.855702'), "
+            "('c', 3, 'General Health Checkup', '2025-03-17 10:00:00.000000'), "
+            "('d', 2, 'Physical Therapy', NULL)"
+        ))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_migration_upgrades_the_baseline_schema():
+    baseline_engine = create_async_engine("sqlite+aiosqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    await create_baseline_tables(baseline_engine)
+
+    async with baseline_engine.begin() as conn:
+        await upgrade_schema(conn)
+    # Running it again on an up to date schema changes nothing
+    async with baseline_engine.begin() as conn:
+        await upgrade_schema(conn)
+
+    async with baseline_engine.connect() as conn:
+        # The duplicate John Doe is merged into the first one, with its recommendations
+        patients = await conn.execute(text("SELECT id, first_name, last_name FROM patients ORDER BY id"))
+        assert patients.all() == [(1, "John", "Doe"), (2, "Jane", "Roe")]
+        recommendations = await conn.execute(text("SELECT id, patient_id FROM recommendations ORDER BY id"))
+        assert recommendations.all() == [("a", 1), ("b", 2), ("c", 1), ("d", 2)]
+
+        # The recommendations table is rebuilt with the (id, timestamp) primary key and the current indexes
+        def schema(sync_conn):
+            inspector = inspect(sync_conn)
+            return inspector.get_pk_constraint("recommendations"), inspector.get_indexes("recommendations"), inspector.get_table_names()
+        primary_key, indexes, tables = await conn.run_sync(schema)
+        assert primary_key["constrained_columns"] == ["id", "timestamp"]
+        assert {index["name"] for index in indexes} == {"ix_recommendations_timestamp_id", "ix_recommendations_patient_id_timestamp"}
+        assert "recommendations_previous" not in tables
+        assert (await conn.execute(text("SELECT COUNT(*) FROM recommendations WHERE timestamp IS NULL"))).scalar() == 0
+
+    # The unique index is the conflict target of the upsert
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=baseline_engine, class_=AsyncSession)
+    async with session_factory() as db:
+        patient_id, changed = await upsert_patient(db, PatientData(first_name="John", last_name="Doe", age=32, bmi=25.0, chronic_pain=False, recent_surgery=False))
+        await db.commit()
+        assert (patient_id, changed) == (1, True)
+
+    # An index missing from an existing table is created
+    async with baseline_engine.begin() as conn:
+        await conn.execute(text("DROP INDEX ix_recommendations_timestamp_id"))
+        await upgrade_schema(conn)
+        indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes("recommendations"))
+        assert "ix_recommendations_timestamp_id" in {index["name"] for index in indexes}
+    await baseline_engine.dispose()
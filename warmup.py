@@ -0,0 +1,74 @@
+"""
+Startup of an API replica: connections opened ahead of the first requests and the startup milestones.
+
+The milestones are measured from the import of the app (STARTED_AT in main.py): `started` (imports done, the
+lifespan starts), `ready` (warm-up done, GET /ready succeeds) and `first_request` (end of the first request other
+than the probes). They are logged and
+exported as the app_startup_seconds gauge.
+"""
+from metrics import STARTUP_SECONDS
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Requests of the probes and scrapers, which don't count as the first request
+PROBE_PATHS = {"/ready", "/metrics"}
+
+
+async def open_db_connections(engine, count: int):
+    # Check out `count` connections at the same time so the pool opens them, they stay in the pool when released
+    connections = [engine.connect() for _ in range(count)]
+    try:
+        await asyncio.gather(*(connection.start() for connection in connections))
+    finally:
+        await asyncio.gather(*(connection.close() for connection in connections))
+
+
+async def open_redis_connections(pool, count: int):
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(await pool.get_connection("PING"))
+        await asyncio.gather(*(connection.connect() for connection in connections))
+    finally:
+        for connection in connections:
+            await pool.release(connection)
+
+
+class StartupTimes:
+    """
+    Seconds from `started_at` (a time.perf_counter value) to each startup milestone, each one recorded once.
+    """
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.milestones = {}
+
+    def mark(self, milestone: str):
+        if milestone in self.milestones:
+            return
+        seconds = time.perf_counter() - self.started_at
+        self.milestones[milestone] = seconds
+        STARTUP_SECONDS.labels(milestone=milestone).set(seconds)
+        logger.info(f"Startup: {milestone} after {seconds * 1000:.0f} ms")
+
+
+class FirstRequestMiddleware:
+    # ASGI middleware marking the end of the first request that isn't a probe, then only passing the requests through
+    def __init__(self, app, startup_times: StartupTimes):
+        self.app = app
+        self.startup_times = startup_times
+        self.served = False
+
+    async def __call__(self, scope, receive, send):
+        if self.served or scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.served = True
+            self.startup_times.mark("first_request")
@@ -0,0 +1,128 @@
+from abc import ABC, abstractmethod
+import asyncio
+import os
+import smtplib
+import logging
+from email.message import EmailMessage
+
+
+logger = logging.getLogger(__name__)
+
+# Notification delivery configuration
+NOTIFICATION_SENDER = os.getenv("NOTIFICATION_SENDER", "log")
+NOTIFICATION_FROM = os.getenv("NOTIFICATION_FROM", "recommendations@healthcare.local")
+# Patients don't have an email address yet, the recipient is built from the patient id
+NOTIFICATION_RECIPIENT_TEMPLATE = os.getenv("NOTIFICATION_RECIPIENT_TEMPLATE", "patient-{patient_id}@healthcare.local")
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", "10"))
+
+
+def build_message(patient_id, recommendations):
+    message = EmailMessage()
+    message["From"] = NOTIFICATION_FROM
+    message["To"] = NOTIFICATION_RECIPIENT_TEMPLATE.format(patient_id=patient_id)
+    message["Subject"] = "Your new health recommendations"
+    lines = "\n".join(f"- {recommendation}" for recommendation in recommendations)
+    message.set_content(f"Based on your last evaluation we recommend:\n{lines}\n")
+    return message
+
+
+class NotificationSender(ABC):
+    """
+    Delivers the combined notification of a patient. Senders are started once and reused for every delivery,
+    subclasses implement send.
+    """
+
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def send(self, patient_id, recommendations):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LogSender(NotificationSender):
+    # Simulates sending an email by logging it
+    async def send(self, patient_id, recommendations):
+        logger.info(f"Email sent to patient {patient_id} with recommendations: {', '.join(recommendations)}")
+
+
+class SMTPSender(NotificationSender):
+    """
+    Sends the notifications through a pool of persistent SMTP connections.
+    smtplib is blocking, so each delivery runs in a thread while the connection is checked out of the pool.
+    A connection that fails is discarded and replaced by a new one on the next delivery.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, pool_size=SMTP_POOL_SIZE, timeout=SMTP_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connections = asyncio.Queue()
+        for _ in range(pool_size):
+            # None is a free slot without an open connection
+            self.connections.put_nowait(None)
+        self.connects = 0
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.ehlo()
+        self.connects += 1
+        return connection
+
+    def _send(self, connection, message):
+        if connection is not None:
+            try:
+                connection.send_message(message)
+                return connection
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the idle connection, open a new one
+                connection = None
+            except Exception:
+                self._quit(connection)
+                raise
+
+        connection = self._connect()
+        try:
+            connection.send_message(message)
+        except Exception:
+            self._quit(connection)
+            raise
+        return connection
+
+    async def send(self, patient_id, recommendations):
+        message = build_message(patient_id, recommendations)
+        connection = await self.connections.get()
+        try:
+            connection = await asyncio.to_thread(self._send, connection, message)
+        except Exception:
+            connection = None
+            raise
+        finally:
+            self.connections.put_nowait(connection)
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    async def close(self):
+        while not self.connections.empty():
+            connection = self.connections.get_nowait()
+            if connection is not None:
+                await asyncio.to_thread(self._quit, connection)
+
+
+def build_sender(kind=NOTIFICATION_SENDER):
+    if kind == "smtp":
+        return SMTPSender()
+    if kind == "log":
+        return LogSender()
+    raise ValueError(f"Unknown notification sender: {kind}")
@@ -0,0 +1,326 @@
+import pytest
+import asyncio
+import fakeredis
+import json
+from unittest.mock import patch, AsyncMock
+import worker
+from notifications import NotificationSender, SMTPSender
+from prometheus_client import REGISTRY
+
+
+def event(patient_id, recommendation):
+    return {"data": json.dumps({
+        "patient_id": patient_id,
+        "recommendation_id": f"{patient_id}-{recommendation}",
+        "recommendation": recommendation,
+        "timestamp": "2025-03-16T19:56:28.855702"
+    })}
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+async def publish(redis_worker, patient_id, recommendation):
+    await redis_worker.xadd(worker.get_shard_stream(worker.get_patient_shard(patient_id)), event(patient_id, recommendation))
+
+
+async def pending_count(redis_worker):
+    count = 0
+    for shard in range(worker.RECOMMENDATION_SHARDS):
+        count += (await redis_worker.xpending(worker.get_shard_stream(shard), worker.CONSUMER_GROUP))["pending"]
+    return count
+
+
+def all_streams():
+    return {worker.get_shard_stream(shard): ">" for shard in range(worker.RECOMMENDATION_SHARDS)}
+
+
+@pytest.fixture
+async def redis_worker():
+    redis_worker = fakeredis.FakeAsyncRedis(decode_responses=True)
+    await redis_worker.flushall()
+    for shard in range(worker.RECOMMENDATION_SHARDS):
+        await worker.ensure_consumer_group(redis_worker, worker.get_shard_stream(shard))
+    yield redis_worker
+    await redis_worker.flushall()
+
+
+@pytest.mark.anyio
+async def test_consume_batch_and_ack(redis_worker):
+    for patient_id in range(5):
+        await publish(redis_worker, patient_id, "Physical Therapy")
+
+    pool = worker.HandlerPool(redis_worker)
+    with patch("worker.handle_processing_worker", new_callable=AsyncMock) as mock_handler:
+        processed = await worker.consume_once(redis_worker, pool, all_streams(), block_ms=10)
+        await pool.drain()
+
+    assert processed == 5
+    assert sorted(call.args[0][0]["patient_id"] for call in mock_handler.await_args_list) == [0, 1, 2, 3, 4]
+    assert await pending_count(redis_worker) == 0
+
+
+@pytest.mark.anyio
+async def test_ensure_consumer_group_is_idempotent(redis_worker):
+    await worker.ensure_consumer_group(redis_worker, worker.get_shard_stream(0))
+
+
+@pytest.mark.anyio
+async def test_pool_is_bounded_and_keeps_patient_order(redis_worker):
+    running = 0
+    max_running = 0
+    handled = []
+
+    async def slow_handler(events):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        handled.extend((event_data["patient_id"], event_data["recommendation"]) for event_data in events)
+        running -= 1
+
+    for recommendation in ("First", "Second", "Third"):
+        for patient_id in range(4):
+            await publish(redis_worker, patient_id, recommendation)
+
+    # Without coalescing every event is its own task, chained after the previous one of the patient
+    pool = worker.HandlerPool(redis_worker, concurrency=3, coalesce_max_events=1)
+    with patch("worker.handle_processing_worker", side_effect=slow_handler):
+        await worker.consume_once(redis_worker, pool, all_streams(), block_ms=10)
+        await pool.drain()
+
+    assert max_running <= 3
+    for patient_id in range(4):
+        assert [rec for pid, rec in handled if pid == patient_id] == ["First", "Second", "Third"]
+    assert await pending_count(redis_worker) == 0
+
+
+@pytest.mark.anyio
+async def test_failed_events_are_retried_then_dead_lettered(redis_worker):
+    await publish(redis_worker, 1, "Physical Therapy")
+
+    dead_lettered = REGISTRY.get_sample_value("worker_events_total", {"outcome": "dead_lettered"}) or 0
+    pool = worker.HandlerPool(redis_worker)
+    with patch("worker.RETRY_BASE_DELAY_SECONDS", 0), patch("worker.MAX_ATTEMPTS", 3), \
+         patch("worker.handle_processing_worker", new_callable=AsyncMock, side_effect=RuntimeError("smtp down")) as mock_handler:
+        await worker.consume_once(redis_worker, pool, all_streams(), block_ms=10)
+        await pool.drain()
+
+    assert mock_handler.await_count == 3
+    dead_letters = await redis_worker.xrange(worker.DEAD_LETTER_STREAM)
+    assert len(dead_letters) == 1
+    assert dead_letters[0][1]["error"] == "smtp down"
+    assert await pending_count(redis_worker) == 0
+    assert REGISTRY.get_sample_value("worker_events_total", {"outcome": "dead_lettered"}) == dead_lettered + 1
+
+
+@pytest.mark.anyio
+async def test_handled_events_are_measured(redis_worker):
+    handled = REGISTRY.get_sample_value("worker_events_total", {"outcome": "handled"}) or 0
+    lags = REGISTRY.get_sample_value("worker_event_lag_seconds_count") or 0
+    for patient_id in range(3):
+        await publish(redis_worker, patient_id, "Physical Therapy")
+
+    pool = worker.HandlerPool(redis_worker)
+    with patch("worker.handle_processing_worker", new_callable=AsyncMock):
+        await worker.consume_once(redis_worker, pool, all_streams(), block_ms=10)
+        await pool.drain()
+
+    assert REGISTRY.get_sample_value("worker_events_total", {"outcome": "handled"}) == handled + 3
+    assert REGISTRY.get_sample_value("worker_event_lag_seconds_count") == lags + 3
+    assert REGISTRY.get_sample_value("worker_handle_duration_seconds_count") >= 3
+    # The lag runs from the recommendation timestamp, which is naive UTC
+    assert worker.event_lag_seconds({"timestamp": "2025-03-16T19:56:28"}, now=1742154999.0) == 11.0
+    assert worker.event_lag_seconds({}) is None
+
+
+@pytest.mark.anyio
+async def test_pending_events_of_crashed_consumer_are_reclaimed(redis_worker):
+    await publish(redis_worker, 1, "Physical Therapy")
+    # A consumer reads the event and crashes before acking it
+    await redis_worker.xreadgroup(worker.CONSUMER_GROUP, "crashed-worker", all_streams())
+
+    pool = worker.HandlerPool(redis_worker)
+    with patch("worker.CLAIM_IDLE_MS", 0), patch("worker.handle_processing_worker", new_callable=AsyncMock) as mock_handler:
+        assert await worker.reclaim_pending(redis_worker, pool, all_streams()) == 1
+        await pool.drain()
+
+    mock_handler.assert_awaited_once()
+    assert await pending_count(redis_worker) == 0
+
+
+@pytest.mark.anyio
+async def test_events_of_a_patient_are_coalesced(redis_worker):
+    for recommendation in ("Post-Op Rehabilitation Plan", "Physical Therapy", "Weight Management Program"):
+        await publish(redis_worker, 1, recommendation)
+    await publish(redis_worker, 2, "General Health Checkup")
+
+    pool = worker.HandlerPool(redis_worker, coalesce_window_ms=0)
+    with patch.object(worker.notification_sender, "send", new_callable=AsyncMock) as mock_send:
+        await worker.consume_once(redis_worker, pool, all_streams(), block_ms=10)
+        await pool.drain()
+
+    assert sorted(call.args for call in mock_send.await_args_list) == [
+        (1, ["Post-Op Rehabilitation Plan", "Physical Therapy", "Weight Management Program"]),
+        (2, ["General Health Checkup"]),
+    ]
+    assert await pending_count(redis_worker) == 0
+
+
+@pytest.mark.anyio
+async def test_coalescing_flushes_when_the_window_is_full(redis_worker):
+    pool = worker.HandlerPool(redis_worker, coalesce_window_ms=60000, coalesce_max_events=2)
+    with patch("worker.handle_processing_worker", new_callable=AsyncMock) as mock_handler:
+        await pool.add("stream", "1-0", {"patient_id": 1, "recommendation": "Physical Therapy"})
+        assert pool.seconds_to_next_flush() > 0
+        await pool.add("stream", "2-0", {"patient_id": 1, "recommendation": "Weight Management Program"})
+        assert pool.seconds_to_next_flush() is None
+        await asyncio.wait(list(pool.tasks))
+
+    mock_handler.assert_awaited_once()
+    assert len(mock_handler.await_args.args[0]) == 2
+
+
+class LocalSMTPServer:
+    # Minimal SMTP stand-in that keeps the received messages
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 localhost ESMTP\r\n")
+        while line := await reader.readline():
+            command = line.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                writer.write(b"250 localhost\r\n")
+            elif command == "DATA":
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                await writer.drain()
+                lines = []
+                while (data := await reader.readline()) != b".\r\n":
+                    lines.append(data)
+                self.messages.append(b"".join(lines).decode())
+                writer.write(b"250 OK\r\n")
+            elif command == "QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+
+@pytest.fixture
+async def smtp_server():
+    smtp_server = LocalSMTPServer()
+    server = await asyncio.start_server(smtp_server.handle, "127.0.0.1", 0)
+    smtp_server.port = server.sockets[0].getsockname()[1]
+    yield smtp_server
+    server.close()
+
+
+@pytest.mark.anyio
+async def test_smtp_sender_reuses_connections(smtp_server):
+    sender = SMTPSender(host="127.0.0.1", port=smtp_server.port, pool_size=1)
+    await sender.start()
+    for patient_id in range(3):
+        await sender.send(patient_id, ["Physical Therapy", "Weight Management Program"])
+    await sender.close()
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 1 and sender.connects == 1
+    assert "patient-2@" in smtp_server.messages[2]
+    assert "- Physical Therapy" in smtp_server.messages[0]
+
+
+
+def test_sender_without_send_cannot_be_created():
+    class IncompleteSender(NotificationSender):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteSender()
+
+def test_assign_shards_splits_all_shards_between_members():
+    members = ["worker-b", "worker-a", "worker-c"]
+    assignments = [worker.assign_shards(members, member, shards=8) for member in members]
+
+    assert set().union(*assignments) == set(range(8))
+    assert sum(len(assignment) for assignment in assignments) == 8
+    assert worker.assign_shards(members, "unknown", shards=8) == set()
+
+
+@pytest.mark.anyio
+async def test_shards_are_rebalanced_when_workers_join_and_leave(redis_worker):
+    first = worker.ShardCoordinator(redis_worker, worker.HandlerPool(redis_worker), consumer_name="worker-a")
+    second = worker.ShardCoordinator(redis_worker, worker.HandlerPool(redis_worker), consumer_name="worker-b")
+
+    await first.rebalance()
+    assert first.owned == set(range(worker.RECOMMENDATION_SHARDS))
+
+    # The new worker only gets its shards once the first one has released them
+    await second.rebalance()
+    assert second.owned == set()
+    await first.rebalance()
+    await second.rebalance()
+    assert first.owned | second.owned == set(range(worker.RECOMMENDATION_SHARDS))
+    assert first.owned & second.owned == set()
+    assert second.owned
+
+    await second.leave()
+    await first.rebalance()
+    assert first.owned == set(range(worker.RECOMMENDATION_SHARDS))
+
+
+@pytest.mark.anyio
+async def test_leases_are_renewed_while_the_pool_is_full(redis_worker):
+    pool = worker.HandlerPool(redis_worker, concurrency=1, coalesce_window_ms=0)
+    coordinator = worker.ShardCoordinator(redis_worker, pool, consumer_name="worker-a")
+    stopped = asyncio.Event()
+
+    async def slow_handler(events):
+        await asyncio.sleep(0.3)
+
+    with patch("worker.HEARTBEAT_INTERVAL_SECONDS", 0.02), patch("worker.LEASE_TTL_MS", 100), \
+            patch("worker.handle_processing_worker", slow_handler):
+        await coordinator.rebalance()
+        heartbeat = asyncio.create_task(coordinator.run(stopped))
+        for patient_id in range(3):
+            await publish(redis_worker, patient_id, "Physical Therapy")
+        # Waits for free slots far longer than the lease TTL
+        await worker.consume_once(redis_worker, pool, coordinator.streams(), block_ms=10)
+        await pool.flush_due(force=True)
+        assert all(coordinator.owns(stream) for stream in coordinator.streams())
+        await pool.drain()
+        stopped.set()
+        await heartbeat
+
+    assert await pending_count(redis_worker) == 0
+    assert await redis_worker.get(worker.get_shard_lease_key(0)) == "worker-a"
+
+
+@pytest.mark.anyio
+async def test_events_of_a_lost_shard_are_left_to_the_new_owner(redis_worker):
+    pool = worker.HandlerPool(redis_worker)
+    coordinator = worker.ShardCoordinator(redis_worker, pool, consumer_name="worker-a")
+    await coordinator.rebalance()
+    streams = coordinator.streams()
+
+    # Another worker took the shard of patient 1 while this one was stalled
+    shard = worker.get_patient_shard(1)
+    await redis_worker.set(worker.get_shard_lease_key(shard), "worker-b")
+    await publish(redis_worker, 1, "Physical Therapy")
+    await publish(redis_worker, 2, "Physical Therapy")
+    await coordinator.rebalance()
+    assert not coordinator.owns(worker.get_shard_stream(shard))
+
+    with patch("worker.handle_processing_worker", new_callable=AsyncMock) as mock_handler:
+        await worker.consume_once(redis_worker, pool, streams, block_ms=10)
+        await pool.drain()
+
+    assert [call.args[0][0]["patient_id"] for call in mock_handler.await_args_list] == [2]
+    # Read but neither handled nor acked, the new owner reclaims it
+    assert (await redis_worker.xpending(worker.get_shard_stream(shard), worker.CONSUMER_GROUP))["pending"] == 1
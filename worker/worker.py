@@ -1,49 +1,504 @@
 import asyncio
 import json
+import os
+import random
+import signal
+import socket
+import time
+from datetime import datetime, timezone
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import redis.asyncio as redis
 import logging
+from notifications import LogSender, build_sender
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("/app/logs/worker.log"),
-        logging.StreamHandler()
-    ],
-    level=logging.INFO
+
+# Redis information
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+
+# Stream consumer configuration. Events are partitioned by patient_id over RECOMMENDATION_SHARDS streams
+# named "<RECOMMENDATION_STREAM>:<shard>"; both values must match the API
+RECOMMENDATION_STREAM = os.getenv("RECOMMENDATION_STREAM", "recommendation_stream")
+RECOMMENDATION_SHARDS = int(os.getenv("RECOMMENDATION_SHARDS", "8"))
+CONSUMER_GROUP = os.getenv("RECOMMENDATION_CONSUMER_GROUP", "recommendation_workers")
+CONSUMER_NAME = os.getenv("WORKER_NAME", socket.gethostname())
+BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "100"))
+BLOCK_MS = int(os.getenv("WORKER_BLOCK_MS", "5000"))
+# Entries delivered to a consumer that didn't ack them for CLAIM_IDLE_MS (e.g. it crashed) are taken over
+CLAIM_IDLE_MS = int(os.getenv("WORKER_CLAIM_IDLE_MS", "60000"))
+CLAIM_INTERVAL_SECONDS = int(os.getenv("WORKER_CLAIM_INTERVAL_SECONDS", "30"))
+
+# Handler pool configuration
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))
+MAX_ATTEMPTS = int(os.getenv("WORKER_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("WORKER_RETRY_BASE_DELAY_SECONDS", "0.5"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("WORKER_RETRY_MAX_DELAY_SECONDS", "10"))
+# Events of a patient are combined into one notification over a time window or up to a number of events
+COALESCE_WINDOW_MS = int(os.getenv("WORKER_COALESCE_WINDOW_MS", "200"))
+COALESCE_MAX_EVENTS = int(os.getenv("WORKER_COALESCE_MAX_EVENTS", "50"))
+# Events that failed MAX_ATTEMPTS times are moved here for inspection
+DEAD_LETTER_STREAM = os.getenv("RECOMMENDATION_DEAD_LETTER_STREAM", f"{RECOMMENDATION_STREAM}:dead")
+
+# Shard assignment. Workers register with a heartbeat and split the shards between the live members.
+# A shard is only read by the worker holding its lease, which is released after its in-flight events are drained
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("WORKER_HEARTBEAT_INTERVAL_SECONDS", "5"))
+MEMBER_TIMEOUT_SECONDS = float(os.getenv("WORKER_MEMBER_TIMEOUT_SECONDS", "15"))
+LEASE_TTL_MS = int(os.getenv("WORKER_LEASE_TTL_MS", "15000"))
+MEMBERS_KEY = f"{CONSUMER_GROUP}:members"
+
+# Prometheus metrics served on this port
+METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+
+# Replaced by the configured sender when the worker starts
+notification_sender = LogSender()
+
+EVENTS = Counter("worker_events", "Recommendation events by outcome (handled, dead_lettered)", ["outcome"])
+HANDLE_DURATION = Histogram("worker_handle_duration_seconds", "Time to handle a patient's notification, retries included")
+# From the timestamp of the recommendation to the moment its event is handled
+EVENT_LAG = Histogram(
+    "worker_event_lag_seconds", "End-to-end lag of the recommendation events",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
 )
+IN_FLIGHT = Gauge("worker_in_flight_events", "Events read and not handled yet")
 
 
-async def handle_processing_worker(event_data):
-    logger.info(f"Processing recommendation: {event_data['recommendation']} for patient {event_data['patient_id']}")
-    
-    # Simulate sending an email to the patient with the recommendation
-    logger.info(f"Email sent to patient {event_data['patient_id']} with recommendation: {event_data['recommendation']}")
-    
+def event_lag_seconds(event_data, now=None):
+    # Recommendation timestamps are naive UTC datetimes, None if the event has none
+    try:
+        timestamp = datetime.fromisoformat(event_data["timestamp"]).replace(tzinfo=timezone.utc)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (now or time.time()) - timestamp.timestamp()
 
-async def main():
-    redis_worker = redis.Redis(host="redis", port=6379, db=0, decode_responses=True)
-    pubsub = redis_worker.pubsub()
-    await pubsub.subscribe("recommendation_channel")
-    logger.info("Worker started and listening for recommendation events...")
-    
-    while True:
-        message = await pubsub.get_message()
-        
-        # Ensure message is not None and data is a string
-        if message and isinstance(message["data"], str):
+
+def get_shard_stream(shard):
+    return f"{RECOMMENDATION_STREAM}:{shard}"
+
+
+def get_patient_shard(patient_id):
+    return int(patient_id) % RECOMMENDATION_SHARDS
+
+
+def get_shard_lease_key(shard):
+    return f"{CONSUMER_GROUP}:lease:{shard}"
+
+
+def assign_shards(members, consumer_name, shards=RECOMMENDATION_SHARDS):
+    # Round-robin over the sorted members, every worker computes the same assignment
+    members = sorted(members)
+    if consumer_name not in members:
+        return set()
+    index = members.index(consumer_name)
+    return {shard for shard in range(shards) if shard % len(members) == index}
+
+
+async def handle_processing_worker(events):
+    # All the events belong to the same patient and are delivered as one combined notification
+    patient_id = events[0]["patient_id"]
+    recommendations = list(dict.fromkeys(event["recommendation"] for event in events))
+    logger.info(f"Processing {len(events)} recommendation events for patient {patient_id}")
+
+    await notification_sender.send(patient_id, recommendations)
+
+
+async def ensure_consumer_group(redis_worker, stream):
+    try:
+        await redis_worker.xgroup_create(stream, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        # The group already exists
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+class HandlerPool:
+    """
+    Coalesces the events of each patient and runs the handlers as concurrent tasks, at most `concurrency` at a time.
+    A patient's events are buffered until `coalesce_window_ms` has passed since the first one or `coalesce_max_events`
+    are buffered, and are then handled together as one notification.
+    Submitting waits for a free slot, which stops the consumer from reading more events than it can handle.
+    Notifications of the same patient are chained, so they are handled in the order they were read.
+    `owns(stream)` tells whether the worker still holds the lease of a shard stream (ShardCoordinator.owns),
+    the events of a lost shard are left pending for its new owner instead of being handled.
+    """
+
+    def __init__(self, redis_worker, concurrency=WORKER_CONCURRENCY, coalesce_window_ms=COALESCE_WINDOW_MS, coalesce_max_events=COALESCE_MAX_EVENTS):
+        self.redis_worker = redis_worker
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.coalesce_window = coalesce_window_ms / 1000
+        self.coalesce_max_events = coalesce_max_events
+        self.tasks = set()
+        self.in_flight = set()
+        self.buffers = {}
+        self.deadlines = {}
+        self.patient_tails = {}
+        self.pending_acks = {}
+        self.owns = lambda stream: True
+
+    def is_in_flight(self, stream, entry_id):
+        return (stream, entry_id) in self.in_flight
+
+    def in_flight_count(self, stream):
+        return sum(1 for in_flight_stream, _ in self.in_flight if in_flight_stream == stream)
+
+    def ack(self, stream, entry_id):
+        self.pending_acks.setdefault(stream, []).append(entry_id)
+
+    async def flush_acks(self):
+        # Ack everything handled since the last flush with a single XACK per stream
+        pending_acks, self.pending_acks = self.pending_acks, {}
+        for stream, acked in pending_acks.items():
+            await self.redis_worker.xack(stream, CONSUMER_GROUP, *acked)
+
+    def seconds_to_next_flush(self):
+        if not self.deadlines:
+            return None
+        return max(0.0, min(self.deadlines.values()) - time.monotonic())
+
+    async def add(self, stream, entry_id, event_data):
+        patient_id = event_data.get("patient_id")
+        self.in_flight.add((stream, entry_id))
+        if patient_id not in self.buffers:
+            self.buffers[patient_id] = []
+            self.deadlines[patient_id] = time.monotonic() + self.coalesce_window
+        self.buffers[patient_id].append((stream, entry_id, event_data))
+        if len(self.buffers[patient_id]) >= self.coalesce_max_events:
+            await self.submit(patient_id)
+
+    async def flush_due(self, force=False):
+        now = time.monotonic()
+        for patient_id, deadline in list(self.deadlines.items()):
+            if force or deadline <= now:
+                await self.submit(patient_id)
+
+    async def submit(self, patient_id):
+        entries = self.buffers.pop(patient_id)
+        del self.deadlines[patient_id]
+        await self.semaphore.acquire()
+        # The lease may have been lost while waiting for a slot
+        lost = [(stream, entry_id) for stream, entry_id, _ in entries if not self.owns(stream)]
+        if lost:
+            logger.warning(f"Leaving {len(lost)} events of patient {patient_id} to the new owner of their shard")
+            self.in_flight.difference_update(lost)
+            entries = [entry for entry in entries if self.owns(entry[0])]
+            if not entries:
+                self.semaphore.release()
+                return
+        previous = self.patient_tails.get(patient_id)
+        task = asyncio.create_task(self._run(entries, previous))
+        self.patient_tails[patient_id] = task
+        self.tasks.add(task)
+
+        def done(task):
+            self.tasks.discard(task)
+            for stream, entry_id, _ in entries:
+                self.in_flight.discard((stream, entry_id))
+            if self.patient_tails.get(patient_id) is task:
+                del self.patient_tails[patient_id]
+            self.semaphore.release()
+        task.add_done_callback(done)
+
+    async def _run(self, entries, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        events = [event_data for _, _, event_data in entries]
+        entry_ids = ", ".join(entry_id for _, entry_id, _ in entries)
+        started = time.perf_counter()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
             try:
-                logger.info(f"Received message: {message}")
-                event_data = json.loads(message["data"])
-                await handle_processing_worker(event_data)
+                await handle_processing_worker(events)
+                HANDLE_DURATION.observe(time.perf_counter() - started)
+                EVENTS.labels(outcome="handled").inc(len(events))
+                now = time.time()
+                for event_data in events:
+                    lag = event_lag_seconds(event_data, now)
+                    if lag is not None:
+                        EVENT_LAG.observe(lag)
+                break
             except Exception as e:
-                logger.error(f"Error processing message: {e}")
-            
-        await asyncio.sleep(1)
-        
-    
+                if attempt == MAX_ATTEMPTS:
+                    logger.error(f"Giving up on events {entry_ids} after {attempt} attempts: {e}")
+                    if not await self.dead_letter(entries, e, attempt):
+                        # Leave the events pending so that they are reclaimed instead of being lost
+                        return
+                    EVENTS.labels(outcome="dead_lettered").inc(len(events))
+                    break
+                # Exponential backoff with jitter
+                delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+                logger.warning(f"Error processing events {entry_ids} (attempt {attempt}), retrying in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+
+        for stream, entry_id, _ in entries:
+            self.ack(stream, entry_id)
+
+    async def dead_letter(self, entries, error, attempts):
+        try:
+            async with self.redis_worker.pipeline(transaction=False) as pipe:
+                for stream, entry_id, event_data in entries:
+                    pipe.xadd(DEAD_LETTER_STREAM, {
+                        "data": json.dumps(event_data),
+                        "stream": stream,
+                        "entry_id": entry_id,
+                        "error": str(error),
+                        "attempts": attempts
+                    })
+                await pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Could not dead-letter events: {e}")
+            return False
+
+    async def drain(self):
+        # Flush the buffered events, wait for the in-flight handlers and ack them
+        await self.flush_due(force=True)
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+        await self.flush_acks()
+
+
+class ShardCoordinator:
+    """
+    Keeps this worker's membership alive and decides which shard streams it reads.
+    `run` calls `rebalance` periodically in its own task, so a consume loop waiting on busy handlers never lets
+    the leases expire: it acquires the leases of the newly assigned shards, renews the ones held and releases
+    the shards assigned to another worker once their in-flight events are done.
+    """
+
+    def __init__(self, redis_worker, pool, consumer_name=CONSUMER_NAME):
+        self.redis_worker = redis_worker
+        self.pool = pool
+        self.consumer_name = consumer_name
+        self.owned = set()
+        self.releasing = set()
+        # Time until which the lease of each held shard stream is known to be ours (time.monotonic)
+        self.lease_deadlines = {}
+        pool.owns = self.owns
+
+    def streams(self):
+        return {get_shard_stream(shard): ">" for shard in sorted(self.owned)}
+
+    def owns(self, stream):
+        # Whether the lease of the shard stream is still held, as of its last acquisition or renewal
+        return self.lease_deadlines.get(stream, 0.0) > time.monotonic()
+
+    async def run(self, stopped):
+        # Heartbeat and lease renewal until `stopped` is set, the first rebalance is done by the caller
+        while not stopped.is_set():
+            try:
+                await asyncio.wait_for(stopped.wait(), timeout=HEARTBEAT_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.rebalance()
+            except redis.ConnectionError as e:
+                logger.error(f"Lost connection to Redis: {e}")
+
+    async def heartbeat(self):
+        now = time.time()
+        async with self.redis_worker.pipeline(transaction=False) as pipe:
+            pipe.zadd(MEMBERS_KEY, {self.consumer_name: now})
+            pipe.zremrangebyscore(MEMBERS_KEY, "-inf", now - MEMBER_TIMEOUT_SECONDS)
+            pipe.zrange(MEMBERS_KEY, 0, -1)
+            _, _, members = await pipe.execute()
+        return members
+
+    async def rebalance(self):
+        desired = assign_shards(await self.heartbeat(), self.consumer_name)
+
+        for shard in self.owned - desired:
+            logger.info(f"Shard {shard} was assigned to another worker, draining it")
+            self.owned.discard(shard)
+            self.releasing.add(shard)
+
+        for shard in list(self.releasing):
+            if shard in desired:
+                self.releasing.discard(shard)
+                self.owned.add(shard)
+            elif self.pool.in_flight_count(get_shard_stream(shard)) == 0:
+                await self.pool.flush_acks()
+                await self._release_lease(shard)
+                self.releasing.discard(shard)
+
+        for shard in sorted(self.owned | self.releasing):
+            if not await self._renew_lease(shard):
+                logger.warning(f"Lost the lease of shard {shard}")
+                self.owned.discard(shard)
+                self.releasing.discard(shard)
+
+        for shard in sorted(desired - self.owned - self.releasing):
+            # The previous owner may still be draining the shard, try again on the next rebalance
+            started = time.monotonic()
+            if await self.redis_worker.set(get_shard_lease_key(shard), self.consumer_name, nx=True, px=LEASE_TTL_MS):
+                self.lease_deadlines[get_shard_stream(shard)] = started + LEASE_TTL_MS / 1000
+                await ensure_consumer_group(self.redis_worker, get_shard_stream(shard))
+                self.owned.add(shard)
+                logger.info(f"Acquired shard {shard}")
+
+    async def leave(self):
+        # Called after the pool is drained
+        for shard in self.owned | self.releasing:
+            await self._release_lease(shard)
+        self.owned.clear()
+        self.releasing.clear()
+        await self.redis_worker.zrem(MEMBERS_KEY, self.consumer_name)
+
+    async def _renew_lease(self, shard):
+        started = time.monotonic()
+        renewed = await self._if_lease_owner(shard, lambda pipe, key: pipe.pexpire(key, LEASE_TTL_MS))
+        if renewed:
+            self.lease_deadlines[get_shard_stream(shard)] = started + LEASE_TTL_MS / 1000
+        else:
+            self.lease_deadlines.pop(get_shard_stream(shard), None)
+        return renewed
+
+    async def _release_lease(self, shard):
+        self.lease_deadlines.pop(get_shard_stream(shard), None)
+        return await self._if_lease_owner(shard, lambda pipe, key: pipe.delete(key))
+
+    async def _if_lease_owner(self, shard, command):
+        # Only touch the lease while it still belongs to this worker
+        key = get_shard_lease_key(shard)
+        async with self.redis_worker.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != self.consumer_name:
+                    return False
+                pipe.multi()
+                command(pipe, key)
+                await pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+
+async def dispatch_entries(pool, stream, entries):
+    """
+    Add a batch of stream entries to the handler pool, returns the number of events added.
+    Entries that can't be processed are acked right away. Dispatching stops when the lease of the stream is lost,
+    the remaining entries stay pending and are reclaimed by the new owner.
+    """
+    submitted = 0
+    for entry_id, fields in entries:
+        if not pool.owns(stream):
+            logger.warning(f"Lost the lease of {stream}, leaving its remaining events to the new owner")
+            break
+        if pool.is_in_flight(stream, entry_id):
+            # Reclaimed while still being handled by this worker
+            continue
+        if not fields or "data" not in fields:
+            # Entry was trimmed from the stream or is malformed, nothing to process
+            pool.ack(stream, entry_id)
+            continue
+        try:
+            event_data = json.loads(fields["data"])
+        except json.JSONDecodeError as e:
+            logger.error(f"Discarding malformed event {entry_id}: {e}")
+            pool.ack(stream, entry_id)
+            continue
+        await pool.add(stream, entry_id, event_data)
+        submitted += 1
+    return submitted
+
+
+async def reclaim_pending(redis_worker, pool, streams):
+    # Take over the entries left pending by crashed consumers (including a previous run of this one)
+    processed = 0
+    for stream in streams:
+        start_id = "0-0"
+        while True:
+            result = await redis_worker.xautoclaim(
+                stream, CONSUMER_GROUP, CONSUMER_NAME,
+                min_idle_time=CLAIM_IDLE_MS, start_id=start_id, count=BATCH_SIZE
+            )
+            start_id, entries = result[0], result[1]
+            if entries:
+                logger.info(f"Reclaimed {len(entries)} pending events from {stream}")
+                processed += await dispatch_entries(pool, stream, entries)
+            if start_id == "0-0":
+                break
+    await pool.flush_acks()
+    return processed
+
+
+async def consume_once(redis_worker, pool, streams, block_ms=BLOCK_MS):
+    # Block until new entries arrive on any of the streams and dispatch up to BATCH_SIZE of them per wake-up.
+    # The wait is cut short when a buffered patient is due to be flushed
+    seconds_to_flush = pool.seconds_to_next_flush()
+    if seconds_to_flush is not None:
+        block_ms = max(1, min(block_ms, int(seconds_to_flush * 1000)))
+    response = await redis_worker.xreadgroup(CONSUMER_GROUP, CONSUMER_NAME, streams, count=BATCH_SIZE, block=block_ms)
+    processed = 0
+    for stream, entries in response or []:
+        processed += await dispatch_entries(pool, stream, entries)
+    await pool.flush_due()
+    await pool.flush_acks()
+    return processed
+
+
+async def main():
+    global notification_sender
+    notification_sender = build_sender()
+    await notification_sender.start()
+    redis_worker = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+    pool = HandlerPool(redis_worker)
+    IN_FLIGHT.set_function(lambda: len(pool.in_flight))
+    start_http_server(METRICS_PORT)
+    coordinator = ShardCoordinator(redis_worker, pool)
+    logger.info(f"Worker {CONSUMER_NAME} started and consuming {RECOMMENDATION_SHARDS} shards of {RECOMMENDATION_STREAM} as part of {CONSUMER_GROUP}...")
+
+    # On SIGTERM/SIGINT stop reading new events and drain the ones in flight
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    # First assignment of the shards, then the heartbeat runs in its own task until the pool is drained
+    try:
+        await coordinator.rebalance()
+    except redis.ConnectionError as e:
+        logger.error(f"Lost connection to Redis: {e}")
+    heartbeat_stopped = asyncio.Event()
+    heartbeat = asyncio.create_task(coordinator.run(heartbeat_stopped))
+
+    last_claim = 0.0
+    while not stopping.is_set():
+        try:
+            streams = coordinator.streams()
+            if not streams:
+                # More workers than shards, stay as a standby member after handing over what is still buffered
+                await pool.flush_due(force=True)
+                try:
+                    await asyncio.wait_for(stopping.wait(), timeout=HEARTBEAT_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if time.monotonic() - last_claim >= CLAIM_INTERVAL_SECONDS:
+                last_claim = time.monotonic()
+                await reclaim_pending(redis_worker, pool, streams)
+            await consume_once(redis_worker, pool, streams, block_ms=min(BLOCK_MS, int(HEARTBEAT_INTERVAL_SECONDS * 1000)))
+        except redis.ConnectionError as e:
+            logger.error(f"Lost connection to Redis: {e}")
+            await asyncio.sleep(1)
+
+    logger.info(f"Shutting down, draining {len(pool.tasks)} in-flight events...")
+    await pool.drain()
+    heartbeat_stopped.set()
+    await heartbeat
+    await coordinator.leave()
+    await notification_sender.close()
+    await redis_worker.close()
+
+
 if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(os.getenv("WORKER_LOG_FILE", "/app/logs/worker.log")),
+            logging.StreamHandler()
+        ],
+        level=logging.INFO
+    )
     asyncio.run(main())
-    
 